@@ -17,6 +17,141 @@ import logging
 from Template import Template
 from TemplateException import TemplateException
 
+# Total number of possible parameters of a statement in the list of
+# tokens produced by TemplateCompiler.tokenize().
+PARAMS_NUMBER = 3
+
+# Relative positions of parameters in TemplateCompiler.tokenize().
+PARAM_NAME = 1
+PARAM_ESCAPE = 2
+PARAM_GLOBAL = 3
+PARAM_GETTEXT_STRING = 1
+PARAM_TTL = 2
+
+# Opcodes of the compiled form. Static text is stored as a plain string,
+# a statement as its opcode followed by its operands:
+OP_VAR = 1            # OP_VAR, name, escape mode, global mode
+OP_IF = 2             # OP_IF, name, global mode, jump
+OP_UNLESS = 3         # OP_UNLESS, name, global mode, jump
+OP_LOOP = 4           # OP_LOOP, name, jump
+OP_ELSE = 5           # OP_ELSE, jump
+OP_END_IF = 6         # OP_END_IF
+OP_END_UNLESS = 7     # OP_END_UNLESS
+OP_END_LOOP = 8       # OP_END_LOOP
+OP_BOUNDARY = 9       # OP_BOUNDARY
+OP_INCLUDE = 10       # OP_INCLUDE, filename
+OP_GETTEXT = 11       # OP_GETTEXT, text
+OP_INVALID = 12       # OP_INVALID, statement
+OP_CACHE = 13         # OP_CACHE, key names, ttl, jump
+OP_END_CACHE = 14     # OP_END_CACHE
+
+# Opcodes of the statements and their number of operands.
+OPCODES = {
+    "<TMPL_VAR"      : OP_VAR,
+    "<TMPL_IF"       : OP_IF,
+    "<TMPL_UNLESS"   : OP_UNLESS,
+    "<TMPL_LOOP"     : OP_LOOP,
+    "<TMPL_ELSE"     : OP_ELSE,
+    "</TMPL_IF"      : OP_END_IF,
+    "</TMPL_UNLESS"  : OP_END_UNLESS,
+    "</TMPL_LOOP"    : OP_END_LOOP,
+    "<TMPL_BOUNDARY" : OP_BOUNDARY,
+    "<TMPL_INCLUDE"  : OP_INCLUDE,
+    "<TMPL_GETTEXT"  : OP_GETTEXT,
+    "<TMPL_CACHE"    : OP_CACHE,
+    "</TMPL_CACHE"   : OP_END_CACHE,
+    }
+STATEMENTS = dict([ (op, statement) for statement, op in OPCODES.items() ])
+OPERANDS = {
+    OP_VAR : 3, OP_IF : 3, OP_UNLESS : 3, OP_LOOP : 2, OP_ELSE : 1,
+    OP_END_IF : 0, OP_END_UNLESS : 0, OP_END_LOOP : 0, OP_BOUNDARY : 0,
+    OP_INCLUDE : 1, OP_GETTEXT : 1, OP_INVALID : 1, OP_CACHE : 3,
+    OP_END_CACHE : 0,
+    }
+
+# Escape modes of TMPL_VAR. The default mode is resolved by the processor.
+ESCAPE_DEFAULT = 0
+ESCAPE_HTML = 1
+ESCAPE_URL = 2
+ESCAPE_NONE = 3
+ESCAPE_MODES = { "HTML" : ESCAPE_HTML, "1" : ESCAPE_HTML,
+                 "URL" : ESCAPE_URL,
+                 "NONE" : ESCAPE_NONE, "0" : ESCAPE_NONE }
+
+# Global lookup modes. None means the setting of the processor is used.
+GLOBAL_MODES = { "1" : 1, "0" : 0 }
+
+
+def assemble(tokens):
+    """ Convert a list of tokens produced by TemplateCompiler.tokenize()
+        into the compiled form. Jumps of the block statements are left
+        unset, see TemplateCompiler.link_blocks().
+        @hidden
+    """
+    code = []
+    i = 0
+    len_tokens = len(tokens)
+    while i < len_tokens:
+        token = tokens[i]
+        if not (token.startswith("<TMPL_") or token.startswith("</TMPL_")):
+            # Empty text needs no instruction.
+            if token:
+                code.append(token)
+            i += 1
+            continue
+        params = list(tokens[i + 1:i + 1 + PARAMS_NUMBER])
+        params.extend([None] * (PARAMS_NUMBER - len(params)))
+        name = params[PARAM_NAME - 1]
+        if type(name) is str:
+            name = intern(name)
+        op = OPCODES.get(token, OP_INVALID)
+        if op == OP_VAR:
+            code.extend([op, name,
+                         ESCAPE_MODES.get(params[PARAM_ESCAPE - 1],
+                                          ESCAPE_DEFAULT),
+                         GLOBAL_MODES.get(params[PARAM_GLOBAL - 1])])
+        elif op == OP_IF or op == OP_UNLESS:
+            code.extend([op, name,
+                         GLOBAL_MODES.get(params[PARAM_GLOBAL - 1]), None])
+        elif op == OP_LOOP:
+            code.extend([op, name, None])
+        elif op == OP_ELSE:
+            code.extend([op, None])
+        elif op == OP_INCLUDE:
+            code.extend([op, name])
+        elif op == OP_GETTEXT:
+            code.extend([op, params[PARAM_GETTEXT_STRING - 1]])
+        elif op == OP_CACHE:
+            # The names of the key variables are separated by colons.
+            keys = tuple([ intern(key) for key in (name or "").split(":")
+                           if key ])
+            ttl = params[PARAM_TTL - 1]
+            if ttl != None:
+                try:
+                    ttl = float(ttl)
+                except ValueError:
+                    raise TemplateException, "Invalid TTL in <TMPL_CACHE>."
+            code.extend([op, keys, ttl, None])
+        elif op == OP_INVALID:
+            code.extend([op, token])
+        else:
+            code.append(op)
+        i += 1 + PARAMS_NUMBER
+    return code
+
+def is_assembled(tokens):
+    """ Return true if the list is in the compiled form, false if it is
+        a list of tokens produced by TemplateCompiler.tokenize().
+        @hidden
+    """
+    for token in tokens:
+        if type(token) is int:
+            return 1
+        if token.startswith("<TMPL_") or token.startswith("</TMPL_"):
+            return 0
+    # Static text only, both forms are the same.
+    return 1
+
 
 ##############################################
 #              CLASS: Template               #
@@ -37,15 +172,21 @@ class TMPLTemplate( Template ):
         method.
     """
 
-    def __init__(self, file, content=None, logger=None):
+    def __init__(self, file, content=None, logger=None, locale=None):
         self._file = file
         self._content = content
+        self._locale = locale
         self._mtime = None
 
         self._version = __version__
         self._tokens = None
+        self._linked = 0
+        self._parts = None
+        self._schema = None
         self._compile_params = None
         self._include_mtimes = {}
+        self._renderer = None
+        self._profiled_renderer = None
         self._logger = logger
 
         if not file:
@@ -61,15 +202,30 @@ class TMPLTemplate( Template ):
             raise TemplateException, "Template: file does not exist: '%s'" % file
         
     def init(self, version, include_files, tokens, compile_params,
-             logger=None):
+             logger=None, linked=0, parts=None, schema=None):
         """ Initialization.
+
+            The tokens can be given either in the compiled form or as
+            a list of tokens produced by TemplateCompiler.tokenize().
+            The index of the parts of linked tokens may be given, see
+            parts(), and the schema of the data, see schema().
             @hidden
         """
         self._version = version
-        self._tokens = tokens
+        self._schema = schema
+        if is_assembled(tokens):
+            self._tokens = tokens
+            self._linked = linked
+            self._parts = parts
+        else:
+            self._tokens = assemble(tokens)
+            self._linked = 0
+            self._parts = None
         self._compile_params = compile_params
         self._logger = logger
         self._include_mtimes = {}
+        self._renderer = None
+        self._profiled_renderer = None
 
         # Save modificaton times of all included template files.
         for inc_file in include_files:
@@ -133,20 +289,113 @@ class TMPLTemplate( Template ):
     
     def getid(self):
         """ Return the identification of this template, either
-        filename or md5 of content.
+        filename or md5 of content. The locale of a template whose gettext
+        strings were translated by the compiler is appended after '@'.
         """
         if self._file:
-            return self._file
+            id = self._file
         else:
             import md5
-            return md5.new(self._content).hexdigest()
+            id = md5.new(self._content).hexdigest()
+        if self._locale:
+            id = "%s@%s" % (id, self._locale)
+        return id
+
+    def locale(self):
+        """ Get the locale into which the gettext strings of this template
+            were translated by the compiler, or None.
+            @hidden
+        """
+        return self._locale
 
     def tokens(self):
-        """ Get tokens of this template.
+        """ Get tokens of this template in the compiled form.
             @hidden
         """
         return self._tokens
 
+    def link(self):
+        """ Make sure the jumps of the block statements are set. Templates
+            which were not compiled by the TemplateCompiler are linked
+            (and validated) on the first call.
+            @hidden
+        """
+        if not self._linked:
+            from TMPLTemplateManager import TMPLTemplateCompiler
+            TMPLTemplateCompiler(logger=self._logger).link_blocks(self._tokens)
+            self._linked = 1
+
+    def parts(self):
+        """ Get the index of the parts of this template: the list of the
+            positions at which the parts start, or an empty list if the
+            parts cannot be found statically. The index is built on the
+            first call if the compiler did not record it.
+            @hidden
+        """
+        self.link()
+        if self._parts is None:
+            from TMPLTemplateManager import TMPLTemplateCompiler
+            self._parts = TMPLTemplateCompiler(logger=self._logger)\
+                          .index_parts(self._tokens)
+        return self._parts
+
+    def schema(self):
+        """ Get the schema of the data referenced by this template.
+
+            The schema is found by the compiler. It's a mapping with the
+            following keys:
+
+            <ul>
+            <li><em>vars</em>: sorted list of the names of the variables
+            referenced outside of loops. Names of loops tested by
+            TMPL_IF or TMPL_UNLESS and the key variables of TMPL_CACHE
+            statements are included.</li>
+            <li><em>loops</em>: mapping of the names of the loops to the
+            schemas of their bodies, which have the same keys except
+            <em>includes</em>.</li>
+            <li><em>globals</em>: sorted list of the names of the variables
+            in a loop with the parameter GLOBAL=1, they may be found in the
+            enclosing scopes.</li>
+            <li><em>magic</em>: sorted list of the names of the magic
+            variables of a loop.</li>
+            <li><em>includes</em>: mapping of the filenames of the included
+            templates to the sorted lists of the names of the variables
+            and loops they reference.</li>
+            </ul>
+
+            Blocks which the compiler removed because they produce no
+            output are not part of the schema.
+
+            @header schema()
+            @return The schema.
+        """
+        if self._schema is None:
+            from TMPLTemplateManager import TMPLTemplateCompiler
+            self._schema = TMPLTemplateCompiler(logger=self._logger)\
+                           .schema(self._tokens)
+        return self._schema
+
+    def renderer(self, profile=0):
+        """ Get the generated rendering function of this template.
+            The function is generated on the first call and cached.
+            Return None if the template cannot be translated.
+            The profiling function is generated and cached separately.
+            @hidden
+        """
+        if profile:
+            if self._profiled_renderer is None:
+                from TMPLTemplateCodegen import TMPLTemplateCodegen
+                self._profiled_renderer = \
+                    TMPLTemplateCodegen(self._logger).compile(self, 1) or 0
+            return self._profiled_renderer or None
+        if self._renderer is None:
+            from TMPLTemplateCodegen import TMPLTemplateCodegen
+            self._renderer = TMPLTemplateCodegen(self._logger).compile(self)
+            if self._renderer is None:
+                # Remember that the template must be interpreted.
+                self._renderer = 0
+        return self._renderer or None
+
     def file(self):
         """ Get filename of the main file of this template.
             @hidden
@@ -175,11 +424,14 @@ class TMPLTemplate( Template ):
 
     def __getstate__(self):
         """ Used by pickle when the class is serialized.
-            Remove the 'debug' attribute before serialization.
+            Remove the 'debug' attribute and the generated rendering
+            functions before serialization.
             @hidden
         """
         dict = copy.copy(self.__dict__)
         del dict["_logger"]
+        dict.pop("_renderer", None)
+        dict.pop("_profiled_renderer", None)
         return dict
 
     def __setstate__(self, dict):
@@ -188,6 +440,19 @@ class TMPLTemplate( Template ):
             @hidden
         """
         self.__dict__ = dict
+        if not dict.has_key("_linked"):
+            # Template precompiled by an older version of the compiler.
+            if dict.get("_tokens") is not None:
+                dict["_tokens"] = assemble(dict["_tokens"])
+            self._linked = 0
+        if not dict.has_key("_parts"):
+            self._parts = None
+        if not dict.has_key("_locale"):
+            self._locale = None
+        if not dict.has_key("_schema"):
+            self._schema = None
+        self._renderer = None
+        self._profiled_renderer = None
 
 
 
@@ -0,0 +1,130 @@
+"""
+Fragment cache of the tmpl template engine. It stores the output of the
+TMPL_CACHE blocks of processed templates, so a block rendered with the
+same key is not processed again.
+"""
+
+__version__='$Revision: 3193 $'[11:-2]
+
+# All imported modules are part of the standard Python library.
+import time
+import threading
+import collections
+
+
+##############################################
+#           CLASS: TMPLTemplateCache
+##############################################
+
+class TMPLTemplateCache:
+    """ A store of rendered fragments with LRU eviction and expiration.
+
+        Pass an instance of this class to <em>TMPLTemplateProcessor.init()
+        </em> to enable caching of the blocks of the
+        <strong>TMPL_CACHE</strong> statements:
+
+        <pre>
+        &lt;TMPL_CACHE user:lang TTL=300&gt;...&lt;/TMPL_CACHE&gt;
+        </pre>
+
+        The output of a block is stored under the key of the template, the
+        position of the block and the values of the variables named by the
+        statement, separated by colons. A block which names no variables
+        is rendered once for all data. The output expires after
+        <strong>TTL</strong> seconds, or after the default ttl of the cache.
+
+        When the cache holds size fragments, the least recently used one
+        is dropped. An instance can be shared by processors in several
+        threads.
+    """
+
+    def __init__(self, size=1000, ttl=None, timer=time.time):
+        """ Constructor.
+
+            @header __init__(size=1000, ttl=None, timer=time.time)
+            @param size Maximal number of stored fragments.
+            @param ttl Default number of seconds after which a fragment
+            expires. None means that fragments without the TTL parameter
+            never expire.
+            @param timer Function which returns the current time in seconds.
+        """
+        self.size = size
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        # Mapping of keys to (fragment, expiration time), the least
+        # recently used first.
+        self._fragments = collections.OrderedDict()
+
+    def get(self, key):
+        """ Return the fragment stored under the key, or None if there is
+            none or it has expired.
+
+            @header get(key)
+            @return String or None.
+            @param key The key of the fragment.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._fragments.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[1] is not None and entry[1] <= self.timer():
+                self.misses += 1
+                return None
+            # Reinsert the fragment as the most recently used one.
+            self._fragments[key] = entry
+            self.hits += 1
+            return entry[0]
+        finally:
+            self._lock.release()
+
+    def set(self, key, fragment, ttl=None):
+        """ Store a fragment under the key.
+
+            @header set(key, fragment, ttl=None)
+            @return No return value.
+            @param key The key of the fragment.
+            @param fragment The rendered output.
+            @param ttl Number of seconds after which the fragment expires,
+            or None for the default ttl of the cache.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        if ttl is None:
+            expires = None
+        else:
+            expires = self.timer() + ttl
+        self._lock.acquire()
+        try:
+            self._fragments.pop(key, None)
+            self._fragments[key] = (fragment, expires)
+            while len(self._fragments) > self.size:
+                self._fragments.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """ Drop all fragments and reset the counters.
+
+            @header clear()
+            @return No return value.
+        """
+        self._lock.acquire()
+        try:
+            self._fragments.clear()
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        """ Return the number of stored fragments, including the expired
+            ones which were not looked up yet.
+            @hidden
+        """
+        return len(self._fragments)
@@ -0,0 +1,361 @@
+"""
+Code generating backend of the tmpl template engine. It translates the
+code of a compiled template into the source of a Python function
+which renders the template by direct calls, so the processor does not need
+to re-interpret the tokens on every run.
+"""
+
+__version__='$Revision: 3193 $'[11:-2]
+
+# All imported modules are part of the standard Python library.
+import gettext
+import logging
+
+# template imports
+from TemplateException import TemplateException
+from TMPLTemplateProcessor import INCLUDE_WARNING, EMPTY_SCOPE, LoopIterator
+from TMPLTemplate import OP_VAR, OP_IF, OP_UNLESS, OP_LOOP, OP_ELSE, \
+     OP_END_IF, OP_END_UNLESS, OP_END_LOOP, OP_BOUNDARY, OP_INCLUDE, \
+     OP_GETTEXT, OP_CACHE, OP_END_CACHE, OPERANDS, STATEMENTS, ESCAPE_DEFAULT, \
+     ESCAPE_HTML, ESCAPE_URL, ESCAPE_NONE
+
+# Name of the generated function.
+RENDER_FUNCTION = "render"
+
+# Local names of the escape functions of the processor.
+ESCAPE_NAMES = { ESCAPE_DEFAULT : "escape_default",
+                 ESCAPE_HTML : "escape_html",
+                 ESCAPE_URL : "escape_url",
+                 ESCAPE_NONE : "escape_none" }
+
+
+class CodegenError(Exception):
+    """ This exception is _PRIVATE_ and non fatal. It's raised when
+        a template cannot be translated and must be interpreted instead.
+        @hidden
+    """
+
+    def __init__(self, error):
+        """ Constructor.
+            @hidden
+        """
+        Exception.__init__(self, "%s" % error)
+
+
+##############################################
+#          CLASS: TMPLTemplateCodegen
+##############################################
+
+class TMPLTemplateCodegen:
+    """ Translate a compiled template into a Python function.
+
+        The generated function takes the processor as its only argument
+        and returns the same string as <em>TMPLTemplateProcessor.process()</em>
+        would return for the whole template. Variables are still resolved
+        by the processor, therefore the output is identical to the output
+        of the interpreter.
+
+        Invalid templates are not translated. The processor interprets
+        them and raises the appropriate exception.
+    """
+
+    def __init__(self, logger=None):
+        """ Constructor.
+
+            @header __init__(logger=None)
+            @param logger A logger object for logging debugging messages.
+        """
+        self._logger = logger
+
+    def generate(self, code, profile=0):
+        """ Return the source of the rendering function of the code.
+
+            @header generate(code, profile=0)
+            @return String containing the source of the function.
+            @param code The compiled form of a template.
+            @param profile Generate a function which records the time
+            spent in every statement and the output it produces. See
+            <em>TMPLTemplateProfiler</em>. The labels of the statements
+            are left in the list self.labels.
+        """
+        self._lines = []
+        self._depth = 0
+        self._profile = profile
+        self.labels = [()]
+        self.emit("def %s(self):" % RENDER_FUNCTION)
+        self._depth += 1
+        if profile:
+            self.emit("timer = self._profiler.timer")
+            self.emit("stats = self._profiler.counters(TEMPLATE, LABELS)")
+            self.emit("size = 0")
+            self.begin(0)
+        self.emit("find_value = self.find_value")
+        self.emit("find_loop = self.find_loop")
+        self.emit("escapes = self._escapes")
+        self.emit("cache = self._cache")
+        for mode, name in ESCAPE_NAMES.items():
+            self.emit("%s = escapes[%d]" % (name, mode))
+        self.emit("loop_rows = []")
+        self.emit("loop_pass = []")
+        self.emit("loop_total = []")
+        self.emit("scopes = []")
+        self.emit("chains = []")
+        self.emit("out = []")
+        self.emit("append = out.append")
+
+        # Stack of the currently open blocks. Each item is a list of
+        # [closing opcode, TMPL_ELSE seen, indentation of the block,
+        #  index of the label of the block, position of the block].
+        blocks = []
+        i = 0
+        len_code = len(code)
+        while i < len_code:
+            op = code[i]
+            if type(op) is not int:
+                if profile:
+                    self.emit("size += %d" % len(op))
+                self.emit("append(%r)" % op)
+                i += 1
+                continue
+
+            if op == OP_VAR:
+                if not ESCAPE_NAMES.has_key(code[i + 2]):
+                    raise CodegenError("Invalid escape mode %s." % code[i + 2])
+                value = "%s(find_value(%r, scopes, loop_pass, loop_total, " \
+                        "%r, chains))" % (ESCAPE_NAMES[code[i + 2]],
+                                          code[i + 1], code[i + 3])
+                if profile:
+                    index = self.label(blocks, op, code[i + 1])
+                    self.emit("start = timer()")
+                    self.emit("piece = %s" % value)
+                    self.emit("stat = stats[%d]" % index)
+                    self.emit("stat[0] += 1; stat[1] += timer() - start; "
+                              "stat[2] += len(piece)")
+                    self.emit("size += len(piece)")
+                    self.emit("append(piece)")
+                else:
+                    self.emit("append(%s)" % value)
+
+            elif op == OP_LOOP:
+                blocks.append([OP_END_LOOP, 0, self._depth,
+                               self.label(blocks, op, code[i + 1]), i])
+                self.begin(blocks[-1][3])
+                self.emit("rows = find_loop(%r, scopes, loop_pass, loop_total, "
+                          "chains)" % code[i + 1])
+                self.emit("if len(rows): scopes.append(rows[0])")
+                self.emit("else: scopes.append(EMPTY_SCOPE)")
+                self.emit("passtotal = len(rows)")
+                self.emit("loop_rows.append(rows)")
+                self.emit("loop_total.append(passtotal)")
+                self.emit("loop_pass.append(0)")
+                self.emit("chains.append({})")
+                self.emit("if passtotal != 0:")
+                self._depth += 1
+                self.emit("while 1:")
+                self._depth += 1
+                self.emit("pass")
+
+            elif op == OP_IF or op == OP_UNLESS:
+                if op == OP_IF:
+                    closing = OP_END_IF
+                    test = "if"
+                else:
+                    closing = OP_END_UNLESS
+                    test = "if not"
+                blocks.append([closing, 0, self._depth,
+                               self.label(blocks, op, code[i + 1]), i])
+                self.begin(blocks[-1][3])
+                self.emit("%s find_value(%r, scopes, loop_pass, "
+                          "loop_total, %r, chains):"
+                          % (test, code[i + 1], code[i + 2]))
+                self._depth += 1
+                self.emit("pass")
+
+            elif op == OP_ELSE:
+                if not blocks or blocks[-1][1] or \
+                   blocks[-1][0] == OP_END_CACHE:
+                    raise CodegenError("Unmatched <TMPL_ELSE>.")
+                blocks[-1][1] = 1
+                if blocks[-1][0] == OP_END_LOOP:
+                    # The ELSE block of a loop is processed when the loop
+                    # has no passes.
+                    self.next_pass()
+                self._depth = blocks[-1][2]
+                self.emit("else:")
+                self._depth += 1
+                self.emit("pass")
+
+            elif op == OP_END_LOOP:
+                if not blocks or blocks[-1][0] != op:
+                    raise CodegenError("Unmatched </TMPL_LOOP>.")
+                closing, else_seen, depth, index, start = blocks.pop()
+                if not else_seen:
+                    self.next_pass()
+                self._depth = depth
+                self.emit("loop_pass.pop()")
+                self.emit("loop_rows.pop()")
+                self.emit("loop_total.pop()")
+                self.emit("scopes.pop()")
+                self.emit("chains.pop()")
+                self.end(index)
+
+            elif op == OP_END_IF or op == OP_END_UNLESS:
+                if not blocks or blocks[-1][0] != op:
+                    raise CodegenError("Unmatched closing statement.")
+                closing, else_seen, depth, index, start = blocks.pop()
+                self._depth = depth
+                self.end(index)
+
+            elif op == OP_CACHE:
+                # The block is rendered into the output and then joined
+                # into one fragment, which is stored in the cache.
+                blocks.append([OP_END_CACHE, 0, self._depth,
+                               self.label(blocks, op, ":".join(code[i + 1])),
+                               i])
+                self.begin(blocks[-1][3])
+                self.emit("if cache is None: fragment_%d = None" % i)
+                self.emit("else:")
+                self._depth += 1
+                keys = "".join([ "str(find_value(%r, scopes, loop_pass, "
+                                 "loop_total, None, chains)), " % var
+                                 for var in code[i + 1] ])
+                self.emit("key_%d = (self._cache_scope, TEMPLATE, %d, (%s))"
+                          % (i, i, keys))
+                self.emit("fragment_%d = cache.get(key_%d)" % (i, i))
+                self._depth -= 1
+                self.emit("if fragment_%d is not None:" % i)
+                self._depth += 1
+                if profile:
+                    self.emit("size += len(fragment_%d)" % i)
+                self.emit("append(fragment_%d)" % i)
+                self._depth -= 1
+                self.emit("else:")
+                self._depth += 1
+                self.emit("mark_%d = len(out)" % i)
+
+            elif op == OP_END_CACHE:
+                if not blocks or blocks[-1][0] != op:
+                    raise CodegenError("Unmatched </TMPL_CACHE>.")
+                closing, else_seen, depth, index, start = blocks.pop()
+                self.emit("if cache is not None:")
+                self._depth += 1
+                self.emit("fragment_%d = ''.join(out[mark_%d:])"
+                          % (start, start))
+                self.emit("del out[mark_%d:]" % start)
+                self.emit("append(fragment_%d)" % start)
+                self.emit("cache.set(key_%d, fragment_%d, %r)"
+                          % (start, start, code[start + 2]))
+                self._depth = depth
+                self.end(index)
+
+            elif op == OP_BOUNDARY:
+                self.emit("self._current_part += 1")
+
+            elif op == OP_INCLUDE:
+                if profile:
+                    self.emit("size += %d" % len(INCLUDE_WARNING % code[i + 1]))
+                self.emit("append(%r)" % (INCLUDE_WARNING % code[i + 1]))
+
+            elif op == OP_GETTEXT:
+                self.emit("piece = gettext.gettext(%r)" % code[i + 1])
+                if profile:
+                    self.emit("size += len(piece)")
+                self.emit("append(piece)")
+
+            else:
+                raise CodegenError("Invalid opcode %s." % op)
+            i += 1 + OPERANDS[op]
+
+        if blocks:
+            raise CodegenError("Missing closing statement.")
+        self.end(0)
+        self.emit("return ''.join(out)")
+        source = "\n".join(self._lines) + "\n"
+        self._lines = None
+        return source
+
+    def compile(self, template, profile=0):
+        """ Translate a compiled template into its rendering function.
+
+            @header compile(template, profile=0)
+            @return The rendering function or None if the template cannot
+            be translated.
+            @param template A compiled template.
+            @param profile Generate a function which records the profile
+            of the processing. See the <em>generate()</em> method.
+        """
+        try:
+            template.link()
+        except TemplateException, error:
+            self.debug("CODEGEN: DECLINED: %s" % error)
+            return None
+        try:
+            source = self.generate(template.tokens(), profile)
+        except CodegenError, error:
+            self.debug("CODEGEN: DECLINED: %s" % error)
+            return None
+        self.debug("CODEGEN: SOURCE:\n" + source)
+        namespace = {"gettext": gettext, "EMPTY_SCOPE": EMPTY_SCOPE,
+                     "LoopIterator": LoopIterator,
+                     "TEMPLATE": template.getid(),
+                     "LABELS": tuple(self.labels)}
+        code = compile(source, "<tmpl:%s>" % template.getid(), "exec")
+        exec code in namespace
+        return namespace[RENDER_FUNCTION]
+
+    def debug(self, msg, level=logging.DEBUG):
+        if self._logger:
+            self._logger.write(msg, level=level)
+
+    ##############################################
+    #              PRIVATE METHODS               #
+    ##############################################
+
+    def emit(self, line):
+        """ Append a line of source at the current indentation.
+            @hidden
+        """
+        self._lines.append("    " * self._depth + line)
+
+    def label(self, blocks, op, name):
+        """ Add the label of a statement nested in the blocks and return
+            its index. The label is the tuple of the statements from the
+            outermost block, for example ("TMPL_LOOP Rows", "TMPL_VAR a").
+            @hidden
+        """
+        if not self._profile:
+            return None
+        if blocks:
+            path = self.labels[blocks[-1][3]]
+        else:
+            path = ()
+        self.labels.append(path + ("%s %s" % (STATEMENTS[op][1:], name),))
+        return len(self.labels) - 1
+
+    def begin(self, index):
+        """ Start measuring the block with the label index.
+            @hidden
+        """
+        if self._profile:
+            self.emit("start_%d = timer(); size_%d = size" % (index, index))
+
+    def end(self, index):
+        """ Record the measurement of the block with the label index.
+            @hidden
+        """
+        if self._profile:
+            self.emit("stat = stats[%d]" % index)
+            self.emit("stat[0] += 1; stat[1] += timer() - start_%d; "
+                      "stat[2] += size - size_%d" % (index, index))
+
+    def next_pass(self):
+        """ Close the body of a loop: record the pass, leave the loop
+            after the last one and enter the scope of the next one.
+            @hidden
+        """
+        self.emit("loop_pass[-1] += 1")
+        self.emit("if loop_pass[-1] == loop_total[-1]: break")
+        self.emit("rows = loop_rows[-1]")
+        self.emit("scopes[-1] = rows[loop_pass[-1]]")
+        self.emit("if rows.__class__ is LoopIterator: "
+                  "loop_total[-1] = len(rows)")
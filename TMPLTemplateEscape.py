@@ -0,0 +1,116 @@
+"""
+Escaping of variables of the tmpl template engine. The ESCAPE parameter
+of every TMPL_VAR is resolved by the compiler, the processor binds each
+escape mode to one of the functions of this module, or to a function
+supplied by the application.
+"""
+
+__version__='$Revision: 3193 $'[11:-2]
+
+# All imported modules are part of the standard Python library.
+import urllib       # for URL escaping of variables
+
+# template imports
+from TemplateException import TemplateException
+from TMPLTemplate import ESCAPE_DEFAULT, ESCAPE_HTML, ESCAPE_URL, \
+     ESCAPE_NONE, ESCAPE_MODES
+
+# Characters replaced by HTML escaping and their entities. The ampersand
+# must be replaced first.
+HTML_ESCAPES = (("&", "&amp;"), ("<", "&lt;"), (">", "&gt;"),
+                ('"', "&quot;"))
+
+# Translation table of HTML escaping of unicode strings.
+HTML_TABLE = dict([ (ord(char), unicode(entity))
+                    for char, entity in HTML_ESCAPES ])
+
+
+class SafeString(str):
+    """ A string which is already escaped.
+
+        Values of this type are never escaped by the processor, whatever
+        the ESCAPE parameter of the TMPL_VAR statement is. Use it for
+        values which contain markup produced by the application.
+    """
+
+
+def escape_html(value):
+    """ Convert a value to a string and replace HTML brackets, ampersands
+        and double quotes with the appropriate HTML entities.
+
+        @header escape_html(value)
+        @return The escaped string.
+        @param value The value of a template variable.
+    """
+    if value.__class__ is not str:
+        if isinstance(value, SafeString):
+            return str(value)
+        if isinstance(value, unicode):
+            return str(value.translate(HTML_TABLE))
+        value = str(value)
+    # Most values contain none of the characters, so look before
+    # replacing.
+    if "&" in value:
+        value = value.replace("&", "&amp;")
+    if "<" in value:
+        value = value.replace("<", "&lt;")
+    if ">" in value:
+        value = value.replace(">", "&gt;")
+    if '"' in value:
+        value = value.replace('"', "&quot;")
+    return value
+
+def escape_url(value):
+    """ Convert a value to a string and escape it for use in an URL.
+
+        @header escape_url(value)
+        @return The escaped string.
+        @param value The value of a template variable.
+    """
+    if isinstance(value, SafeString):
+        return str(value)
+    return urllib.quote_plus(str(value))
+
+def escape_none(value):
+    """ Convert a value to a string without escaping.
+
+        @header escape_none(value)
+        @return The string.
+        @param value The value of a template variable.
+    """
+    return str(value)
+
+# Functions of the escape modes.
+ESCAPE_FUNCTIONS = { ESCAPE_HTML : escape_html,
+                     ESCAPE_URL : escape_url,
+                     ESCAPE_NONE : escape_none }
+
+def escape_functions(html_escape=1, escapes=None):
+    """ Return the list of escape functions indexed by the compiled
+        escape modes.
+
+        @header escape_functions(html_escape=1, escapes=None)
+        @return List of functions.
+
+        @param html_escape Whether the variables without the ESCAPE
+        parameter are HTML escaped.
+
+        @param escapes Mapping of values of the ESCAPE parameter
+        (<em>HTML</em>, <em>URL</em> or <em>NONE</em>) to functions which
+        replace the default escape functions.
+    """
+    functions = ESCAPE_FUNCTIONS.copy()
+    if escapes:
+        for name, function in escapes.items():
+            mode = ESCAPE_MODES.get(str(name).upper())
+            if mode is None:
+                raise TemplateException, "Invalid escape mode '%s'." % name
+            if not callable(function):
+                raise TemplateException, "Escape function of mode '%s' "\
+                                         "is not callable." % name
+            functions[mode] = function
+    if html_escape:
+        functions[ESCAPE_DEFAULT] = functions[ESCAPE_HTML]
+    else:
+        functions[ESCAPE_DEFAULT] = functions[ESCAPE_NONE]
+    return [ functions[mode] for mode in range(len(functions)) ]
@@ -13,6 +13,7 @@ import re
 import os
 import os.path
 import logging
+import gettext
 import cPickle      # for template compilation
 
 # template imports
@@ -33,6 +34,33 @@ PARAM_NAME = 1
 PARAM_ESCAPE = 2
 PARAM_GLOBAL = 3
 PARAM_GETTEXT_STRING = 1
+PARAM_TTL = 2
+
+# Elements whose whitespace is kept by minification, the start tag of any
+# of them or the start of a quoted attribute value, whose whitespace is
+# kept as well, and the end of each of them.
+PRESERVE_ELEMENTS = ("pre", "textarea", "script", "style")
+PRESERVE_START = re.compile(r"<(%s)\b|=\s*([\"'])"
+                            % "|".join(PRESERVE_ELEMENTS), re.IGNORECASE)
+PRESERVE_END = dict([ (element, re.compile(r"</%s\s*>" % element,
+                                           re.IGNORECASE))
+                      for element in PRESERVE_ELEMENTS ])
+PRESERVE_END['"'] = re.compile('"')
+PRESERVE_END["'"] = re.compile("'")
+
+# Characters of a locale, which is a part of the names of precompiled files.
+LOCALE = re.compile(r"^[A-Za-z0-9_.@-]+$")
+
+# Whitespace collapsed by minification.
+WHITESPACE = re.compile(r"\s{2,}|[\t\r\f\v]")
+
+# Opcodes of the block statements and of their closing statements.
+BLOCK_END = {
+    TMPLTemplate.OP_IF     : TMPLTemplate.OP_END_IF,
+    TMPLTemplate.OP_UNLESS : TMPLTemplate.OP_END_UNLESS,
+    TMPLTemplate.OP_LOOP   : TMPLTemplate.OP_END_LOOP,
+    TMPLTemplate.OP_CACHE  : TMPLTemplate.OP_END_CACHE,
+    }
 
 # Find a way to lock files. Currently implemented only for UNIX and windows.
 LOCKTYPE_FCNTL = 1
@@ -126,6 +154,7 @@ class TMPLTemplateManager(TemplateManager):
         self._max_include = 5
         self._comments = 1
         self._gettext = 0
+        self._minify = 0
         self._logger = logger
 
         # Find what module to use to lock files.
@@ -136,11 +165,13 @@ class TMPLTemplateManager(TemplateManager):
             raise TemplateException, "Template precompilation is not "\
                                      "available on this platform."
 
-    def init(self, include=1, max_include=5, comments=1, gettext=0, logger=None):
+    def init(self, include=1, max_include=5, comments=1, gettext=0, logger=None,
+             minify=0):
         """ Initialization.
         
             @header
-            init(include=1, max_include=5, comments=1, gettext=0, logger=None)
+            init(include=1, max_include=5, comments=1, gettext=0, logger=None,
+                 minify=0)
             
             @param include Enable or disable included templates.
             This optional parameter can be used to enable or disable
@@ -189,6 +220,14 @@ class TMPLTemplateManager(TemplateManager):
             
             @param gettext Enable or disable gettext support.
 
+            @param minify Enable or disable minification of whitespace.
+            When enabled, every run of whitespace in the static text of
+            the template is collapsed into one newline, if it contains
+            a newline, or into one space. The contents of the
+            <em>pre</em>, <em>textarea</em>, <em>script</em> and
+            <em>style</em> elements are left intact. Templates which were
+            precompiled with another setting are recompiled.
+
             @param debug Enable or disable debugging messages.
             This optional parameter is a flag that can be used to enable
             or disable debugging messages which are printed to the standard
@@ -200,11 +239,12 @@ class TMPLTemplateManager(TemplateManager):
         self._max_include = max_include
         self._comments = comments
         self._gettext = gettext
+        self._minify = minify
         self._logger = logger
 
         self.debug("TMPLTemplate Manager INIT DONE")
 
-    def prepare(self, file, content=None):
+    def prepare(self, file, content=None, locale=None):
         """ Preprocess, parse, tokenize and compile the template.
             
             If precompilation is enabled then this method tries to load
@@ -220,7 +260,7 @@ class TMPLTemplateManager(TemplateManager):
             If precompilation is disabled, then this method parses and
             compiles the template.
             
-            @header prepare(file)
+            @header prepare(file, content=None, locale=None)
             
             @return Compiled template.
             The methods returns an instance of the <em>Template</em> class
@@ -232,12 +272,28 @@ class TMPLTemplateManager(TemplateManager):
             if the parameter is a relative path. All included templates must
             be placed in subdirectory <strong>'inc'</strong> of the 
             directory in which the main template file is located.
+
+            @param content String containing the template data, used when
+            file is None.
+
+            @param locale Translate the gettext strings of the template
+            into this locale at compile time.
+            This optional parameter takes effect only when gettext support
+            is enabled. The strings are translated by the catalog of the
+            current text domain of the <em>gettext</em> module and merged
+            into the static text, so they cost nothing when the template
+            is processed. Every locale has its own compiled template, both
+            in the cache and on the disk, where the locale is appended to
+            the name of the template file, for example
+            <em>page.tmpl@de_DE.c</em>. Without this parameter the gettext
+            strings are translated every time the template is processed.
         """
         template = None
+        locale = self.variant(locale)
         if self._cache == 0:
             # no cache
             self.debug("No cache! call compiled ...")
-            return self.compiled(file, content)
+            return self.compiled(file, content, locale)
 
         # considering cache
         self.debug("Cache = %s" % (self._cache))
@@ -249,6 +305,8 @@ class TMPLTemplateManager(TemplateManager):
         else:
             import md5
             tid = md5.new(content).hexdigest()
+        if locale:
+            tid = "%s@%s" % (tid, locale)
 
         self.debug( "Create Template ID: '%s'" % (tid) )
 
@@ -257,7 +315,8 @@ class TMPLTemplateManager(TemplateManager):
             self.debug("%s PRECACHED" % (tid))
             cached_template = self._templates[tid]
             compile_params = (self._include, self._max_include,
-                              self._comments, self._gettext)
+                              self._comments, self._gettext, self._minify,
+                              locale)
             if cached_template.is_uptodate(compile_params):
                 self.debug("PRECACHED: UPTODATE")
                 template = cached_template
@@ -273,7 +332,7 @@ class TMPLTemplateManager(TemplateManager):
                 self.debug("UPDATE REFER COUNTER %s" % (self._ref_counts[tid]))
         else:
             self.debug("%s IS NOT CACHED" % (tid))
-            template = self.compiled(file, content)
+            template = self.compiled(file, content, locale)
             if self._cache == 1:
                 self._templates[tid] = template
             else:
@@ -314,7 +373,7 @@ class TMPLTemplateManager(TemplateManager):
         return template
             
 
-    def compiled(self, file, content=None):
+    def compiled(self, file, content=None, locale=None):
         """ Preprocess, parse, tokenize and compile the template.
             
             If precompilation is enabled then this method tries to load
@@ -344,21 +403,29 @@ class TMPLTemplateManager(TemplateManager):
             directory in which the main template file is located.
         """
         compiled = None
+        locale = self.variant(locale)
         if file:
             if self._precompile:
-                if self.is_precompiled(file):
+                if self.is_precompiled(file, locale):
                     try:
-                        precompiled = self.load_precompiled(file)
+                        precompiled = self.load_precompiled(file, locale)
                     except PrecompiledError, template:
                         self.debug( "Htmltmpl: bad precompiled "\
                                     "template '%s' removed" % template )
-                        compiled = self.compile(file)
+                        compiled = self.compile(file, locale)
                         self.save_precompiled(compiled)
                     else:
                         precompiled.setlogger(self._logger)
                         compile_params = (self._include, self._max_include,
-                                          self._comments, self._gettext)
-                        if precompiled.is_uptodate(compile_params):
+                                          self._comments, self._gettext,
+                                          self._minify, locale)
+                        if precompiled.file() != file or \
+                           precompiled.locale() != locale:
+                            # The file holds another template.
+                            self.debug("PRECOMPILED: OTHER TEMPLATE")
+                            compiled = self.compile(file, locale)
+                            self.save_precompiled(compiled)
+                        elif precompiled.is_uptodate(compile_params):
                             self.debug("PRECOMPILED: UPTODATE")
                             compiled = precompiled
                         else:
@@ -366,13 +433,13 @@ class TMPLTemplateManager(TemplateManager):
                             compiled = self.update(precompiled)
                 else:
                     self.debug("PRECOMPILED: NOT PRECOMPILED")
-                    compiled = self.compile(file)
+                    compiled = self.compile(file, locale)
                     self.save_precompiled(compiled)
             else:
                 self.debug("PRECOMPILATION DISABLED")
-                compiled = self.compile(file)
+                compiled = self.compile(file, locale)
         else:
-            compiled = self.compile_string(content)
+            compiled = self.compile_string(content, locale)
             
         return compiled
     
@@ -396,11 +463,12 @@ class TMPLTemplateManager(TemplateManager):
         """
         self.debug("UPDATE")
         if template.file():
-            updated = self.compile(template.file())
+            updated = self.compile(template.file(), template.locale())
             if self._precompile:
                 self.save_precompiled(updated)
         else:
-            updated = self.compile_string(template.content())
+            updated = self.compile_string(template.content(),
+                                          template.locale())
 
         return updated
 
@@ -438,35 +506,59 @@ class TMPLTemplateManager(TemplateManager):
         else:
             raise TemplateException, "BUG: bad locktype in lock_file"
 
-    def compile(self, file):
+    def compile(self, file, locale=None):
         """ Compile the template.
             @hidden
         """
         return TMPLTemplateCompiler(self._include, self._max_include,
                                     self._comments, self._gettext,
-                                    self._logger).compile(file)
+                                    self._logger, self._minify,
+                                    locale).compile(file)
     
-    def compile_string(self, data):
+    def compile_string(self, data, locale=None):
         """ Compile the template.
             @hidden
         """
         return TMPLTemplateCompiler(self._include, self._max_include,
                                     self._comments, self._gettext,
-                                    self._logger).compile_string(data)
+                                    self._logger, self._minify,
+                                    locale).compile_string(data)
+
+    def variant(self, locale):
+        """ Return the locale of the compiled templates which are prepared
+            for the locale, None if the gettext strings are not translated
+            by the compiler.
+            @hidden
+        """
+        if not (locale and self._gettext):
+            return None
+        if not LOCALE.match(locale):
+            raise TemplateException, "Invalid locale '%s'." % locale
+        return locale
+
+    def precompiled_file(self, file, locale=None):
+        """ Return the filename of the precompiled template. The locale
+            is appended after an '@', so the name of a variant cannot be
+            the name of the precompiled form of another template file.
+            @hidden
+        """
+        if not locale:
+            return file + "c"   # "template.tmplc"
+        return "%s@%s.c" % (file, locale)   # "template.tmpl@de.c"
     
-    def is_precompiled(self, file):
+    def is_precompiled(self, file, locale=None):
         """ Return true if the template is already precompiled on the disk.
             This method doesn't check whether the compiled template is
             uptodate.
             @hidden
         """
-        filename = file + "c"   # "template.tmplc"
+        filename = self.precompiled_file(file, locale)
         if os.path.isfile(filename):
             return 1
         else:
             return 0
         
-    def load_precompiled(self, file):
+    def load_precompiled(self, file, locale=None):
         """ Load precompiled template from disk.
 
             Remove the precompiled template file and recompile it
@@ -474,7 +566,7 @@ class TMPLTemplateManager(TemplateManager):
             
             @hidden
         """
-        filename = file + "c"   # "template.tmplc"
+        filename = self.precompiled_file(file, locale)
         self.debug("LOADING PRECOMPILED")
         try:
             remove_bad = 0
@@ -516,7 +608,7 @@ class TMPLTemplateManager(TemplateManager):
             
             @hidden
         """
-        filename = template.file() + "c"   # creates "template.tmplc"
+        filename = self.precompiled_file(template.file(), template.locale())
         # Check if we have write permission to the template's directory.
         template_dir = os.path.dirname(os.path.abspath(filename))
         if not os.access(template_dir, os.W_OK):
@@ -586,17 +678,19 @@ class TMPLTemplateCompiler:
     """
 
     def __init__(self, include=1, max_include=5, comments=1, gettext=0,
-                 logger=None):
+                 logger=None, minify=0, locale=None):
         """ Constructor.
 
         @header __init__(include=1, max_include=5, comments=1, gettext=0,
-                         logger=None)
+                         logger=None, minify=0, locale=None)
 
         @param include Enable or disable included templates.
         @param max_include Maximum depth of nested inclusions.
         @param comments Enable or disable template comments.
         @param gettext Enable or disable gettext support.
         @param logger Enable or disable debugging messages.
+        @param minify Enable or disable minification of whitespace.
+        @param locale Translate gettext strings into this locale.
         """
         
         self._include = include
@@ -604,11 +698,18 @@ class TMPLTemplateCompiler:
         self._comments = comments
         self._gettext = gettext
         self._logger = logger
+        self._minify = minify
+        self._locale = gettext and locale or None
         
         # This is a list of filenames of all included templates.
         # It's modified by the include_templates() method.
         self._include_files = []
 
+        # Mapping of the filenames of included templates to the names of
+        # the variables and loops they reference, including the templates
+        # they include. It's modified by the include_templates() method.
+        self._include_names = {}
+
         # This is a counter of current inclusion depth. It's used to prevent
         # infinite recursive includes.
         self._include_level = 0
@@ -629,11 +730,16 @@ class TMPLTemplateCompiler:
         self.debug("COMPILING FROM FILE: %s" % ( file ))
         self._include_path = os.path.join(os.path.dirname(file), INCLUDE_DIR)
         tokens = self.parse(self.read(file))
+        code = self.fold(TMPLTemplate.assemble(tokens), file)
+        if self._minify:
+            self.minify(code)
+        self.link_blocks(code)
         compile_params = (self._include, self._max_include, self._comments,
-                          self._gettext)
-        template = TMPLTemplate.TMPLTemplate(file)
+                          self._gettext, self._minify, self._locale)
+        template = TMPLTemplate.TMPLTemplate(file, None, None, self._locale)
         template.init(TMPLTemplate.__version__, self._include_files,
-                      tokens, compile_params, self._logger)
+                      code, compile_params, self._logger, 1,
+                      self.index_parts(code), self.schema(code))
         return template
 
     def compile_string(self, data):
@@ -653,10 +759,16 @@ class TMPLTemplateCompiler:
         self.debug("COMPILING FROM STRING")
         self._include = 0
         tokens = self.parse(data)
+        code = self.fold(TMPLTemplate.assemble(tokens), "<string>")
+        if self._minify:
+            self.minify(code)
+        self.link_blocks(code)
         compile_params = (self._include, self._max_include, self._comments,
-                          self._gettext)
-        template = TMPLTemplate.TMPLTemplate(None, data)
-        template.init(TMPLTemplate.__version__, [], tokens, compile_params, self._logger)
+                          self._gettext, self._minify, self._locale)
+        template = TMPLTemplate.TMPLTemplate(None, data, None, self._locale)
+        template.init(TMPLTemplate.__version__, [], code, compile_params,
+                      self._logger, 1, self.index_parts(code),
+                      self.schema(code))
         return template
 
     ##############################################
@@ -741,6 +853,8 @@ class TMPLTemplateCompiler:
                     self._include_files.append(include_file)
                     include_data = self.read(include_file)
                     include_tokens = self.parse(include_data)
+                    self._include_names[include_file] = self.names(
+                        TMPLTemplate.assemble(include_tokens))
 
                     # Append the tokens from the included template to actual
                     # position in the tokens list, replacing the TMPL_INCLUDE
@@ -755,6 +869,336 @@ class TMPLTemplateCompiler:
         if self._include_level > 0: self._include_level -= 1
         return out
     
+    def fold(self, code, name):
+        """ Simplify the compiled form of a template before its blocks
+            are linked. Adjacent static text, also the text of included
+            templates, is merged into one string. Blocks which produce no
+            output are removed and a TMPL_CACHE block which contains
+            static text only is replaced by the text. The gettext strings
+            are translated when the compiler has a locale. Return the new
+            compiled form.
+            @hidden
+        """
+        OPERANDS = TMPLTemplate.OPERANDS
+        translate = self.translator()
+        OP_ELSE = TMPLTemplate.OP_ELSE
+        OP_CACHE = TMPLTemplate.OP_CACHE
+        out = []
+        # Position of the text which ends the output, or None.
+        text = None
+        # Stack of open blocks: [opcode, position in out, text before it,
+        # position of its TMPL_ELSE, text before the TMPL_ELSE]
+        stack = []
+        i = 0
+        len_code = len(code)
+        while i < len_code:
+            op = code[i]
+            if op == TMPLTemplate.OP_GETTEXT and translate:
+                # Continue with the translation as static text.
+                i += 1
+                op = translate(code[i])
+            if type(op) is not int:
+                if text is None:
+                    text = len(out)
+                    out.append(op)
+                else:
+                    out[text] += op
+                i += 1
+                continue
+            length = 1 + OPERANDS.get(op, 0)
+            if BLOCK_END.has_key(op):
+                stack.append([op, len(out), text, None, None])
+            elif op == OP_ELSE and stack:
+                if stack[-1][3] is None:
+                    stack[-1][3] = len(out)
+                    stack[-1][4] = text
+                else:
+                    # Invalid blocks are left to link_blocks().
+                    stack[-1][3] = -1
+            elif stack and op == BLOCK_END[stack[-1][0]]:
+                start_op, start, before, else_pos, else_text = stack.pop()
+                if else_pos == len(out) - 2 and start_op != OP_CACHE:
+                    # Drop the empty ELSE block.
+                    del out[else_pos:]
+                    text = else_text
+                body = out[start + 1 + OPERANDS[start_op]:]
+                if not body and (out[start + 1] or start_op == OP_CACHE):
+                    # Nothing is produced in any case.
+                    del out[start:]
+                    text = before
+                    i += length
+                    continue
+                if start_op == OP_CACHE and len(body) == 1 and \
+                   type(body[0]) is not int:
+                    # Static text needs no caching.
+                    del out[start:]
+                    if before is None:
+                        text = len(out)
+                        out.append(body[0])
+                    else:
+                        out[before] += body[0]
+                        text = before
+                    i += length
+                    continue
+            out.extend(code[i:i + length])
+            text = None
+            i += length
+        self.debug("FOLD: %s: %d -> %d ITEMS" % (name, len_code, len(out)))
+        return out
+
+    def translator(self):
+        """ Return the function which translates the gettext strings
+            into the locale of the compiler, or None.
+            @hidden
+        """
+        if not self._locale:
+            return None
+        domain = gettext.textdomain()
+        catalogs = gettext.find(domain, gettext.bindtextdomain(domain),
+                                [self._locale], all=1)
+        # The catalogs are read here, gettext.translation() would return
+        # the catalogs it has already read even if they were updated.
+        # They are recorded with the included templates, so the template
+        # is recompiled when a catalog changes.
+        translation = None
+        for catalog in catalogs:
+            file = open(catalog, "rb")
+            try:
+                fallback = gettext.GNUTranslations(file)
+            finally:
+                file.close()
+            if translation is None:
+                translation = fallback
+            else:
+                translation.add_fallback(fallback)
+            self._include_files.append(catalog)
+        if translation is None:
+            translation = gettext.NullTranslations()
+        self.debug("TRANSLATING: %s: %s" % (domain, self._locale))
+        return translation.gettext
+
+    def minify(self, code):
+        """ Collapse the whitespace in the static text of the compiled
+            form, except in the elements of PRESERVE_ELEMENTS and in
+            quoted attribute values. The elements and the values are
+            tracked across the statements in between.
+            @hidden
+        """
+        OPERANDS = TMPLTemplate.OPERANDS
+        # The preserved element or the quote of the attribute value which
+        # is open, or None.
+        element = None
+        before = after = 0
+        i = 0
+        len_code = len(code)
+        while i < len_code:
+            op = code[i]
+            if type(op) is int:
+                i += 1 + OPERANDS.get(op, 0)
+                continue
+            before += len(op)
+            pieces = []
+            pos = 0
+            while pos < len(op):
+                if element:
+                    match = PRESERVE_END[element].search(op, pos)
+                    if not match:
+                        pieces.append(op[pos:])
+                        break
+                    pieces.append(op[pos:match.end()])
+                    element = None
+                else:
+                    match = PRESERVE_START.search(op, pos)
+                    if not match:
+                        pieces.append(WHITESPACE.sub(self.collapse, op[pos:]))
+                        break
+                    pieces.append(WHITESPACE.sub(self.collapse,
+                                                 op[pos:match.start()]))
+                    pieces.append(match.group())
+                    element = (match.group(1) or match.group(2)).lower()
+                pos = match.end()
+            code[i] = "".join(pieces)
+            after += len(code[i])
+            i += 1
+        self.debug("MINIFY: %d -> %d CHARACTERS" % (before, after))
+
+    def collapse(self, match):
+        """ Return the replacement of a run of whitespace.
+            @hidden
+        """
+        if "\n" in match.group():
+            return "\n"
+        return " "
+
+    def link_blocks(self, code):
+        """ Validate the compiled form of a template and set the jumps
+            of its block statements. Raise an exception if a statement is
+            unknown or has no identifier or if the blocks are not properly
+            nested.
+
+            The jump of every TMPL_IF, TMPL_UNLESS and TMPL_LOOP is set to
+            the position of its TMPL_ELSE or, if it has none, of its closing
+            statement. The jump of every TMPL_ELSE is set to the position of
+            the closing statement. The jump of every TMPL_CACHE is set to
+            the position of its closing statement, a TMPL_CACHE can contain
+            neither a TMPL_ELSE of its own nor a TMPL_BOUNDARY.
+            @hidden
+        """
+        OPERANDS = TMPLTemplate.OPERANDS
+        STATEMENTS = TMPLTemplate.STATEMENTS
+        # Stack of open blocks: [closing opcode, position, ELSE position]
+        stack = []
+        i = 0
+        len_code = len(code)
+        while i < len_code:
+            op = code[i]
+            if type(op) is not int:
+                i += 1
+                continue
+            if op == TMPLTemplate.OP_INVALID:
+                raise TemplateException, "Invalid statement %s>." % code[i + 1]
+            if op == TMPLTemplate.OP_VAR or (BLOCK_END.has_key(op) and
+                                             op != TMPLTemplate.OP_CACHE):
+                if not code[i + 1]:
+                    raise TemplateException, "No identifier in %s>."\
+                                             % STATEMENTS[op]
+            if BLOCK_END.has_key(op):
+                stack.append([BLOCK_END[op], i, None])
+            elif op == TMPLTemplate.OP_ELSE:
+                if not stack:
+                    raise TemplateException, "Unmatched <TMPL_ELSE>."
+                if stack[-1][2] != None:
+                    raise TemplateException, "Duplicate <TMPL_ELSE>."
+                if stack[-1][0] == TMPLTemplate.OP_END_CACHE:
+                    raise TemplateException, "<TMPL_ELSE> in <TMPL_CACHE>."
+                start = stack[-1][1]
+                stack[-1][2] = i
+                code[start + OPERANDS[code[start]]] = i
+            elif op in BLOCK_END.values():
+                if not stack or stack[-1][0] != op:
+                    raise TemplateException, "Unmatched %s>." % STATEMENTS[op]
+                closing, start, else_pos = stack.pop()
+                if else_pos == None:
+                    code[start + OPERANDS[code[start]]] = i
+                else:
+                    code[else_pos + 1] = i
+            elif op == TMPLTemplate.OP_BOUNDARY:
+                for block in stack:
+                    if block[0] == TMPLTemplate.OP_END_CACHE:
+                        raise TemplateException, \
+                              "<TMPL_BOUNDARY> in <TMPL_CACHE>."
+            i += 1 + OPERANDS[op]
+        if stack:
+            raise TemplateException, "Missing %s>." % STATEMENTS[stack[-1][0]]
+
+    def index_parts(self, code):
+        """ Return the list of the positions at which the parts of
+            a linked template start, the first part at position zero and
+            every other one after a TMPL_BOUNDARY. Return an empty list if
+            a TMPL_BOUNDARY is inside of a block, because the number of
+            the parts before it depends on the data then.
+            @hidden
+        """
+        OPERANDS = TMPLTemplate.OPERANDS
+        parts = [0]
+        depth = 0
+        i = 0
+        len_code = len(code)
+        while i < len_code:
+            op = code[i]
+            if type(op) is not int:
+                i += 1
+                continue
+            if BLOCK_END.has_key(op):
+                depth += 1
+            elif op in BLOCK_END.values():
+                depth -= 1
+            elif op == TMPLTemplate.OP_BOUNDARY:
+                if depth:
+                    self.debug("PARTS: BOUNDARY IN BLOCK")
+                    return []
+                parts.append(i + 1)
+            i += 1 + OPERANDS[op]
+        self.debug("PARTS: %d" % len(parts))
+        return parts
+
+    def schema(self, code):
+        """ Return the schema of the data referenced by a compiled
+            template, see TMPLTemplate.schema().
+            @hidden
+        """
+        OPERANDS = TMPLTemplate.OPERANDS
+        OP_VAR = TMPLTemplate.OP_VAR
+        def new_scope():
+            return { "vars" : set(), "loops" : {}, "globals" : set(),
+                     "magic" : set() }
+        def finish(scope):
+            for key in ("vars", "globals", "magic"):
+                scope[key] = sorted(scope[key])
+            for loop in scope["loops"].values():
+                finish(loop)
+            return scope
+        top = new_scope()
+        stack = [top]
+        i = 0
+        len_code = len(code)
+        while i < len_code:
+            op = code[i]
+            if type(op) is not int:
+                i += 1
+                continue
+            scope = stack[-1]
+            if op == OP_VAR or op == TMPLTemplate.OP_IF or \
+               op == TMPLTemplate.OP_UNLESS:
+                var = code[i + 1]
+                if op == OP_VAR:
+                    override = code[i + 3]
+                else:
+                    override = code[i + 2]
+                if var[:2] == "__" and scope is not top:
+                    scope["magic"].add(var)
+                else:
+                    scope["vars"].add(var)
+                    if override == 1 and scope is not top:
+                        scope["globals"].add(var)
+            elif op == TMPLTemplate.OP_LOOP:
+                var = code[i + 1]
+                if not scope["loops"].has_key(var):
+                    scope["loops"][var] = new_scope()
+                stack.append(scope["loops"][var])
+            elif op == TMPLTemplate.OP_END_LOOP:
+                stack.pop()
+            elif op == TMPLTemplate.OP_CACHE:
+                scope["vars"].update(code[i + 1])
+            i += 1 + OPERANDS[op]
+        schema = finish(top)
+        schema["includes"] = self._include_names.copy()
+        self.debug("SCHEMA: %d VARS, %d LOOPS" % (len(schema["vars"]),
+                                                 len(schema["loops"])))
+        return schema
+
+    def names(self, code):
+        """ Return the sorted list of the names of all variables and loops
+            referenced by a compiled template.
+            @hidden
+        """
+        OPERANDS = TMPLTemplate.OPERANDS
+        names = set()
+        i = 0
+        len_code = len(code)
+        while i < len_code:
+            op = code[i]
+            if type(op) is not int:
+                i += 1
+                continue
+            if op == TMPLTemplate.OP_VAR or op == TMPLTemplate.OP_IF or \
+               op == TMPLTemplate.OP_UNLESS or op == TMPLTemplate.OP_LOOP:
+                names.add(code[i + 1])
+            elif op == TMPLTemplate.OP_CACHE:
+                names.update(code[i + 1])
+            i += 1 + OPERANDS[op]
+        return sorted(names)
+
     def tokenize(self, template_data):
         """ Split the template into tokens separated by template statements.
             The statements itself and associated parameters are also
@@ -788,10 +1232,19 @@ class TMPLTemplateCompiler:
                 statement = statement.strip()
                 params = re.split(r"\s+", statement)
                 self.debug("PARAMS: %s"%(params))
-                tokens.append(self.find_directive(params))
+                directive = self.find_directive(params)
+                tokens.append(directive)
                 tokens.append(self.find_name(params))
-                tokens.append(self.find_param("ESCAPE", params))
-                tokens.append(self.find_param("GLOBAL", params))
+                if directive == "<TMPL_CACHE":
+                    # The key variables are the identifier, the TTL is
+                    # the parameter at position PARAM_TTL.
+                    cache_params = [None] * (PARAMS_NUMBER - PARAM_NAME)
+                    cache_params[PARAM_TTL - PARAM_NAME - 1] = \
+                        self.find_param("TTL", params)
+                    tokens.extend(cache_params)
+                else:
+                    tokens.append(self.find_param("ESCAPE", params))
+                    tokens.append(self.find_param("GLOBAL", params))
             else:
                 # "Normal" template data.
                 if self._gettext:
@@ -10,24 +10,483 @@ __version__='$Revision: 3193 $'[11:-2]
 # All imported modules are part of the standard Python library.
 
 from types import *
-import cgi          # for HTML escaping of variables
-import urllib       # for URL escaping of variables
+import sys
 import gettext
 import logging
+import threading
+import cPickle
+import itertools
+import collections
+import multiprocessing
 
 # template imports
 from TemplateProcessor import TemplateProcessor
 from TemplateException import TemplateException
+from TMPLTemplate import OP_VAR, OP_IF, OP_UNLESS, OP_LOOP, OP_ELSE, \
+     OP_END_IF, OP_END_UNLESS, OP_END_LOOP, OP_BOUNDARY, OP_INCLUDE, \
+     OP_GETTEXT, OP_CACHE, OP_END_CACHE, OPERANDS, ESCAPE_DEFAULT, \
+     ESCAPE_MODES
+from TMPLTemplateEscape import escape_functions
+
+# Warning emitted in place of a TMPL_INCLUDE which was not replaced by
+# the parser.
+INCLUDE_WARNING = """
+                        <br />
+                        <p>
+                        <strong>HTMLTMPL WARNING:</strong><br />
+                        Cannot include template: <strong>%s</strong>
+                        </p>
+                        <br />
+                    """
+
+# Total number of passes of a loop over an iterator, until the last pass
+# is reached.
+UNSIZED = sys.maxint
+
+# Types of the values which are their own fingerprint, see
+# TMPLTemplateSession.fingerprint().
+SCALAR_TYPES = (StringType, UnicodeType, IntType, LongType, FloatType,
+                BooleanType, NoneType)
+
+# Handling of the data which a processed template doesn't reference, see
+# TMPLTemplateProcessor.init().
+UNUSED_MODES = (None, "warn", "ignore")
+
+# Maximal number of shapes of mappings validated by setdict() which are
+# remembered by a processor.
+SHAPES_SIZE = 256
+
+# Scope of the variables inside of a loop which has no passes. Variables
+# referenced in the ELSE block of an empty loop are not found.
+EMPTY_SCOPE = {}
+
+# Value of a name which is not found in a scope.
+MISSING = object()
+
+# Accessors of names in scopes which are not dicts, keyed by the class
+# of the scope and the name, see lookup().
+ACCESSORS = {}
+
+# Maximal number of accessors remembered. The classes of rows may be
+# created for every query.
+ACCESSORS_SIZE = 1024
+
+def lookup(scope, var):
+    """ Return the value of name var in a scope which is not a dict, or
+        MISSING. Mappings are accessed by key, other objects by attribute.
+        Names starting with an underscore are never found by attribute.
+
+        How a name is resolved depends on the class of the scope only, so
+        it's found out once per class and name, and the loop rows of one
+        class skip the introspection.
+        @hidden
+    """
+    cls = scope.__class__
+    accessor = ACCESSORS.get((cls, var))
+    if accessor is None:
+        if cls is ColumnScope:
+            # Index the column without the calls of the mapping methods.
+            def accessor(scope, var=var):
+                column = scope._columns.get(var)
+                if column is None:
+                    return MISSING
+                return column[scope._index]
+        elif cls is RecordScope:
+            def accessor(scope, var=var):
+                index = scope._fields.get(var)
+                if index is None:
+                    return MISSING
+                return scope._record[index]
+        elif hasattr(cls, "keys") and hasattr(cls, "__contains__"):
+            # The membership is tested first, item access adds the key to
+            # mappings with __missing__, like collections.defaultdict.
+            def accessor(scope, var=var):
+                if var in scope:
+                    return scope[var]
+                return MISSING
+        elif hasattr(cls, "keys") and hasattr(cls, "__getitem__"):
+            # Rows backed by a sequence, like sqlite3.Row, test their
+            # values with the operator in.
+            def accessor(scope, var=var):
+                if var in scope.keys():
+                    return scope[var]
+                return MISSING
+        elif var[:1] == "_":
+            accessor = lambda scope: MISSING
+        else:
+            accessor = lambda scope, var=var: getattr(scope, var, MISSING)
+        if len(ACCESSORS) >= ACCESSORS_SIZE:
+            ACCESSORS.clear()
+        ACCESSORS[(cls, var)] = accessor
+    return accessor(scope)
+
+##############################################
+#              CLASS: Deferred
+##############################################
+
+class Deferred:
+    """ A value of a template variable or loop computed on demand.
+
+        The function is called when the processing first reaches
+        a statement which needs the value, with the given arguments.
+        Values which are only referenced in disabled blocks are never
+        computed. The result is remembered, so the function is called
+        at most once, also when the value is shared by contexts used by
+        concurrent threads.
+    """
+
+    def __init__(self, function, *args, **kwargs):
+        """ Constructor.
+
+            @header Deferred(function, *args, **kwargs)
+            @param function A callable which returns a scalar, or a list
+            of mappings for a loop.
+        """
+        self._function = function
+        self._args = args
+        self._kwargs = kwargs
+        self._resolved = 0
+        self._value = None
+        self._lock = threading.Lock()
+
+    def resolve(self):
+        """ Return the value, compute it on the first call.
+
+            @header resolve()
+            @return The value.
+        """
+        if not self._resolved:
+            self._lock.acquire()
+            try:
+                # Another thread may have computed the value meanwhile.
+                if not self._resolved:
+                    self._value = self._function(*self._args,
+                                                 **self._kwargs)
+                    self._resolved = 1
+                    # Release the references held by the arguments.
+                    self._function = self._args = self._kwargs = None
+            finally:
+                self._lock.release()
+        return self._value
+
+    def __getstate__(self):
+        """ Used by pickle when the value is sent to a worker process.
+            Remove the lock.
+            @hidden
+        """
+        dict = self.__dict__.copy()
+        del dict["_lock"]
+        return dict
+
+    def __setstate__(self, dict):
+        """ Used by pickle when the value is received by a worker process.
+            Add a new lock.
+            @hidden
+        """
+        self.__dict__ = dict
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        if self._resolved:
+            return "<Deferred %r>" % (self._value,)
+        return "<Deferred %r>" % (self._function,)
+
+
+##############################################
+#            CLASS: LoopIterator
+##############################################
+
+class LoopIterator:
+    """ The mappings of a loop given by an iterable. The mappings are
+        read in order of the passes, one mapping ahead, so the last pass
+        is recognized when it's entered. The length is UNSIZED until
+        then.
+        @hidden
+    """
+
+    def __init__(self, iterable):
+        """ Constructor.
+            @hidden
+        """
+        self._iterator = iter(iterable)
+        self._pass = -1
+        self._row = None
+        self._total = UNSIZED
+        self._next = None
+        self.fetch()
+
+    def __len__(self):
+        return self._total
+
+    def __getitem__(self, i):
+        """ Return the mapping of pass i, which must be the current or
+            the next pass.
+            @hidden
+        """
+        if i != self._pass:
+            if i != self._pass + 1 or i >= self._total:
+                raise TemplateException, "Loop over an iterator must be "\
+                                         "processed in order."
+            self._row = self._next
+            self._pass = i
+            self.fetch()
+        return self._row
+
+    def fetch(self):
+        """ Read the mapping of the pass after the current one.
+            @hidden
+        """
+        try:
+            self._next = self._iterator.next()
+        except StopIteration:
+            self._next = None
+            self._total = self._pass + 1
+
+
+##############################################
+#              CLASS: Columns
+##############################################
+
+class Columns:
+    """ The passes of a loop given by columns instead of rows.
+
+        The data of the loop is a mapping of the names of the variables
+        in the loop to sequences of their values, the value of pass i at
+        index i of every sequence. The scope of a pass looks up its
+        variables in the columns, no mapping is built for it.
+
+        Columns which have the method tolist(), like the arrays of the
+        array module or of NumPy, are converted to lists of Python
+        scalars in one pass when the instance is created. A NumPy
+        structured or record array can be passed instead of the mapping,
+        its fields are the columns. Such an array can also be set as
+        a loop directly, the processor wraps it in this class.
+    """
+
+    def __init__(self, columns):
+        """ Constructor.
+
+            @header Columns(columns)
+            @param columns A mapping of variable names to sequences of
+            equal length, or a NumPy structured array.
+        """
+        if is_record_array(columns):
+            columns = dict([ (name, columns[name])
+                             for name in columns.dtype.names ])
+        self._columns = {}
+        self._total = None
+        for name, column in columns.items():
+            if hasattr(column, "tolist"):
+                column = column.tolist()
+            if self._total is None:
+                self._total = len(column)
+            elif len(column) != self._total:
+                raise TemplateException, "Columns of a loop differ in "\
+                                         "length: '%s'." % name
+            self._columns[name] = column
+        if self._total is None:
+            self._total = 0
+
+    def __len__(self):
+        return self._total
+
+    def __getitem__(self, i):
+        """ Return the scope of pass i.
+            @hidden
+        """
+        if i < 0:
+            i += self._total
+        if not 0 <= i < self._total:
+            raise IndexError, i
+        return ColumnScope(self._columns, i)
+
+    def __getslice__(self, i, j):
+        """ Return the passes i to j - 1 as columns.
+            @hidden
+        """
+        return Columns(dict([ (name, column[i:j])
+                              for name, column in self._columns.items() ]))
+
+    def __repr__(self):
+        return "<Columns %s x %d>" % (self._columns.keys(), self._total)
+
+
+class ColumnScope(object):
+    """ The scope of one pass of a loop given by columns. A read-only
+        mapping of the variable names to the values at its index. It's
+        a new-style class, so the slots leave out the __dict__ of every
+        pass.
+        @hidden
+    """
+
+    __slots__ = ("_columns", "_index")
+
+    def __init__(self, columns, index):
+        """ Constructor.
+            @hidden
+        """
+        self._columns = columns
+        self._index = index
+
+    def __contains__(self, var):
+        return var in self._columns
+
+    def __getitem__(self, var):
+        return self._columns[var][self._index]
+
+    def keys(self):
+        return self._columns.keys()
+
+
+##############################################
+#             CLASS: CursorRows
+##############################################
+
+class CursorRows:
+    """ The passes of a loop given by the result set of a DB-API cursor.
+
+        The variables in the loop are the columns of the result set, as
+        named by <em>cursor.description</em>. The records are fetched in
+        batches by <em>cursor.fetchmany()</em> while the loop is
+        processed, so the memory used doesn't depend on the number of
+        records, and no mapping is built for a record. Like any loop over
+        an iterator, it must be referenced by one TMPL_LOOP only.
+    """
+
+    def __init__(self, cursor, batch_size=100):
+        """ Constructor.
+
+            @header CursorRows(cursor, batch_size=100)
+            @param cursor A DB-API cursor on which a query was executed.
+            @param batch_size Number of records fetched at once.
+        """
+        self._cursor = cursor
+        self._batch_size = batch_size
+
+    def __iter__(self):
+        """ Yield the scopes of the records.
+            @hidden
+        """
+        cursor = self._cursor
+        if cursor.description is None:
+            raise TemplateException, "Cursor of a loop has no result set."
+        fields = dict([ (column[0], i)
+                        for i, column in enumerate(cursor.description) ])
+        while 1:
+            records = cursor.fetchmany(self._batch_size)
+            if not records:
+                break
+            for record in records:
+                yield RecordScope(fields, record)
+
+
+class RecordScope(object):
+    """ The scope of one pass of a loop given by a cursor. A read-only
+        mapping of the column names to the values of a record. It's
+        a new-style class like ColumnScope.
+        @hidden
+    """
+
+    __slots__ = ("_fields", "_record")
+
+    def __init__(self, fields, record):
+        """ Constructor.
+            @hidden
+        """
+        self._fields = fields
+        self._record = record
+
+    def __contains__(self, var):
+        return var in self._fields
+
+    def __getitem__(self, var):
+        return self._record[self._fields[var]]
+
+    def keys(self):
+        return self._fields.keys()
+
+
+def is_record_array(value):
+    """ Return true if value is a NumPy structured or record array.
+        @hidden
+    """
+    dtype = getattr(value, "dtype", None)
+    return getattr(dtype, "names", None) is not None and \
+           hasattr(value, "__len__")
+
+
+##############################################
+#          CLASS: PassWindow
+##############################################
+
+class PassWindow:
+    """ The passes of a loop sent to a worker process, a slice of its
+        mappings which starts at pass first. The passes are found at
+        their index in the whole loop and the length is the total number
+        of passes, so the magic variables are not changed.
+        @hidden
+    """
+
+    def __init__(self, rows, first, total):
+        """ Constructor.
+            @hidden
+        """
+        self._rows = rows
+        self._first = first
+        self._total = total
+
+    def __len__(self):
+        return self._total
+
+    def __getitem__(self, i):
+        return self._rows[i - self._first]
 
-# Total number of possible parameters.
-# Increment if adding a parameter to any statement.
-PARAMS_NUMBER = 3
 
-# Relative positions of parameters in TemplateCompiler.tokenize().
-PARAM_NAME = 1
-PARAM_ESCAPE = 2
-PARAM_GLOBAL = 3
-PARAM_GETTEXT_STRING = 1
+##############################################
+#          CLASS: WorkerPool
+##############################################
+
+class WorkerPool:
+    """ The worker processes of a processor and of its contexts, a pool
+        for every number of workers. A pool is started when it's first
+        needed and kept until close() is called.
+        @hidden
+    """
+
+    def __init__(self):
+        """ Constructor.
+            @hidden
+        """
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def get(self, workers):
+        """ Return the pool of the given number of worker processes.
+            @hidden
+        """
+        self._lock.acquire()
+        try:
+            pool = self._pools.get(workers)
+            if pool is None:
+                pool = multiprocessing.Pool(workers)
+                self._pools[workers] = pool
+            return pool
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """ Stop all worker processes.
+            @hidden
+        """
+        self._lock.acquire()
+        try:
+            pools = self._pools.values()
+            self._pools.clear()
+        finally:
+            self._lock.release()
+        for pool in pools:
+            pool.terminate()
+            pool.join()
 
 
 ##############################################
@@ -48,19 +507,42 @@ class TMPLTemplateProcessor( TemplateProcessor ):
         self._html_escape = 1
         self._magic_vars = 1
         self._global_vars = 0
+        self._codegen = 0
+        self._loop_workers = 1
+        self._loop_min_rows = 10000
+        self._profiler = None
+        self._cache = None
+        self._unused = None
         self._logger = logger
 
+        # Escape functions indexed by the compiled escape modes.
+        self._escapes = escape_functions()
+
+        # The settings which change the output of a TMPL_CACHE block,
+        # the first item of its key in the fragment cache.
+        self._cache_scope = self.cache_scope()
+
         # Data structure containing variables and loops set by the
         # application. Use debug=1, process some template and
         # then check stderr to see how the structure looks.
         # It's modified only by set() and reset() methods.
         self._vars = {}
 
+        # Mapping of the shapes of the mappings passed to setdict() to
+        # the names they skip and the names whose values are converted.
+        self._shapes = {}
+
+        # Worker processes of process_many() and process_parallel(),
+        # shared by the contexts of this processor.
+        self._pool = WorkerPool()
+
         # Following variables are for multipart templates.
         self._current_part = 1
         self._current_pos = 0
 
-    def init(self, html_escape=1, magic_vars=1, global_vars=0, keep_data=0, logger=None):
+    def init(self, html_escape=1, magic_vars=1, global_vars=0, keep_data=0,
+             logger=None, codegen=0, escapes=None, loop_workers=1,
+             loop_min_rows=10000, profiler=None, cache=None, unused=None):
         """ Initialization.
 
             NOTE: html_escape should be parsed from html template TMPL_VAR as
@@ -96,11 +578,74 @@ class TMPLTemplateProcessor( TemplateProcessor ):
             statement.
 
             @param logger A logger object for logging debugging messages.
+
+            @param codegen Enable or disable the code generating backend.
+            When enabled, a template processed as a whole is translated
+            once into a Python function which is cached on the template
+            and called on every later run. The output is identical to the
+            output of the interpreter. Templates that cannot be translated
+            and processing of single parts are still interpreted.
+
+            @param escapes Replace the built-in escape functions.
+            This optional parameter is a mapping of values of the
+            <strong>ESCAPE</strong> parameter (HTML, URL or NONE) to
+            functions. A function gets the value of a variable and returns
+            the escaped string. The HTML function also escapes variables
+            without the ESCAPE parameter when html_escape is enabled.
+            Values of the type <em>TMPLTemplateEscape.SafeString</em> are
+            never escaped by the built-in functions.
+
+            @param loop_workers Number of worker processes which render
+            large top-level loops. When greater than one, a template
+            processed as a whole renders the passes of every top-level
+            loop with at least loop_min_rows passes in ranges of passes,
+            in parallel. The output is identical to serial processing.
+            Loops which contain a <strong>TMPL_BOUNDARY</strong> are
+            always processed serially. The escape functions, the passes
+            of the loops and the variables referenced inside of them must
+            be picklable. The worker processes are kept until
+            <em>close()</em> is called.
+
+            @param loop_min_rows Minimal number of passes of a loop which
+            is rendered in parallel.
+
+            @param profiler An instance of <em>TMPLTemplateProfiler</em>.
+            When given, the templates processed as a whole by
+            <em>process()</em> are profiled. Templates which cannot be
+            translated by the code generating backend and other kinds of
+            processing are not profiled.
+
+            @param cache An instance of <em>TMPLTemplateCache</em> which
+            stores the output of the <strong>TMPL_CACHE</strong> blocks.
+            Without a cache the blocks are processed as usual. Processors
+            with other escape functions, magic_vars or global_vars
+            settings can share a cache, they don't get each other's
+            fragments.
+
+            @param unused What to do with the top-level variables and loops
+            which a processed template doesn't reference according to its
+            schema, see <em>TMPLTemplate.schema()</em>. With
+            <em>"warn"</em> their names are written to the logger as
+            a warning when a template is processed from its beginning.
+            With <em>"ignore"</em> they are left out of the data which is
+            copied: the data given to <em>render()</em> and
+            <em>process_many()</em>, the data sent to worker processes and
+            the data compared by sessions. The default None keeps them.
         """
+        if unused not in UNUSED_MODES:
+            raise TemplateException, "Invalid unused mode '%s'." % unused
         self._html_escape  = html_escape
         self._magic_vars   = magic_vars
         self._global_vars  = global_vars
+        self._codegen      = codegen
+        self._loop_workers = loop_workers
+        self._loop_min_rows = loop_min_rows
+        self._profiler     = profiler
+        self._cache        = cache
+        self._unused       = unused
         self._logger       = logger
+        self._escapes      = escape_functions(html_escape, escapes)
+        self._cache_scope  = self.cache_scope()
 
         # reset data
         self.reset(keep_data=keep_data)
@@ -124,6 +669,27 @@ class TMPLTemplateProcessor( TemplateProcessor ):
             is equal to number of times the loop block is repeated in the
             output.
       
+            A loop can also be given by an iterator over mappings, for
+            example a generator. It's consumed while the loop is
+            processed, one mapping ahead, so it must be referenced by one
+            TMPL_LOOP only. A TMPL_IF always finds such loop enabled and
+            the magic variable __PASSTOTAL__ is only known in its last
+            pass.
+
+            To compute a value only when the template needs it, pass
+            an instance of <em>Deferred</em>. Values in loops can be
+            deferred as well.
+
+            To give a loop by columns, pass an instance of <em>Columns</em>
+            or a NumPy structured array. To stream the result set of
+            a database query, pass an instance of <em>CursorRows</em>.
+
+            The mappings of a loop can also be other objects, for example
+            the records of an ORM. Their variables and nested loops are
+            then looked up by key if the objects have the methods keys()
+            and __getitem__(), otherwise by attribute. Attributes whose
+            names start with an underscore are not found.
+      
             @header set(var, value)
             @return No return value.
 
@@ -131,24 +697,14 @@ class TMPLTemplateProcessor( TemplateProcessor ):
             @param value The value to associate.
             
         """
-        # The correctness of character case is verified only for top-level
-        # variables.
-        if self.is_ordinary_var(value):
-            # template top-level ordinary variable
-            if not var.islower():
-                raise TemplateException, "Invalid variable name '%s'." % var
-        elif type(value) in [ListType, TupleType] or \
-             (hasattr(value, '__class__') and issubclass(value.__class__, list)):
-            # template top-level loop
-            if var != var.capitalize():
-                raise TemplateException, "Invalid loop name '%s' (%s)." % (var, value)
-        else:
-            #raise TemplateException, "Value of toplevel variable '%s' must "\
-            #                     "be either a scalar or a list." % var
-            self.debug("Value of toplevel variable '%s' is not a "\
-                       "scalar or a list. Assuming boolean ..." % var)
-            value = value and True or False
-            
+        if not self.check(var, value):
+            if is_record_array(value):
+                value = Columns(value)
+            else:
+                self.debug("Value of toplevel variable '%s' is not a "\
+                           "scalar or a list. Assuming boolean ..." % var)
+                value = value and True or False
+
         self._vars[var] = value
         self.debug("VALUE SET: " + str(var))
 
@@ -182,13 +738,87 @@ class TMPLTemplateProcessor( TemplateProcessor ):
         """
         return self._vars.keys()
 
-    def setdict(self, dict):
-        if type(dict) != type({}):
-            return
+    def setdict(self, dict, strict=1):
+        """ Associate the values of a mapping with top-level template
+            variables and loops, as <em>set()</em> does for every key.
+
+            The names are validated against the values once for every
+            shape of the mapping, that is the set of its keys and of the
+            classes of their values. Mappings of a known shape are bound
+            at once, without checking every key again.
+
+            @header setdict(dict, strict=1)
+            @return No return value.
+
+            @param dict Mapping of names to values. Mappings which are not
+            dicts, like <em>collections.OrderedDict</em>, are copied to
+            a dict first. Anything else, like None, is ignored.
 
-        for key in dict.keys():
-            self.set(key, dict[key])
+            @param strict Raise an exception if a name is invalid. If this
+            flag is false, the keys with invalid names are skipped.
+        """
+        if type(dict) is not DictType:
+            if not (hasattr(dict, "keys") and hasattr(dict, "__getitem__")):
+                return
+            dict = DictType(dict)
+
+        key = (strict, frozenset([ (var, value.__class__)
+                                   for var, value in dict.iteritems() ]))
+        plan = self._shapes.get(key)
+        if plan is None:
+            plan = self.plan(dict, strict)
+            if len(self._shapes) >= SHAPES_SIZE:
+                self._shapes.clear()
+            self._shapes[key] = plan
+        skipped, converted = plan
+        if skipped:
+            dict = dict.copy()
+            for var in skipped:
+                del dict[var]
+        self._vars.update(dict)
+        for var in converted:
+            self.set(var, dict[var])
+        self.debug("VALUES SET: %d" % len(dict))
         
+    def context(self):
+        """ Return a new render context of this processor.
+
+            A context is a processor which shares the settings of this
+            processor and starts with a copy of its variables and loops,
+            but has data and a current part of its own. Configure and fill
+            the shared processor once, then create a context for every
+            render: the contexts can be used by concurrent threads without
+            any locking, also with the same compiled template. The shared
+            processor must not be changed while its contexts are used.
+
+            A profiler, a fragment cache and deferred values are shared by
+            the contexts as well. The fragment cache is thread-safe, the
+            counters of a profiler may be inexact.
+
+            @header context()
+            @return Instance of <em>TMPLTemplateContext</em>.
+        """
+        return TMPLTemplateContext(self)
+
+    def render(self, template, data=None):
+        """ Process a compiled template as a whole in a new render
+            context. This processor is not changed, so the method can be
+            called by concurrent threads.
+
+            @header render(template, data=None)
+            @return Result of the processing as string.
+
+            @param template A compiled template.
+            See the <em>process()</em> method.
+
+            @param data A mapping of variables and loops which are set in
+            the context as by <em>setdict()</em>.
+        """
+        context = TMPLTemplateContext(self)
+        if data:
+            context.setdict(self.used(template, data))
+        return context.process(template)
+
     def reset(self, keep_data=0):
         """ Reset the template data.
 
@@ -239,306 +869,903 @@ class TMPLTemplateProcessor( TemplateProcessor ):
         """
         self.debug("APP INPUT:")
         self.debug( "%s" % (self._vars) )
+        self.check_data(template)
         if part != None and (part == 0 or part < self._current_part):
             raise TemplateException, "process() - invalid part number"
 
-        # This flag means "jump behind the end of current statement" or
-        # "skip the parameters of current statement".
-        # Even parameters that actually are not present in the template
-        # do appear in the list of tokens as empty items !
-        skip_params = 0 
-
-        # Stack for enabling or disabling output in response to TMPL_IF,
-        # TMPL_UNLESS, TMPL_ELSE and TMPL_LOOPs with no passes.
-        output_control = []
-        ENABLE_OUTPUT = 1
-        DISABLE_OUTPUT = 0
-        
-        # Stacks for data related to loops.
-        loop_name = []        # name of a loop
-        loop_pass = []        # current pass of a loop (counted from zero)
-        loop_start = []       # index of loop start in token list
-        loop_total = []       # total number of passes in a loop
-        
-        tokens = template.tokens()
-        len_tokens = len(tokens)
-        out = ""              # buffer for processed output
+        if self._profiler and part == None and self._current_pos == 0:
+            render = template.renderer(1)
+            if render:
+                self.debug("PROCESS: PROFILE")
+                return render(self)
 
-        # Recover position at which we ended after processing of last part.
-        i = self._current_pos
-            
-        # Process the list of tokens.
-        while 1:
-            if i == len_tokens: break            
-            if skip_params:   
-                # Skip the parameters following a statement.
-                skip_params = 0
-                i += PARAMS_NUMBER
-                continue
+        if self._loop_workers > 1 and part == None and \
+           self._current_pos == 0:
+            result = self.process_parallel(template)
+            if result != None:
+                return result
 
-            token = tokens[i]
-            if token.startswith("<TMPL_") or \
-               token.startswith("</TMPL_"):
-                if token == "<TMPL_VAR":
-                    # TMPL_VARs should be first. They are the most common.
-                    var = tokens[i + PARAM_NAME]
-                    if not var:
-                        raise TemplateException, "No identifier in <TMPL_VAR>."
-                    escape = tokens[i + PARAM_ESCAPE]
-                    globalp = tokens[i + PARAM_GLOBAL]
-                    skip_params = 1
-                    
-                    # If output of current block is not disabled then append
-                    # the substitued and escaped variable to the output.
-                    if DISABLE_OUTPUT not in output_control:
-                        value = str(self.find_value(var, loop_name, loop_pass,
-                                                    loop_total, globalp))
-                        out += self.escape(value, escape)
-                        self.debug("VAR: " + str(var))
-
-                elif token == "<TMPL_LOOP":
-                    var = tokens[i + PARAM_NAME]
-                    if not var:
-                        raise TemplateException, "No identifier in <TMPL_LOOP>."
-                    skip_params = 1
-
-                    # Find total number of passes in this loop.
-                    passtotal = self.find_value(var, loop_name, loop_pass,
-                                                loop_total)
-                    if not passtotal: passtotal = 0
-                    # Push data for this loop on the stack.
-                    loop_total.append(passtotal)
-                    loop_start.append(i)
-                    loop_pass.append(0)
-                    loop_name.append(var)
-
-                    # Disable output of loop block if the number of passes
-                    # in this loop is zero.
-                    if passtotal == 0:
-                        # This loop is empty.
-                        output_control.append(DISABLE_OUTPUT)
-                        self.debug("LOOP: DISABLE: " + str(var))
-                    else:
-                        output_control.append(ENABLE_OUTPUT)
-                        self.debug("LOOP: FIRST PASS: %s TOTAL: %d"\
-                                 % (var, passtotal))
-
-                elif token == "<TMPL_IF":
-                    var = tokens[i + PARAM_NAME]
-                    if not var:
-                        raise TemplateException, "No identifier in <TMPL_IF>."
-                    globalp = tokens[i + PARAM_GLOBAL]
-                    skip_params = 1
-                    if self.find_value(var, loop_name, loop_pass,
-                                       loop_total, globalp):
-                        output_control.append(ENABLE_OUTPUT)
-                        self.debug("IF: ENABLE: " + str(var))
-                    else:
-                        output_control.append(DISABLE_OUTPUT)
-                        self.debug("IF: DISABLE: " + str(var))
-     
-                elif token == "<TMPL_UNLESS":
-                    var = tokens[i + PARAM_NAME]
-                    if not var:
-                        raise TemplateException, "No identifier in <TMPL_UNLESS>."
-                    globalp = tokens[i + PARAM_GLOBAL]
-                    skip_params = 1
-                    if self.find_value(var, loop_name, loop_pass,
-                                      loop_total, globalp):
-                        output_control.append(DISABLE_OUTPUT)
-                        self.debug("UNLESS: DISABLE: " + str(var))
-                    else:
-                        output_control.append(ENABLE_OUTPUT)
-                        self.debug("UNLESS: ENABLE: " + str(var))
-     
-                elif token == "</TMPL_LOOP":
-                    skip_params = 1
-                    if not loop_name:
-                        raise TemplateException, "Unmatched </TMPL_LOOP>."
-                    
-                    # If this loop was not disabled, then record the pass.
-                    if loop_total[-1] > 0: loop_pass[-1] += 1
-                    
-                    if loop_pass[-1] == loop_total[-1]:
-                        # There are no more passes in this loop. Pop
-                        # the loop from stack.
-                        loop_pass.pop()
-                        loop_name.pop()
-                        loop_start.pop()
-                        loop_total.pop()
-                        output_control.pop()
-                        self.debug("LOOP: END")
-                    else:
-                        # Jump to the beggining of this loop block 
-                        # to process next pass of the loop.
-                        i = loop_start[-1]
-                        self.debug("LOOP: NEXT PASS")
-     
-                elif token == "</TMPL_IF":
-                    skip_params = 1
-                    if not output_control:
-                        raise TemplateException, "Unmatched </TMPL_IF>."
-                    output_control.pop()
-                    self.debug("IF: END")
-     
-                elif token == "</TMPL_UNLESS":
-                    skip_params = 1
-                    if not output_control:
-                        raise TemplateException, "Unmatched </TMPL_UNLESS>."
-                    output_control.pop()
-                    self.debug("UNLESS: END")
-     
-                elif token == "<TMPL_ELSE":
-                    skip_params = 1
-                    if not output_control:
-                        raise TemplateException, "Unmatched <TMPL_ELSE>."
-                    if output_control[-1] == DISABLE_OUTPUT:
-                        # Condition was false, activate the ELSE block.
-                        output_control[-1] = ENABLE_OUTPUT
-                        self.debug("ELSE: ENABLE")
-                    elif output_control[-1] == ENABLE_OUTPUT:
-                        # Condition was true, deactivate the ELSE block.
-                        output_control[-1] = DISABLE_OUTPUT
-                        self.debug("ELSE: DISABLE")
-                    else:
-                        raise TemplateException, "BUG: ELSE: INVALID FLAG"
-
-                elif token == "<TMPL_BOUNDARY":
-                    if part and part == self._current_part:
-                        self.debug("BOUNDARY ON")
-                        self._current_part += 1
-                        self._current_pos = i + 1 + PARAMS_NUMBER
-                        break
-                    else:
-                        skip_params = 1
-                        self.debug("BOUNDARY OFF")
-                        self._current_part += 1
-
-                elif token == "<TMPL_INCLUDE":
-                    # TMPL_INCLUDE is left in the compiled template only
-                    # when it was not replaced by the parser.
-                    skip_params = 1
-                    filename = tokens[i + PARAM_NAME]
-                    out += """
-                        <br />
-                        <p>
-                        <strong>HTMLTMPL WARNING:</strong><br />
-                        Cannot include template: <strong>%s</strong>
-                        </p>
-                        <br />
-                    """ % filename
-                    self.debug("CANNOT INCLUDE WARNING")
-
-                elif token == "<TMPL_GETTEXT":
-                    skip_params = 1
-                    if DISABLE_OUTPUT not in output_control:
-                        text = tokens[i + PARAM_GETTEXT_STRING]
-                        out += gettext.gettext(text)
-                        self.debug("GETTEXT: " + text)
-                    
-                else:
-                    # Unknown processing directive.
-                    raise TemplateException, "Invalid statement %s>." % token
-                     
-            elif DISABLE_OUTPUT not in output_control:
-                # Raw textual template data.
-                # If output of current block is not disabled, then 
-                # append template data to the output buffer.
-                out += token
-                
-            i += 1
-            # end of the big while loop
-        
-        # Check whether all opening statements were closed.
-        
-        if loop_name: raise TemplateException, "Missing </TMPL_LOOP>."
-        if output_control: raise TemplateException, "Missing </TMPL_IF> or </TMPL_UNLESS>"
-        return out
+        if self._codegen and part == None and self._current_pos == 0:
+            render = template.renderer()
+            if render:
+                self.debug("PROCESS: CODEGEN")
+                return render(self)
 
-    def setlogger(self, logger):
-        self._logger = logger
+        return "".join(self.process_tokens(template, part))
 
-    def debug(self, msg, level=logging.DEBUG):
-        if self._logger:
-            self._logger.write(msg, level=level)
-    
-    ##############################################
-    #              PRIVATE METHODS               #
-    ##############################################
-    
-    def find_value(self, var, loop_name, loop_pass, loop_total,
-                   global_override=None):
-        """ Search the self._vars data structure to find variable var
-            located in currently processed pass of a loop which
-            is currently being processed. If the variable is an ordinary
-            variable, then return it.
-            
-            If the variable is an identificator of a loop, then 
-            return the total number of times this loop will
-            be executed.
-            
-            Return an empty string, if the variable is not
-            found at all.
+    def process_part(self, template, part):
+        """ Process one part of a compiled multipart template. Return
+            the result as string.
 
-            @hidden
+            Unlike <em>process()</em>, this method renders the part
+            directly, without processing the parts before it, and it
+            does not change the current part of this processor. The parts
+            can be processed in any order and each of them any number of
+            times, so parts which depend on little data, like headers and
+            footers, can be cached by the application.
+
+            The start of every part is found by the compiler. This is
+            possible only when no <strong>TMPL_BOUNDARY</strong> is inside
+            of a block, otherwise an exception is raised.
+
+            @header process_part(template, part)
+            @return Result of the processing as string.
+
+            @param template A compiled template.
+            See the <em>process()</em> method.
+
+            @param part The number of the part to process, counted from
+            one.
         """
-        # Search for the requested variable in magic vars if the name
-        # of the variable starts with "__" and if we are inside a loop.
-        if self._magic_vars and var.startswith("__") and loop_name:
-            return self.magic_var(var, loop_pass[-1], loop_total[-1])
-                    
-        # Search for an ordinary variable or for a loop.
-        # Recursively search in self._vars for the requested variable.
-        scope = self._vars
-        #self.debug("SCOPE: %s"%(scope))
-        globals = []
-        for i in range(len(loop_name)):            
-            # If global lookup is on then push the value on the stack.
-            if ((self._global_vars and global_override != "0") or \
-                 global_override == "1") and scope.has_key(var) and \
-                self.is_ordinary_var(scope[var]):
-                globals.append(scope[var])
-		   
-            
-            # Descent deeper into the hierarchy.
-            if scope.has_key(loop_name[i]) and scope[loop_name[i]]:
-                self.debug("LOOP_NAME: %s; LOOP_PASS: %s"%(loop_name[i],loop_pass[i]))
-                scope = scope[loop_name[i]][loop_pass[i]] #####what is the meanning
-            else:
-                return ""
-            
-        if scope.has_key(var):
-            # Value exists in current loop.
-            if type(scope[var]) in [ListType, TupleType] or \
-               (hasattr(scope[var], '__class__') and issubclass(scope[var].__class__, list)):
-                # The requested value is a loop.
-                # Return total number of its passes.
-                return len(scope[var])
-            else:
-                return scope[var]
-        elif globals and \
-             ((self._global_vars and global_override != "0") or \
-               global_override == "1"):
-            # Return globally looked up value.
-            return globals.pop()
+        parts = template.parts()
+        if not parts:
+            raise TemplateException, "process_part() - template has "\
+                                     "a TMPL_BOUNDARY inside of a block"
+        if part < 1 or part > len(parts):
+            raise TemplateException, "process_part() - invalid part number"
+        if part < len(parts):
+            # Stop at the boundary which ends the part.
+            stop = parts[part] - 1
         else:
-            # No value found.
-            if var[0].isupper():
-                # This is a loop name.
-                # Return zero, because the user wants to know number
-                # of its passes.
-                return 0
-            else:
-                return ""
+            stop = None
+        self.debug("PROCESS PART: %d" % part)
+        return "".join(self.process_tokens(template, None, parts[part - 1],
+                                           stop))
 
-    def magic_var(self, var, loop_pass, loop_total):
-        """ Resolve and return value of a magic variable.
-            Raise an exception if the magic variable is not recognized.
+    def process_iter(self, template, part=None, chunk_size=8192):
+        """ Process a compiled template. Return an iterator over the result.
 
-            @hidden
-        """
-        self.debug("MAGIC: '%s', PASS: %d, TOTAL: %d"\
-                 % (var, loop_pass, loop_total))
+            This method has the same semantics as <em>process()</em>, but
+            the result is produced incrementally while the template is
+            processed. The output is yielded in chunks, so the caller can
+            send it out without holding the whole result in memory.
+
+            @header process_iter(template, part=None, chunk_size=8192)
+            @return Iterator over chunks of the result as strings. The
+            concatenation of the chunks equals the result of
+            <em>process()</em>.
+
+            @param template A compiled template.
+            See the <em>process()</em> method.
+
+            @param part The part of a multipart template to process.
+            See the <em>process()</em> method.
+
+            @param chunk_size Minimal size of a chunk.
+            Output is collected until at least chunk_size characters are
+            available. Zero yields every piece of output as soon as it is
+            produced. The last chunk can be shorter.
+        """
+        self.debug("APP INPUT:")
+        self.debug( "%s" % (self._vars) )
+        self.check_data(template)
+        if part != None and (part == 0 or part < self._current_part):
+            raise TemplateException, "process_iter() - invalid part number"
+        return self.chunks(self.process_tokens(template, part), chunk_size)
+
+    def process_to(self, template, sink, part=None, buffer_size=8192):
+        """ Process a compiled template and write the result to a sink.
+
+            This method has the same semantics as <em>process()</em>, but
+            the result is written to a file-like object or a socket while
+            the template is processed. Small pieces of output are collected
+            into a buffer and written together. Pieces of at least
+            buffer_size characters, typically the long static text of the
+            template, are written as they are, without being copied.
+
+            @header process_to(template, sink, part=None, buffer_size=8192)
+            @return Number of characters written.
+
+            @param template A compiled template.
+            See the <em>process()</em> method.
+
+            @param sink The object the result is written to.
+            It must have either the method <em>write()</em> of files or the
+            method <em>sendall()</em> of sockets.
+
+            @param part The part of a multipart template to process.
+            See the <em>process()</em> method.
+
+            @param buffer_size Size of the buffer.
+        """
+        self.debug("APP INPUT:")
+        self.debug( "%s" % (self._vars) )
+        self.check_data(template)
+        if part != None and (part == 0 or part < self._current_part):
+            raise TemplateException, "process_to() - invalid part number"
+        if hasattr(sink, "write"):
+            write = sink.write
+        elif hasattr(sink, "sendall"):
+            write = sink.sendall
+        else:
+            raise TemplateException, "process_to() - invalid sink"
+
+        if self._codegen and part == None and self._current_pos == 0:
+            render = template.renderer()
+            if render:
+                self.debug("PROCESS: CODEGEN")
+                pieces = [ render(self) ]
+            else:
+                pieces = self.process_tokens(template, part)
+        else:
+            pieces = self.process_tokens(template, part)
+
+        written = 0
+        buf = []
+        size = 0
+        for piece in pieces:
+            length = len(piece)
+            if length >= buffer_size:
+                if buf:
+                    write("".join(buf))
+                    buf = []
+                    size = 0
+                write(piece)
+            else:
+                buf.append(piece)
+                size += length
+                if size >= buffer_size:
+                    write("".join(buf))
+                    buf = []
+                    size = 0
+            written += length
+        if buf:
+            write("".join(buf))
+        return written
+
+    def response(self, template, keep_data=0):
+        """ Return a WSGI response iterable which processes a compiled
+            template part by part.
+
+            Every part of a multipart template is yielded as soon as it's
+            processed, so the client can receive the head of a page while
+            the rest is computed. Processing continues at the current
+            part of this processor. The iterable resets this processor
+            when it's closed, also if the client disconnects before all
+            parts are sent.
+
+            @header response(template, keep_data=0)
+            @return Instance of <em>TMPLTemplateResponse</em>.
+
+            @param template A compiled template.
+            See the <em>process()</em> method.
+
+            @param keep_data Do not reset the template data when the
+            iterable is closed. See the <em>reset()</em> method.
+        """
+        return TMPLTemplateResponse(self, template, keep_data)
+
+    def session(self, template, fingerprint=None):
+        """ Return a session which processes a compiled template
+            repeatedly and renders again only the passes of loops whose
+            data changed.
+
+            The session remembers the output of every pass of the
+            top-level loops, keyed by the fingerprint of its mapping. On
+            the next run of <em>TMPLTemplateSession.process()</em> the
+            passes with known fingerprints are reused, the new and the
+            changed ones are rendered and the output of the removed ones
+            is forgotten. The result is identical to the result of
+            <em>process()</em>.
+
+            @header session(template, fingerprint=None)
+            @return Instance of <em>TMPLTemplateSession</em>.
+
+            @param template A compiled template.
+            See the <em>process()</em> method.
+
+            @param fingerprint A function which returns a hashable
+            fingerprint of a mapping of a loop. Mappings with equal
+            fingerprints must produce the same output. By default the
+            fingerprint is built from the contents of the mapping, so
+            values other than lists, tuples and dictionaries must be
+            replaced, not modified in place, to be noticed.
+        """
+        return TMPLTemplateSession(self, template, fingerprint)
+
+    def process_many(self, template, datasets, workers=1, batch_size=64):
+        """ Process a compiled template once for every set of data.
+            Return an iterator over the results.
+
+            Every set of data is a mapping which is associated with the
+            top-level variables and loops as by <em>setdict()</em>. The
+            variables set on this processor are common to all of them,
+            a mapping overrides the common variables with the same name.
+            The data of this processor is not changed.
+
+            @header process_many(template, datasets, workers=1, batch_size=64)
+            @return Iterator over results of the processing as strings, in
+            the order of the sets of data.
+
+            @param template A compiled template.
+            See the <em>process()</em> method.
+
+            @param datasets An iterable of mappings.
+            It's consumed incrementally, so it can be a generator.
+
+            @param workers Number of worker processes.
+            With one worker the templates are processed in this process.
+            Otherwise the template, the settings and the common variables
+            are pickled once and loaded by every worker process once, the
+            sets of data are sent in batches. They and the escape
+            functions must be picklable then. The worker processes are
+            kept until <em>close()</em> is called.
+
+            @param batch_size Number of sets of data sent to a worker
+            process at once.
+        """
+        if batch_size < 1:
+            raise TemplateException, "process_many() - invalid batch size"
+        state = (template, self.settings(), self._escapes,
+                 self.used(template, self._vars).copy())
+        if self._unused == "ignore":
+            datasets = itertools.imap(lambda data: self.used(template, data),
+                                      datasets)
+        batches = self.batches(datasets, batch_size)
+        if workers is None or workers <= 1:
+            self.debug("PROCESS MANY: IN PROCESS")
+            worker = new_worker(*state)
+            for batch in batches:
+                for result in process_batch(batch, worker):
+                    yield result
+            return
+
+        self.debug("PROCESS MANY: %d WORKERS" % workers)
+        pool = self._pool.get(workers)
+        key = CALLS.next()
+        state = cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL)
+        # Keep a limited number of batches in flight, so the sets of
+        # data are read only as fast as the results are consumed.
+        pending = collections.deque()
+        for batch in batches:
+            pending.append(pool.apply_async(worker_batch,
+                                            (key, state, batch)))
+            if len(pending) > 2 * workers:
+                for result in pending.popleft().get():
+                    yield result
+        while pending:
+            for result in pending.popleft().get():
+                yield result
+
+    def close(self):
+        """ Stop the worker processes of this processor.
+
+            The worker processes of <em>process_many()</em> and of the
+            parallel rendering of loops are started when they are first
+            needed and kept for the next calls. They are shared by the
+            contexts of this processor. Call this method when the
+            processor is not used anymore, the processes are started
+            again when they are needed.
+
+            @header close()
+            @return No return value.
+        """
+        self._pool.close()
+        self.debug("WORKERS CLOSED")
+
+    def setlogger(self, logger):
+        self._logger = logger
+
+    def debug(self, msg, level=logging.DEBUG):
+        if self._logger:
+            self._logger.write(msg, level=level)
+    
+    ##############################################
+    #              PRIVATE METHODS               #
+    ##############################################
+    
+    def process_tokens(self, template, part=None, start=None, stop=None,
+                       window=None, state=None):
+        """ Process the list of tokens of a compiled template. This is
+            a generator yielding the pieces of the output in order.
+
+            Processing starts at position start, or where processing of
+            the last part ended, and ends at position stop. A window
+            (rows, first, last) restricts processing to the passes first
+            to last - 1 of the top-level loop at position start. The
+            state is the tuple of the loop stacks of an enclosing run,
+            which processes the block between start and stop in the
+            loops open at start.
+
+            @hidden
+        """
+        escapes = self._escapes
+
+        if state:
+            loop_rows, loop_pass, loop_start, loop_total, loop_last, \
+                       scopes, chains = state
+        else:
+            # Stacks for data related to loops.
+            loop_rows = []    # list of mappings of a loop
+            loop_pass = []    # current pass of a loop (counted from zero)
+            loop_start = []   # index of loop start in the code
+            loop_total = []   # total number of passes in a loop
+            loop_last = []    # pass at which processing of a loop ends
+
+            # The scope chain. The current mapping of every open loop,
+            # the innermost last. The top-level scope is self._vars.
+            # Chains hold the values found by global lookup from the
+            # enclosing scopes of every loop, they stay valid until the
+            # loop is left.
+            scopes = []
+            chains = []
+            state = (loop_rows, loop_pass, loop_start, loop_total,
+                     loop_last, scopes, chains)
+        open_loops = len(loop_start)
+        template_id = None
+
+        # The jump of a disabled TMPL_IF, TMPL_UNLESS or TMPL_LOOP points
+        # to its TMPL_ELSE or to its closing statement, the jump of
+        # a TMPL_ELSE reached from an enabled block points to the closing
+        # statement. The code of a disabled block is never visited.
+        template.link()
+        code = template.tokens()
+        len_code = len(code)
+
+        # Recover position at which we ended after processing of last part.
+        i = self._current_pos
+        if start != None:
+            i = start
+        if stop != None:
+            len_code = stop
+        if window:
+            # Enter the loop at the first pass of the window and stop
+            # after its closing statement.
+            rows, first, last = window
+            loop_rows.append(rows)
+            loop_total.append(len(rows))
+            loop_last.append(last)
+            loop_start.append(i)
+            loop_pass.append(first)
+            scopes.append(rows[first])
+            chains.append({})
+            len_code = self.loop_end(code, i) + 1
+            i += 3
+            
+        # Process the compiled template.
+        while i < len_code:
+            op = code[i]
+            if type(op) is not IntType:
+                # Raw textual template data.
+                yield op
+                i += 1
+
+            elif op == OP_VAR:
+                # TMPL_VARs should be first. They are the most common.
+                var = code[i + 1]
+                # Append the substitued and escaped variable to the output.
+                value = self.find_value(var, scopes, loop_pass, loop_total,
+                                        code[i + 3], chains)
+                yield escapes[code[i + 2]](value)
+                self.debug("VAR: " + str(var))
+                i += 4
+
+            elif op == OP_LOOP:
+                var = code[i + 1]
+                # Find the mappings and total number of passes in this loop.
+                rows = self.find_loop(var, scopes, loop_pass, loop_total,
+                                      chains)
+                # Enter the scope of the first pass. That also finds
+                # out whether a loop over an iterator has one pass only.
+                if len(rows):
+                    scopes.append(rows[0])
+                else:
+                    scopes.append(EMPTY_SCOPE)
+                passtotal = len(rows)
+                # Push data for this loop on the stack.
+                loop_rows.append(rows)
+                loop_total.append(passtotal)
+                loop_last.append(passtotal)
+                loop_start.append(i)
+                loop_pass.append(0)
+                chains.append({})
+
+                # Skip the loop block if the number of passes
+                # in this loop is zero.
+                if passtotal == 0:
+                    # This loop is empty.
+                    self.debug("LOOP: DISABLE: " + str(var))
+                    i = self.jump(code, code[i + 2])
+                else:
+                    self.debug("LOOP: FIRST PASS: %s TOTAL: %d"\
+                             % (var, passtotal))
+                    i += 3
+
+            elif op == OP_IF:
+                var = code[i + 1]
+                if self.find_value(var, scopes, loop_pass,
+                                   loop_total, code[i + 2], chains):
+                    self.debug("IF: ENABLE: " + str(var))
+                    i += 4
+                else:
+                    self.debug("IF: DISABLE: " + str(var))
+                    i = self.jump(code, code[i + 3])
+
+            elif op == OP_UNLESS:
+                var = code[i + 1]
+                if self.find_value(var, scopes, loop_pass,
+                                   loop_total, code[i + 2], chains):
+                    self.debug("UNLESS: DISABLE: " + str(var))
+                    i = self.jump(code, code[i + 3])
+                else:
+                    self.debug("UNLESS: ENABLE: " + str(var))
+                    i += 4
+
+            elif op == OP_END_LOOP:
+                if not loop_start:
+                    raise TemplateException, "Unmatched </TMPL_LOOP>."
+                
+                # If this loop was not disabled, then record the pass.
+                if loop_total[-1] > 0: loop_pass[-1] += 1
+                
+                if loop_pass[-1] == loop_last[-1]:
+                    # There are no more passes in this loop. Pop
+                    # the loop from stack.
+                    loop_pass.pop()
+                    loop_rows.pop()
+                    loop_start.pop()
+                    loop_total.pop()
+                    loop_last.pop()
+                    scopes.pop()
+                    chains.pop()
+                    self.debug("LOOP: END")
+                    i += 1
+                else:
+                    # Enter the scope of the next pass and jump to the
+                    # beggining of this loop block to process it.
+                    rows = loop_rows[-1]
+                    scopes[-1] = rows[loop_pass[-1]]
+                    if rows.__class__ is LoopIterator:
+                        # The total is known when the last pass is read.
+                        loop_total[-1] = loop_last[-1] = len(rows)
+                    i = loop_start[-1] + 3
+                    self.debug("LOOP: NEXT PASS")
+
+            elif op == OP_END_IF or op == OP_END_UNLESS:
+                self.debug("IF: END")
+                i += 1
+
+            elif op == OP_ELSE:
+                # The block was enabled, skip the ELSE block.
+                self.debug("ELSE: DISABLE")
+                i = code[i + 1]
+
+            elif op == OP_BOUNDARY:
+                i += 1
+                if part and part == self._current_part:
+                    self.debug("BOUNDARY ON")
+                    self._current_part += 1
+                    self._current_pos = i
+                    break
+                else:
+                    self.debug("BOUNDARY OFF")
+                    self._current_part += 1
+
+            elif op == OP_INCLUDE:
+                # TMPL_INCLUDE is left in the compiled template only
+                # when it was not replaced by the parser.
+                yield INCLUDE_WARNING % code[i + 1]
+                self.debug("CANNOT INCLUDE WARNING")
+                i += 2
+
+            elif op == OP_GETTEXT:
+                text = code[i + 1]
+                yield gettext.gettext(text)
+                self.debug("GETTEXT: " + text)
+                i += 2
+
+            elif op == OP_CACHE:
+                cache = self._cache
+                if cache is None:
+                    self.debug("CACHE: DISABLED")
+                    i += 4
+                    continue
+                if template_id is None:
+                    template_id = template.getid()
+                key = (self._cache_scope, template_id, i,
+                       tuple([ str(self.find_value(var, scopes, loop_pass,
+                                                   loop_total, None, chains))
+                               for var in code[i + 1] ]))
+                end = code[i + 3]
+                fragment = cache.get(key)
+                if fragment is None:
+                    # Render the block in the loops open here.
+                    self.debug("CACHE: MISS")
+                    fragment = "".join(self.process_tokens(template, None,
+                                                           i + 4, end, None,
+                                                           state))
+                    cache.set(key, fragment, code[i + 2])
+                else:
+                    self.debug("CACHE: HIT")
+                yield fragment
+                i = end + 1
+
+            elif op == OP_END_CACHE:
+                i += 1
+
+            else:
+                # Unknown processing directive.
+                raise TemplateException, "Invalid opcode %s." % op
+            # end of the big while loop
+        
+        # Check whether all loops were closed.
+        if len(loop_start) > open_loops:
+            raise TemplateException, "Missing </TMPL_LOOP>."
+
+    def loop_end(self, code, i):
+        """ Return the position of the closing statement of the loop
+            at position i.
+            @hidden
+        """
+        i = code[i + 2]
+        if code[i] == OP_ELSE:
+            i = code[i + 1]
+        return i
+
+    def jump(self, code, i):
+        """ Return the position at which processing continues when
+            a disabled block jumps to position i. That's the first
+            instruction of its ELSE block if there is one, otherwise
+            its closing statement.
+            @hidden
+        """
+        if code[i] == OP_ELSE:
+            self.debug("ELSE: ENABLE")
+            i += 2
+        return i
+
+    def process_parallel(self, template):
+        """ Process a compiled template as a whole, rendering the large
+            top-level loops in worker processes. Return the result as
+            string, or None if there are no such loops.
+
+            @hidden
+        """
+        template.link()
+        code = template.tokens()
+        loops = self.parallel_loops(code)
+        if not loops:
+            return None
+
+        workers = self._loop_workers
+        pool = self._pool.get(workers)
+
+        # The workers get the variables which the passes can find by
+        # global lookup, and only their own passes of the loop.
+        names = set()
+        for start, end, rows in loops:
+            names.update(self.referenced_names(code, start + 3, end))
+        vars = dict([ (name, self._vars[name]) for name in names
+                      if self._vars.has_key(name) ])
+        key = CALLS.next()
+        state = cPickle.dumps((template, self.settings(), self._escapes,
+                               vars), cPickle.HIGHEST_PROTOCOL)
+
+        # Submit the ranges of passes of all loops at once, the workers
+        # render them while the rest of the template is processed here.
+        ranges = []
+        for start, end, rows in loops:
+            total = len(rows)
+            size = max(1, total // (workers * 4))
+            results = []
+            for first in range(0, total, size):
+                last = min(first + size, total)
+                window = (PassWindow(rows[first:last], first, total),
+                          first, last)
+                results.append(pool.apply_async(process_window,
+                                                (key, state, start, window)))
+            ranges.append(results)
+
+        out = []
+        i = 0
+        for (start, end, rows), results in zip(loops, ranges):
+            self.debug("LOOP: PARALLEL: %s TOTAL: %d RANGES: %d"\
+                       % (code[start + 1], len(rows), len(results)))
+            out.extend(self.process_tokens(template, None, i, start))
+            for result in results:
+                out.append(result.get())
+            i = end + 1
+        out.extend(self.process_tokens(template, None, i))
+        return "".join(out)
+
+    def parallel_loops(self, code):
+        """ Return the list of (start, end, rows) of top-level loops
+            which have enough passes to be rendered in parallel. The
+            start and end are the positions of the loop statement and of
+            its closing statement.
+
+            @hidden
+        """
+        return self.top_loops(code, max(self._loop_min_rows, 1))
+
+    def top_loops(self, code, min_rows):
+        """ Return the list of (start, end, rows) of top-level loops
+            over lists or tuples of at least min_rows mappings which
+            contain no TMPL_BOUNDARY. Any pass of such loop can be
+            rendered alone, see process_tokens().
+
+            @hidden
+        """
+        loops = []
+        depth = 0
+        i = 0
+        len_code = len(code)
+        while i < len_code:
+            op = code[i]
+            if type(op) is not IntType:
+                i += 1
+                continue
+            if op == OP_LOOP and depth == 0:
+                end = self.loop_end(code, i)
+                value = self._vars.get(code[i + 1])
+                if value.__class__ is Deferred:
+                    value = value.resolve()
+                if self.is_iterator_loop(value):
+                    # An iterator is read ahead when it's looked up, it's
+                    # left to the serial processing.
+                    rows = None
+                else:
+                    rows = self.find_loop(code[i + 1], [], [], [])
+                if isinstance(rows, (ListType, TupleType, Columns)) and \
+                   len(rows) >= min_rows and \
+                   not self.has_boundary(code, i, end):
+                    loops.append((i, end, rows))
+                    i = end + 1
+                    continue
+            if op == OP_IF or op == OP_UNLESS or op == OP_LOOP or \
+               op == OP_CACHE:
+                depth += 1
+            elif op == OP_END_IF or op == OP_END_UNLESS or \
+                 op == OP_END_LOOP or op == OP_END_CACHE:
+                depth -= 1
+            i += 1 + OPERANDS[op]
+        return loops
+
+    def referenced_names(self, code, i, end):
+        """ Return the set of the names of the variables, loops and cache
+            keys referenced between positions i and end of the code.
+            @hidden
+        """
+        names = set()
+        while i < end:
+            op = code[i]
+            if type(op) is not IntType:
+                i += 1
+                continue
+            if op == OP_VAR or op == OP_IF or op == OP_UNLESS or \
+               op == OP_LOOP:
+                names.add(code[i + 1])
+            elif op == OP_CACHE:
+                names.update(code[i + 1])
+            i += 1 + OPERANDS[op]
+        return names
+
+    def has_boundary(self, code, i, end):
+        """ Return true if there is a TMPL_BOUNDARY between positions i
+            and end of the code.
+            @hidden
+        """
+        while i < end:
+            op = code[i]
+            if type(op) is not IntType:
+                i += 1
+            elif op == OP_BOUNDARY:
+                return 1
+            else:
+                i += 1 + OPERANDS[op]
+        return 0
+
+    def cache_scope(self):
+        """ Return the settings which change the output of a TMPL_CACHE
+            block: the escape functions, the magic and global lookup.
+            @hidden
+        """
+        return (tuple(self._escapes), self._magic_vars, self._global_vars)
+
+    def settings(self):
+        """ Return the arguments of init() which reproduce the processing
+            settings of this processor.
+            @hidden
+        """
+        return { "html_escape" : self._html_escape,
+                 "magic_vars" : self._magic_vars,
+                 "global_vars" : self._global_vars,
+                 "codegen" : self._codegen }
+
+    def batches(self, items, batch_size):
+        """ Collect items into lists of batch_size items.
+
+            @hidden
+        """
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def chunks(self, pieces, chunk_size):
+        """ Collect pieces of output into chunks of at least chunk_size
+            characters.
+
+            @hidden
+        """
+        buf = []
+        size = 0
+        for piece in pieces:
+            if not piece:
+                continue
+            buf.append(piece)
+            size += len(piece)
+            if size >= chunk_size:
+                yield "".join(buf)
+                buf = []
+                size = 0
+        if buf:
+            yield "".join(buf)
+
+    def find_value(self, var, scopes, loop_pass, loop_total,
+                   global_override=None, chains=None):
+        """ Find variable var in the current scope, which is the mapping
+            of the currently processed pass of the innermost loop, or
+            self._vars outside of loops. If the variable is an ordinary
+            variable, then return it.
+            
+            If the variable is an identificator of a loop, then 
+            return the total number of times this loop will
+            be executed.
+
+            If global lookup is on, then variables which are not found in
+            the current scope are looked up in the enclosing scopes. The
+            global_override is the compiled GLOBAL parameter, None means
+            that the global_vars setting applies.
+            
+            Return an empty string, if the variable is not
+            found at all.
+
+            The cost of a lookup does not depend on the depth of the
+            loops, see find_global().
+
+            @hidden
+        """
+        if scopes:
+            # Search for the requested variable in magic vars if the name
+            # of the variable starts with "__" and if we are inside a loop.
+            if self._magic_vars and var[:2] == "__":
+                return self.magic_var(var, loop_pass[-1], loop_total[-1])
+            scope = scopes[-1]
+        else:
+            scope = self._vars
+
+        if scope.__class__ is DictType:
+            value = scope.get(var, MISSING)
+        elif scope.__class__ is ColumnScope:
+            value = scope._columns.get(var, MISSING)
+            if value is not MISSING:
+                value = value[scope._index]
+        else:
+            value = lookup(scope, var)
+        if value is not MISSING:
+            # Value exists in current scope.
+            if value.__class__ is Deferred:
+                value = value.resolve()
+            if isinstance(value, (ListType, TupleType, Columns)):
+                # The requested value is a loop.
+                # Return total number of its passes.
+                return len(value)
+            return value
+
+        if scope is EMPTY_SCOPE:
+            return ""
+        if scopes and ((self._global_vars and global_override != 0) or \
+                       global_override == 1):
+            # Return globally looked up value.
+            value = self.find_global(var, scopes, len(scopes) - 1, chains)
+            if value is not None:
+                return value
+
+        # No value found.
+        if var[0].isupper():
+            # This is a loop name.
+            # Return zero, because the user wants to know number
+            # of its passes.
+            return 0
+        else:
+            return ""
+
+    def find_global(self, var, scopes, depth, chains=None):
+        """ Look up an ordinary variable in the scopes enclosing the scope
+            of the loop at the given depth, the innermost first. Return
+            None if it is not found.
+
+            The results are remembered in chains, so every variable is
+            looked up once per entry of the loop, not once per reference.
+
+            @hidden
+        """
+        if chains is not None:
+            chain = chains[depth]
+            if var in chain:
+                return chain[var]
+        if depth:
+            scope = scopes[depth - 1]
+        else:
+            scope = self._vars
+        if scope.__class__ is DictType:
+            value = scope.get(var)
+        else:
+            value = lookup(scope, var)
+        if value.__class__ is Deferred:
+            value = value.resolve()
+        if not self.is_ordinary_var(value):
+            if depth:
+                value = self.find_global(var, scopes, depth - 1, chains)
+            else:
+                value = None
+        if chains is not None:
+            chain[var] = value
+        return value
+
+    def find_loop(self, var, scopes, loop_pass, loop_total, chains=None):
+        """ Return the list of mappings of loop var in the current scope.
+            A loop can also be given by the number of its passes, then
+            the variables inside of the loop are not found. Return an empty
+            list if the loop is not found.
+
+            @hidden
+        """
+        if scopes:
+            scope = scopes[-1]
+        else:
+            scope = self._vars
+        if scope.__class__ is DictType:
+            rows = scope.get(var)
+        else:
+            rows = lookup(scope, var)
+        if rows.__class__ is Deferred:
+            rows = rows.resolve()
+        if isinstance(rows, (ListType, TupleType, Columns)):
+            return rows
+        if is_record_array(rows):
+            return Columns(rows)
+        if self.is_iterator_loop(rows):
+            return LoopIterator(rows)
+        passtotal = self.find_value(var, scopes, loop_pass, loop_total,
+                                    None, chains)
+        if not passtotal:
+            return []
+        return [EMPTY_SCOPE] * passtotal
+
+    def magic_var(self, var, loop_pass, loop_total):
+        """ Resolve and return value of a magic variable.
+            Raise an exception if the magic variable is not recognized.
+
+            @hidden
+        """
+        self.debug("MAGIC: '%s', PASS: %d, TOTAL: %d"\
+                 % (var, loop_pass, loop_total))
         if var == "__FIRST__":
             if loop_pass == 0:
                 return 1
@@ -559,6 +1786,10 @@ class TMPLTemplateProcessor( TemplateProcessor ):
             # Magic variable __PASS__ counts passes from one.
             return loop_pass + 1
         elif var == "__PASSTOTAL__":
+            if loop_total == UNSIZED:
+                raise TemplateException, "Magic variable __PASSTOTAL__ is "\
+                                         "unknown before the last pass of "\
+                                         "a loop over an iterator."
             return loop_total
         elif var == "__ODD__":
             # Internally pass numbers stored in loop_pass are counted from
@@ -594,25 +1825,427 @@ class TMPLTemplateProcessor( TemplateProcessor ):
 
     def escape(self, str, override=""):
         """ Escape a string either by HTML escaping or by URL escaping.
+            The override is the value of the ESCAPE parameter.
+            @hidden
+        """
+        return self.escape_value(str, ESCAPE_MODES.get(override,
+                                                       ESCAPE_DEFAULT))
+
+    def escape_value(self, str, mode):
+        """ Escape a string according to a compiled escape mode.
+            @hidden
+        """
+        return self._escapes[mode](str)
+
+    def check(self, var, value):
+        """ Validate the name of a top-level variable or loop. Return
+            true if the value is set as is, false if set() converts it.
+            Raise an exception if the name is invalid.
             @hidden
         """
-        ESCAPE_QUOTES = 1
-        if (self._html_escape and override != "NONE" and override != "0" and \
-            override != "URL") or override == "HTML" or override == "1":
-            return cgi.escape(str, ESCAPE_QUOTES)
-        elif override == "URL":
-            return urllib.quote_plus(str)
+        # The correctness of character case is verified only for top-level
+        # variables.
+        if self.is_ordinary_var(value):
+            # template top-level ordinary variable
+            if not var.islower():
+                raise TemplateException, "Invalid variable name '%s'." % var
+        elif type(value) in [ListType, TupleType] or \
+             (hasattr(value, '__class__') and issubclass(value.__class__, list)) \
+             or isinstance(value, Columns) or is_record_array(value) \
+             or self.is_iterator_loop(value):
+            # template top-level loop
+            if var != var.capitalize():
+                raise TemplateException, "Invalid loop name '%s' (%s)." % (var, value)
+            if is_record_array(value):
+                return 0
+        elif isinstance(value, Deferred):
+            # template top-level variable or loop computed on demand
+            if not var.islower() and var != var.capitalize():
+                raise TemplateException, "Invalid variable name '%s'." % var
         else:
-            return str
+            return 0
+        return 1
+
+    def plan(self, dict, strict):
+        """ Validate the names of a mapping passed to setdict(). Return
+            the tuples of the names which are skipped and of the names
+            whose values are converted.
+            @hidden
+        """
+        skipped = []
+        converted = []
+        for var, value in dict.iteritems():
+            try:
+                if not self.check(var, value):
+                    converted.append(var)
+            except TemplateException:
+                if strict:
+                    raise
+                self.debug("INVALID NAME SKIPPED: %s" % var)
+                skipped.append(var)
+        return (tuple(skipped), tuple(converted))
+
+    def check_data(self, template):
+        """ Warn about the data which the template doesn't reference if
+            the unused mode is "warn" and the template is processed from
+            its beginning.
+            @hidden
+        """
+        if self._unused != "warn" or self._current_pos != 0:
+            return
+        unused = self.unused_vars(template, self._vars)
+        if unused:
+            unused.sort()
+            self.debug("UNUSED DATA: %s: %s" % (template.getid(),
+                                                ", ".join(unused)),
+                       logging.WARNING)
+
+    def used(self, template, vars):
+        """ Return the mapping vars without the names which the template
+            doesn't reference if the unused mode is "ignore", otherwise
+            return vars.
+            @hidden
+        """
+        if self._unused != "ignore":
+            return vars
+        unused = self.unused_vars(template, vars)
+        if not unused:
+            return vars
+        vars = vars.copy()
+        for var in unused:
+            del vars[var]
+        self.debug("UNUSED DATA IGNORED: %d" % len(unused))
+        return vars
+
+    def unused_vars(self, template, vars):
+        """ Return the list of the names in the mapping vars which the
+            template doesn't reference. A name referenced in a loop may be
+            found by global lookup if it has the parameter GLOBAL=1, or if
+            global lookup is enabled on this processor.
+            @hidden
+        """
+        schema = template.schema()
+        names = set(schema["vars"])
+        names.update(schema["loops"].keys())
+        loops = schema["loops"].values()
+        while loops:
+            loop = loops.pop()
+            names.update(loop["globals"])
+            if self._global_vars:
+                names.update(loop["vars"])
+            loops.extend(loop["loops"].values())
+        return [ var for var in vars if var not in names ]
+
+    def is_iterator_loop(self, value):
+        """ Return true if value is an iterator or a CursorRows, which
+            are processed lazily as a loop. Other iterables which are not
+            lists or tuples are values of ordinary variables.
+            @hidden
+        """
+        return value.__class__ is CursorRows or \
+               (hasattr(value, "next") and hasattr(value, "__iter__"))
 
     def is_ordinary_var(self, var):
         """ Return true if var is a scalar. (not a reference to loop)
             @hidden
         """
-        if type(var) in [StringType, UnicodeType, IntType, LongType,
-                         FloatType, BooleanType]:
+        if isinstance(var, (StringType, UnicodeType, IntType, LongType,
+                            FloatType, BooleanType)):
             return 1
         else:
             return 0
 
-    
+
+##############################################
+#          CLASS: TMPLTemplateContext
+##############################################
+
+class TMPLTemplateContext(TMPLTemplateProcessor):
+    """ The state of one render of a shared processor.
+
+        Use <em>TMPLTemplateProcessor.context()</em> to create instances
+        of this class. A context has all methods of the processor.
+    """
+
+    def __init__(self, processor):
+        """ Constructor.
+            @hidden
+        """
+        # The settings are immutable, they are shared by reference.
+        self.__dict__.update(processor.__dict__)
+        self._vars = processor._vars.copy()
+        self._current_part = 1
+        self._current_pos = 0
+
+
+##############################################
+#          CLASS: TMPLTemplateResponse
+##############################################
+
+class TMPLTemplateResponse:
+    """ WSGI response iterable of a multipart template.
+
+        Use <em>TMPLTemplateProcessor.response()</em> to create instances
+        of this class. Each iteration processes and yields one part of the
+        template. The WSGI server calls <em>close()</em> when the response
+        is finished or abandoned, which resets the processor.
+    """
+
+    def __init__(self, processor, template, keep_data=0):
+        """ Constructor.
+            @hidden
+        """
+        self._processor = processor
+        self._template = template
+        self._keep_data = keep_data
+        self._closed = 0
+
+    def __iter__(self):
+        """ Process and yield the remaining parts of the template.
+        """
+        processor = self._processor
+        while not self._closed:
+            part = processor._current_part
+            result = processor.process(self._template, part)
+            # The current part does not change when the processing
+            # reaches the end of the template.
+            last = processor._current_part == part
+            processor.debug("RESPONSE: PART %d" % part)
+            yield result
+            if last:
+                break
+
+    def close(self):
+        """ Reset the state of the processor, so it can be used to
+            process another template.
+
+            @header close()
+            @return No return value.
+        """
+        if not self._closed:
+            self._closed = 1
+            self._processor.reset(keep_data=self._keep_data)
+
+
+##############################################
+#          CLASS: TMPLTemplateSession
+##############################################
+
+class TMPLTemplateSession:
+    """ Repeated processing of a template which reuses the output of the
+        passes of loops whose data did not change.
+
+        Use <em>TMPLTemplateProcessor.session()</em> to create instances
+        of this class. Set the data on the processor and call
+        <em>process()</em> for every run.
+    """
+
+    def __init__(self, processor, template, fingerprint=None):
+        """ Constructor.
+            @hidden
+        """
+        self._processor = processor
+        self._template = template
+        self._fingerprint = fingerprint or self.fingerprint
+        self.hits = 0
+        self.misses = 0
+
+        # Output of the passes of the last run: mapping of the position
+        # of a loop to the mapping of the keys of its passes to output.
+        self._passes = {}
+
+        # Mapping of the position of a loop to the flags (magic, global)
+        # telling whether its passes depend on their number or on the
+        # enclosing scope.
+        self._depends = {}
+
+    def process(self):
+        """ Process the template as a whole with the data of the
+            processor. Return the result as string.
+
+            @header process()
+            @return Result of the processing as string.
+        """
+        processor = self._processor
+        template = self._template
+        processor.reset(keep_data=1)
+        template.link()
+        code = template.tokens()
+        passes = {}
+        out = []
+        i = 0
+        for start, end, rows in processor.top_loops(code, 1):
+            out.extend(processor.process_tokens(template, None, i, start))
+            magic, glob = self.depends(code, start, end)
+            context = None
+            if glob:
+                # Global lookup finds ordinary variables only.
+                vars = processor.used(template, processor._vars)
+                context = self.fingerprint(dict([
+                    (var, value) for var, value in vars.items()
+                    if processor.is_ordinary_var(value) or
+                       value.__class__ is Deferred ]))
+            total = len(rows)
+            known = self._passes.get(start, {})
+            current = {}
+            for loop_pass in range(total):
+                key = (self._fingerprint(rows[loop_pass]), context)
+                if magic:
+                    key += (loop_pass, total)
+                piece = current.get(key)
+                if piece is None:
+                    piece = known.get(key)
+                if piece is None:
+                    self.misses += 1
+                    piece = "".join(processor.process_tokens(
+                        template, None, start, None,
+                        (rows, loop_pass, loop_pass + 1)))
+                else:
+                    self.hits += 1
+                current[key] = piece
+                out.append(piece)
+            processor.debug("SESSION: LOOP %s: %d PASSES" % (code[start + 1],
+                                                            total))
+            passes[start] = current
+            i = end + 1
+        out.extend(processor.process_tokens(template, None, i))
+        self._passes = passes
+        return "".join(out)
+
+    def clear(self):
+        """ Forget the output of all passes, for example after the
+            settings of the processor changed.
+
+            @header clear()
+            @return No return value.
+        """
+        self._passes = {}
+
+    ##############################################
+    #              PRIVATE METHODS               #
+    ##############################################
+
+    def depends(self, code, start, end):
+        """ Return the flags (magic, global) of the loop at position
+            start. Magic is true if the body of the loop refers to
+            a magic variable of the loop, global is true if it may look
+            up variables in the top-level scope.
+            @hidden
+        """
+        depends = self._depends.get(start)
+        if depends is None:
+            magic = 0
+            glob = self._processor._global_vars
+            depth = 0
+            i = start + 3
+            while i < end:
+                op = code[i]
+                if type(op) is not IntType:
+                    i += 1
+                    continue
+                if op == OP_LOOP:
+                    depth += 1
+                elif op == OP_END_LOOP:
+                    depth -= 1
+                elif op == OP_VAR or op == OP_IF or op == OP_UNLESS:
+                    if code[i + 1][:2] == "__" and depth == 0:
+                        magic = 1
+                    if op == OP_VAR:
+                        override = code[i + 3]
+                    else:
+                        override = code[i + 2]
+                    if override == 1:
+                        glob = 1
+                i += 1 + OPERANDS[op]
+            depends = (magic, glob)
+            self._depends[start] = depends
+        return depends
+
+    def fingerprint(self, value):
+        """ Return a hashable fingerprint of the contents of a value.
+            @hidden
+        """
+        if value.__class__ is ColumnScope:
+            value = dict([ (key, value[key]) for key in value.keys() ])
+        if isinstance(value, dict):
+            items = []
+            for key, item in value.iteritems():
+                if item.__class__ in SCALAR_TYPES:
+                    # Most values are scalars, skip the recursion.
+                    items.append((key, (item.__class__, item)))
+                else:
+                    items.append((key, self.fingerprint(item)))
+            items.sort()
+            return (dict, tuple(items))
+        if isinstance(value, (ListType, TupleType)):
+            return (list, tuple([ self.fingerprint(item) for item in value ]))
+        try:
+            hash(value)
+        except TypeError:
+            return (None, repr(value))
+        return (value.__class__, value)
+
+
+##############################################
+#             WORKER PROCESSES               #
+##############################################
+
+# Keys of the calls which send work to worker processes.
+CALLS = itertools.count()
+
+# The key of the last call served by a worker process and the state
+# loaded for it, see load_worker().
+WORKER = (None, None)
+
+def new_worker(template, settings, escapes, vars):
+    """ Return the state used by process_batch(): a processor with the
+        given settings, the template and the common variables.
+        @hidden
+    """
+    processor = TMPLTemplateProcessor()
+    processor.init(**settings)
+    processor._escapes = escapes
+    return (processor, template, vars)
+
+def load_worker(key, state):
+    """ Return the state of a worker process for the call with the given
+        key. The pickled state is loaded once per call.
+        @hidden
+    """
+    global WORKER
+    if WORKER[0] != key:
+        WORKER = (key, new_worker(*cPickle.loads(state)))
+    return WORKER[1]
+
+def worker_batch(key, state, batch):
+    """ Process a batch of TMPLTemplateProcessor.process_many() in
+        a worker process.
+        @hidden
+    """
+    return process_batch(batch, load_worker(key, state))
+
+def process_batch(batch, worker):
+    """ Process the template once for every mapping of the batch.
+        Return the list of results.
+        @hidden
+    """
+    processor, template, vars = worker
+    results = []
+    for data in batch:
+        processor.reset()
+        processor._vars.update(vars)
+        processor.setdict(data)
+        results.append(processor.process(template))
+    return results
+
+def process_window(key, state, start, window):
+    """ Render the window (rows, first, last) of the top-level loop at
+        position start of the template in a worker process. Return the
+        result as string.
+        @hidden
+    """
+    processor, template, vars = load_worker(key, state)
+    processor.reset()
+    processor._vars.update(vars)
+    return "".join(processor.process_tokens(template, None, start, None,
+                                            window))
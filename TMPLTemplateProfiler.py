@@ -0,0 +1,155 @@
+"""
+Profiler of the tmpl template engine. It collects the number of
+executions, the cumulative time and the size of the output of every
+statement of the processed templates.
+"""
+
+__version__='$Revision: 3193 $'[11:-2]
+
+# All imported modules are part of the standard Python library.
+import time
+
+# Positions of the counters of a statement.
+COUNT = 0
+TIME = 1
+BYTES = 2
+
+# Columns of the table and the keys it can be sorted by.
+COLUMNS = { "count" : COUNT, "time" : TIME, "bytes" : BYTES }
+
+
+##############################################
+#          CLASS: TMPLTemplateProfiler
+##############################################
+
+class TMPLTemplateProfiler:
+    """ Collect the profile of processed templates.
+
+        Pass an instance of this class to <em>TMPLTemplateProcessor.init()
+        </em> to enable profiling. Every template processed as a whole is
+        then processed by a generated function which measures each
+        TMPL_VAR, TMPL_IF, TMPL_UNLESS and TMPL_LOOP statement. The
+        measurements are aggregated across all runs until <em>reset()</em>
+        is called.
+
+        A statement is identified by the template and by its path, the
+        statements of the blocks it's nested in, for example
+        ("TMPL_LOOP Rows", "TMPL_IF odd", "TMPL_VAR name"). The empty path
+        stands for the whole template. The time and the output of a block
+        include the statements nested in it.
+
+        The processors which are not given a profiler are not affected.
+    """
+
+    def __init__(self, timer=time.time):
+        """ Constructor.
+
+            @header __init__(timer=time.time)
+            @param timer Function which returns the current time in seconds.
+        """
+        self.timer = timer
+        self._templates = {}
+
+    def counters(self, template, labels):
+        """ Return the list of counters of the statements of a template.
+            Each item is a list [count, time, bytes] of the statement of
+            the same index in labels.
+            @hidden
+        """
+        key = (template, labels)
+        counters = self._templates.get(key)
+        if counters is None:
+            counters = [ [0, 0.0, 0] for label in labels ]
+            self._templates[key] = counters
+        return counters
+
+    def stats(self):
+        """ Return the collected measurements.
+
+            @header stats()
+            @return List of tuples (template, path, count, time, bytes)
+            sorted by template and path.
+        """
+        stats = {}
+        for (template, labels), counters in self._templates.items():
+            for path, counter in zip(labels, counters):
+                if not counter[COUNT]:
+                    continue
+                key = (template, path)
+                if stats.has_key(key):
+                    # Statements with the same path, or a statement of
+                    # a template which was recompiled.
+                    total = stats[key]
+                    for i in (COUNT, TIME, BYTES):
+                        total[i] += counter[i]
+                else:
+                    stats[key] = list(counter)
+        keys = stats.keys()
+        keys.sort()
+        return [ key + tuple(stats[key]) for key in keys ]
+
+    def table(self, sort="time", limit=None):
+        """ Return the measurements formatted as a table.
+
+            @header table(sort="time", limit=None)
+            @return String containing the table.
+            @param sort Column by which the rows are sorted in descending
+            order: <em>count</em>, <em>time</em> or <em>bytes</em>.
+            @param limit Maximal number of rows.
+        """
+        column = COLUMNS[sort] + 2
+        stats = self.stats()
+        stats.sort(lambda a, b: cmp(b[column], a[column]))
+        if limit != None:
+            stats = stats[:limit]
+        lines = [ "%10s %12s %12s  %s" % ("count", "time [ms]", "bytes",
+                                         "statement") ]
+        for template, path, count, elapsed, size in stats:
+            lines.append("%10d %12.3f %12d  %s" % (count, elapsed * 1000.0,
+                                                   size,
+                                                   self.name(template, path)))
+        return "\n".join(lines) + "\n"
+
+    def collapsed(self):
+        """ Return the measurements in the collapsed stack format of
+            flame graph tools: one line per statement, the frames
+            separated by semicolons and the time spent in the statement
+            itself, without the nested statements, in microseconds.
+
+            @header collapsed()
+            @return String containing the lines.
+        """
+        stats = self.stats()
+        own = {}
+        for template, path, count, elapsed, size in stats:
+            own[(template, path)] = own.get((template, path), 0.0) + elapsed
+            if path:
+                parent = (template, path[:-1])
+                own[parent] = own.get(parent, 0.0) - elapsed
+        lines = []
+        for template, path, count, elapsed, size in stats:
+            micros = int(round(max(own[(template, path)], 0.0) * 1000000))
+            lines.append("%s %d" % (self.name(template, path, ";"), micros))
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """ Drop the collected measurements.
+
+            @header reset()
+            @return No return value.
+        """
+        for counters in self._templates.values():
+            for counter in counters:
+                counter[COUNT] = 0
+                counter[TIME] = 0.0
+                counter[BYTES] = 0
+
+    ##############################################
+    #              PRIVATE METHODS               #
+    ##############################################
+
+    def name(self, template, path, separator=" / "):
+        """ Return the printable name of a statement.
+            @hidden
+        """
+        return separator.join((template.replace(separator, "_"),) + path)
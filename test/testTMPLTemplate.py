@@ -162,6 +162,56 @@ class testTMPLTemplate(unittest.TestCase):
         f_tmpl.init(TMPLTemplate.__version__, [], ['tokens'], {})       
         self.assertEquals(f_tmpl._tokens, ['tokens'])
 
+    def test_assemble(self):
+        """
+        Test assemble
+        """
+        tokens = ['', 'text', '<TMPL_VAR', 'var', 'URL', '1',
+                  '<TMPL_IF', 'flag', None, '0', '<TMPL_ELSE', None, None, None,
+                  '</TMPL_IF', None, None, None,
+                  '<TMPL_GETTEXT', 'hello', None, None, '<TMPL_INVALID']
+        code = TMPLTemplate.assemble(tokens)
+        self.assertEquals(code, ['text',
+                                 TMPLTemplate.OP_VAR, 'var',
+                                 TMPLTemplate.ESCAPE_URL, 1,
+                                 TMPLTemplate.OP_IF, 'flag', 0, None,
+                                 TMPLTemplate.OP_ELSE, None,
+                                 TMPLTemplate.OP_END_IF,
+                                 TMPLTemplate.OP_GETTEXT, 'hello',
+                                 TMPLTemplate.OP_INVALID, '<TMPL_INVALID'])
+        self.assertEquals(TMPLTemplate.is_assembled(tokens), 0)
+        self.assertEquals(TMPLTemplate.is_assembled(code), 1)
+        self.assertEquals(TMPLTemplate.is_assembled(['text']), 1)
+
+        # Templates precompiled with the list of tokens are converted.
+        f_tmpl = TMPLTemplate.TMPLTemplate(self.__test_filename)
+        f_tmpl.init(TMPLTemplate.__version__, [], [], {})
+        state = f_tmpl.__getstate__()
+        del state['_linked']
+        state['_tokens'] = tokens
+        f_tmpl.__setstate__(state)
+        self.assertEquals(f_tmpl.tokens(), code)
+        self.assertEquals(f_tmpl._linked, 0)
+
+    def test_schema(self):
+        """
+        Test schema
+        """
+        f_tmpl = TMPLTemplate.TMPLTemplate(None, "x")
+        f_tmpl.init(TMPLTemplate.__version__, [],
+                    ['<TMPL_VAR', 'a', None, None], {})
+        self.assertEquals(f_tmpl._schema, None)
+        schema = f_tmpl.schema()
+        self.assertEquals(schema["vars"], ['a'])
+        self.assert_(f_tmpl.schema() is schema)
+
+        # Templates precompiled without the schema find it when needed.
+        state = f_tmpl.__getstate__()
+        del state['_schema']
+        f_tmpl.__setstate__(state)
+        f_tmpl.setlogger(None)
+        self.assertEquals(f_tmpl.schema(), schema)
+
     def test_file(self):
 	"""
         Test file
@@ -183,7 +233,7 @@ class testTMPLTemplate(unittest.TestCase):
 	"""
         f_tmpl = TMPLTemplate.TMPLTemplate(self.__test_filename,  self.__test_content)
         dict = f_tmpl.__getstate__()
-        self.assertEquals(dict.keys(), ['_compile_params', '_mtime', '_content', '_file', '_version', '_include_mtimes', '_tokens'])
+        self.assertEquals(dict.keys(), ['_locale', '_compile_params', '_mtime', '_content', '_parts', '_file', '_version', '_linked', '_schema', '_tokens', '_include_mtimes'])
 
     def test__setstate__(self):
         """
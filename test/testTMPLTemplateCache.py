@@ -0,0 +1,82 @@
+"""
+PyUnit TestCase for TMPLTemplateCache.
+
+$Id: testTMPLTemplateCache.py 3193 2010-11-10 14:22:01Z duan $
+"""
+
+__version__= "$Revision: 3193 $"[11:-2]
+
+import unittest
+
+# more imports
+import template.TMPLTemplateCache as TMPLTemplateCache
+
+class Timer:
+    """ A clock which is moved by the test.
+    """
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+class testTMPLTemplateCache(unittest.TestCase):
+
+    def setUp(self):
+        self.timer = Timer()
+        self.__testee = TMPLTemplateCache.TMPLTemplateCache(3, None,
+                                                            self.timer)
+
+    def tearDown(self):
+        self.__testee = None
+
+    def test_get(self):
+        """
+        Test get
+        """
+        self.assertEquals(self.__testee.get("a"), None)
+        self.__testee.set("a", "")
+        self.assertEquals(self.__testee.get("a"), "")
+        self.assertEquals((self.__testee.hits, self.__testee.misses), (1, 1))
+
+    def test_set(self):
+        """
+        Test set
+        """
+        for key in ["a", "b", "c"]:
+            self.__testee.set(key, key.upper())
+        # The least recently used fragment is dropped.
+        self.assertEquals(self.__testee.get("a"), "A")
+        self.__testee.set("d", "D")
+        self.assertEquals(len(self.__testee), 3)
+        self.assertEquals(self.__testee.get("b"), None)
+        self.assertEquals(self.__testee.get("a"), "A")
+        self.__testee.set("a", "AA")
+        self.assertEquals(self.__testee.get("a"), "AA")
+        self.assertEquals(len(self.__testee), 3)
+
+    def test_ttl(self):
+        """
+        Test expiration of fragments
+        """
+        self.__testee.set("a", "A", 10)
+        self.__testee.set("b", "B")
+        self.timer.now = 9.0
+        self.assertEquals(self.__testee.get("a"), "A")
+        self.timer.now = 10.0
+        self.assertEquals(self.__testee.get("a"), None)
+        self.assertEquals(self.__testee.get("b"), "B")
+
+        testee = TMPLTemplateCache.TMPLTemplateCache(ttl=5, timer=self.timer)
+        testee.set("a", "A")
+        self.timer.now = 15.0
+        self.assertEquals(testee.get("a"), None)
+
+    def test_clear(self):
+        """
+        Test clear
+        """
+        self.__testee.set("a", "A")
+        self.__testee.get("a")
+        self.__testee.clear()
+        self.assertEquals(len(self.__testee), 0)
+        self.assertEquals((self.__testee.hits, self.__testee.misses), (0, 0))
@@ -0,0 +1,133 @@
+"""
+PyUnit TestCase for TMPLTemplateCodegen.
+
+$Id: testTMPLTemplateCodegen.py 3193 2010-11-10 14:22:01Z duan $
+"""
+
+__version__= "$Revision: 3193 $"[11:-2]
+
+import unittest
+
+# more imports
+import template.TMPLTemplate as TMPLTemplate
+import template.TMPLTemplateCodegen as TMPLTemplateCodegen
+import template.TMPLTemplateManager as TMPLTemplateManager
+import template.TMPLTemplateProcessor as TMPLTemplateProcessor
+import template.TemplateException as TemplateException
+
+# test fixture
+
+TEMPLATE = """<html><TMPL_VAR title>
+<TMPL_IF flag>yes<TMPL_ELSE>no</TMPL_IF>
+<TMPL_UNLESS flag>unless</TMPL_UNLESS>
+<TMPL_LOOP Rows>
+  <TMPL_VAR __PASS__>/<TMPL_VAR __PASSTOTAL__>: <TMPL_VAR name ESCAPE=URL>
+  <TMPL_IF __FIRST__>first</TMPL_IF><TMPL_IF __LAST__>last</TMPL_IF>
+  <TMPL_VAR title GLOBAL=1>
+  <TMPL_LOOP Cells><TMPL_VAR value ESCAPE=NONE> <TMPL_VAR name GLOBAL=1></TMPL_LOOP>
+</TMPL_LOOP>
+<TMPL_LOOP Empty>never</TMPL_LOOP>
+<TMPL_BOUNDARY>
+</html>"""
+
+DATA = {
+    "title" : "<Title & co>",
+    "flag" : 1,
+    "Rows" : [ { "name" : "a b", "Cells" : [ { "value" : "<1>" },
+                                             { "value" : "<2>" } ] },
+               { "name" : "c&d", "Cells" : [] },
+               { "name" : "e", "Cells" : [ { "value" : 3 } ] } ],
+    "Empty" : [],
+    }
+
+def compile_string(data):
+    return TMPLTemplateManager.TMPLTemplateCompiler().compile_string(data)
+
+class testTMPLTemplateCodegen(unittest.TestCase):
+
+    def setUp(self):
+        self.__testee = TMPLTemplateCodegen.TMPLTemplateCodegen()
+
+    def tearDown(self):
+        self.__testee = None
+
+    def process(self, template, data, codegen):
+        processor = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        processor.init(codegen=codegen)
+        processor.setdict(data)
+        return processor.process(template)
+
+    def test_generate(self):
+        """
+        Test generate
+        """
+        source = self.__testee.generate(["text", TMPLTemplate.OP_VAR, "var",
+                                         TMPLTemplate.ESCAPE_DEFAULT, None])
+        self.assert_(source.startswith("def render(self):"))
+        self.assert_("'text'" in source)
+        self.assert_("'var'" in source)
+        for tokens in [["<TMPL_IF", "var", None, None],
+                       ["</TMPL_LOOP", None, None, None],
+                       ["<TMPL_IF", "var", None, None,
+                        "<TMPL_ELSE", None, None, None,
+                        "<TMPL_ELSE", None, None, None,
+                        "</TMPL_IF", None, None, None]]:
+            self.assertRaises(TMPLTemplateCodegen.CodegenError,
+                              self.__testee.generate,
+                              TMPLTemplate.assemble(tokens))
+
+    def test_compile(self):
+        """
+        Test compile
+        """
+        template = compile_string(TEMPLATE)
+        render = self.__testee.compile(template)
+        self.assert_(callable(render))
+        template.init(TMPLTemplate.__version__, [],
+                      ["<TMPL_IF", "var", None, None, "unbalanced"], {})
+        self.assertEquals(self.__testee.compile(template), None)
+
+    def test_identical_output(self):
+        """
+        Generated function renders the same output as the interpreter
+        """
+        template = compile_string(TEMPLATE)
+        expected = self.process(template, DATA, 0)
+        self.assertEquals(self.process(template, DATA, 1), expected)
+        # The function is cached on the template.
+        self.assert_(template.renderer() is template.renderer())
+        data = DATA.copy()
+        data["flag"] = 0
+        self.assertEquals(self.process(template, data, 1),
+                          self.process(template, data, 0))
+
+    def test_loop_else(self):
+        """
+        ELSE block of a loop is rendered only when the loop is empty
+        """
+        template = compile_string("<TMPL_LOOP Rows><TMPL_VAR __PASS__>"
+                                  "<TMPL_ELSE>empty</TMPL_LOOP>")
+        self.assert_(template.renderer())
+        for rows in [ [], [ {}, {}, {} ] ]:
+            data = { "Rows" : rows }
+            self.assertEquals(self.process(template, data, 1),
+                              self.process(template, data, 0))
+        self.assertEquals(self.process(template, { "Rows" : [] }, 1), "empty")
+
+    def test_fallback(self):
+        """
+        Templates that cannot be translated are interpreted
+        """
+        template = compile_string("a")
+        template.init(TMPLTemplate.__version__, [],
+                      ["<TMPL_LOOP", "Rows", None, None, "a"], {})
+        self.assertEquals(template.renderer(), None)
+        data = { "Rows" : [ {}, {}, {} ] }
+        self.assertRaises(TemplateException.TemplateException,
+                          self.process, template, data, 1)
+
+        processor = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        processor.init(codegen=1)
+        template = compile_string("head<TMPL_BOUNDARY>body")
+        self.assertEquals(processor.process(template, 1), "head")
+        self.assertEquals(processor.process(template, 2), "body")
@@ -0,0 +1,97 @@
+"""
+PyUnit TestCase for TMPLTemplateEscape.
+
+$Id: testTMPLTemplateEscape.py 3193 2010-11-10 14:22:01Z duan $
+"""
+
+__version__= "$Revision: 3193 $"[11:-2]
+
+import unittest
+
+# more imports
+import template.TMPLTemplate as TMPLTemplate
+import template.TMPLTemplateEscape as TMPLTemplateEscape
+import template.TMPLTemplateManager as TMPLTemplateManager
+import template.TMPLTemplateProcessor as TMPLTemplateProcessor
+import template.TemplateException as TemplateException
+
+class testTMPLTemplateEscape(unittest.TestCase):
+
+    def test_escape_html(self):
+        """
+        Test escape_html
+        """
+        escape_html = TMPLTemplateEscape.escape_html
+        self.assertEquals(escape_html('a < b & "c" > d'),
+                          'a &lt; b &amp; &quot;c&quot; &gt; d')
+        self.assertEquals(escape_html("plain"), "plain")
+        self.assertEquals(escape_html("&amp;"), "&amp;amp;")
+        self.assertEquals(escape_html(12), "12")
+        self.assertEquals(escape_html(u"<u>"), "&lt;u&gt;")
+        self.assertEquals(escape_html(TMPLTemplateEscape.SafeString("<b>")),
+                          "<b>")
+
+    def test_escape_url(self):
+        """
+        Test escape_url
+        """
+        escape_url = TMPLTemplateEscape.escape_url
+        self.assertEquals(escape_url("a b&c"), "a+b%26c")
+        self.assertEquals(escape_url(3), "3")
+        self.assertEquals(escape_url(TMPLTemplateEscape.SafeString("a+b")),
+                          "a+b")
+
+    def test_escape_none(self):
+        """
+        Test escape_none
+        """
+        self.assertEquals(TMPLTemplateEscape.escape_none("<b>"), "<b>")
+        self.assertEquals(TMPLTemplateEscape.escape_none(1.5), "1.5")
+
+    def test_escape_functions(self):
+        """
+        Test escape_functions
+        """
+        functions = TMPLTemplateEscape.escape_functions()
+        self.assertEquals(functions[TMPLTemplate.ESCAPE_DEFAULT],
+                          TMPLTemplateEscape.escape_html)
+        self.assertEquals(functions[TMPLTemplate.ESCAPE_URL],
+                          TMPLTemplateEscape.escape_url)
+        functions = TMPLTemplateEscape.escape_functions(0)
+        self.assertEquals(functions[TMPLTemplate.ESCAPE_DEFAULT],
+                          TMPLTemplateEscape.escape_none)
+        self.assertEquals(functions[TMPLTemplate.ESCAPE_HTML],
+                          TMPLTemplateEscape.escape_html)
+
+        upper = lambda value: str(value).upper()
+        functions = TMPLTemplateEscape.escape_functions(1, { "html" : upper })
+        self.assertEquals(functions[TMPLTemplate.ESCAPE_DEFAULT], upper)
+        self.assertEquals(functions[TMPLTemplate.ESCAPE_HTML], upper)
+
+        self.assertRaises(TemplateException.TemplateException,
+                          TMPLTemplateEscape.escape_functions, 1,
+                          { "JS" : upper })
+        self.assertRaises(TemplateException.TemplateException,
+                          TMPLTemplateEscape.escape_functions, 1,
+                          { "URL" : "upper" })
+
+    def test_process(self):
+        """
+        The processor uses the bound escape functions
+        """
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        template = compiler.compile_string("<TMPL_VAR a>|<TMPL_VAR a ESCAPE=URL>"
+                                           "|<TMPL_VAR a ESCAPE=NONE>"
+                                           "|<TMPL_VAR b>")
+        for codegen in [0, 1]:
+            processor = TMPLTemplateProcessor.TMPLTemplateProcessor()
+            processor.init(codegen=codegen)
+            processor.set("a", "x <y>")
+            processor.set("b", TMPLTemplateEscape.SafeString("<br />"))
+            self.assertEquals(processor.process(template),
+                              "x &lt;y&gt;|x+%3Cy%3E|x <y>|<br />")
+
+            processor.init(codegen=codegen, escapes={ "URL" : repr })
+            processor.set("a", "x <y>")
+            self.assertEquals(processor.process(template),
+                              "x &lt;y&gt;|'x <y>'|x <y>|")
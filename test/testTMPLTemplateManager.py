@@ -10,7 +10,10 @@ import unittest
 import sets
 import sys
 import os
+import time
 import cPickle
+import struct
+import gettext
 # more imports
 import template.TemplateException as TemplateException
 import template.TMPLTemplateManager as TMPLTemplateManager
@@ -33,6 +36,27 @@ def create_file(filename, content, always=0):
         f.write(content)
         f.close()
 
+def create_catalog(filename, messages):
+    keys = messages.keys()
+    keys.sort()
+    ids = "".join([ key + "\0" for key in keys ])
+    strs = "".join([ messages[key] + "\0" for key in keys ])
+    start = 7 * 4 + 16 * len(keys)
+    offsets = []
+    for key in keys:
+        offsets.append((len(key), start + ids.index(key + "\0")))
+    start += len(ids)
+    for key in keys:
+        value = messages[key]
+        offsets.append((len(value), start + strs.index(value + "\0")))
+    f = open(filename, 'wb')
+    f.write(struct.pack("Iiiiiii", 0x950412deL, 0, len(keys), 7 * 4,
+                        7 * 4 + 8 * len(keys), 0, 0))
+    for length, offset in offsets:
+        f.write(struct.pack("ii", length, offset))
+    f.write(ids + strs)
+    f.close()
+
 INCLUDE_DIR = "."
 class testTMPLTemplateCompiler(unittest.TestCase):
 
@@ -73,7 +97,7 @@ class testTMPLTemplateCompiler(unittest.TestCase):
                           os.path.join(os.path.dirname(self.__tmpl_filename),INCLUDE_DIR ))
         self.assertEquals(template._version, TMPLTemplate.__version__)
         self.assertEquals(template._tokens, ['Test 1'])
-        self.assertEquals(template._compile_params, (self.__testee._include,                  self.__testee._max_include, self.__testee._comments, self.__testee._gettext))
+        self.assertEquals(template._compile_params, (self.__testee._include,                  self.__testee._max_include, self.__testee._comments, self.__testee._gettext, self.__testee._minify, self.__testee._locale))
         self.assertEquals(template._mtime, os.path.getmtime(self.__tmpl_filename))  
 
         self.assertEquals(template._file, self.__tmpl_filename)
@@ -168,6 +192,173 @@ class testTMPLTemplateCompiler(unittest.TestCase):
         self.assertEquals(tokens, ["Test 1", "Test 2"])
         self.assertEquals(self.__testee._include_files, [os.path.join(self.__testee._include_path, "test.tmpl"),os.path.join(self.__testee._include_path, "test2.tmpl")])
 
+    def test_link_blocks(self):
+        """
+        Test link_blocks
+        """
+        code = TMPLTemplate.assemble(self.__testee.tokenize(
+            "<TMPL_IF a>x<TMPL_ELSE>y</TMPL_IF><TMPL_LOOP B>z</TMPL_LOOP>"))
+        self.__testee.link_blocks(code)
+        self.assertEquals(code, [TMPLTemplate.OP_IF, 'a', None, 5, 'x',
+                                 TMPLTemplate.OP_ELSE, 8, 'y',
+                                 TMPLTemplate.OP_END_IF,
+                                 TMPLTemplate.OP_LOOP, 'B', 13, 'z',
+                                 TMPLTemplate.OP_END_LOOP])
+        for data in ["<TMPL_IF a>", "</TMPL_IF>", "<TMPL_ELSE>",
+                     "<TMPL_IF a><TMPL_ELSE><TMPL_ELSE></TMPL_IF>",
+                     "<TMPL_IF a><TMPL_LOOP B></TMPL_IF></TMPL_LOOP>",
+                     "<TMPL_INVALID a>",
+                     "<TMPL_CACHE a>x<TMPL_ELSE>y</TMPL_CACHE>",
+                     "<TMPL_CACHE a><TMPL_IF b><TMPL_BOUNDARY></TMPL_IF>"
+                     "</TMPL_CACHE>"]:
+            self.assertRaises(TemplateException.TemplateException,
+                              self.__testee.link_blocks,
+                              TMPLTemplate.assemble(self.__testee.tokenize(data)))
+        self.assertRaises(TemplateException.TemplateException,
+                          self.__testee.link_blocks,
+                          [TMPLTemplate.OP_VAR, '', 0, None])
+        self.assertRaises(TemplateException.TemplateException,
+                          self.__testee.compile_string, "<TMPL_IF a>")
+
+        code = TMPLTemplate.assemble(self.__testee.tokenize(
+            "<TMPL_CACHE a:b TTL=60>x</TMPL_CACHE><TMPL_CACHE>y</TMPL_CACHE>"))
+        self.__testee.link_blocks(code)
+        self.assertEquals(code, [TMPLTemplate.OP_CACHE, ('a', 'b'), 60.0, 5,
+                                 'x', TMPLTemplate.OP_END_CACHE,
+                                 TMPLTemplate.OP_CACHE, (), None, 11, 'y',
+                                 TMPLTemplate.OP_END_CACHE])
+        self.assertRaises(TemplateException.TemplateException,
+                          self.__testee.compile_string,
+                          "<TMPL_CACHE a TTL=x></TMPL_CACHE>")
+
+    def test_fold(self):
+        """
+        Test fold
+        """
+        def fold(data):
+            return self.__testee.fold(TMPLTemplate.assemble(
+                self.__testee.tokenize(data)), "<string>")
+        self.assertEquals(fold("a<TMPL_IF x></TMPL_IF>b<TMPL_VAR v>c"),
+                          ['ab', TMPLTemplate.OP_VAR, 'v', 0, None, 'c'])
+        self.assertEquals(fold("a<TMPL_LOOP X><TMPL_UNLESS y><TMPL_ELSE>"
+                               "</TMPL_UNLESS></TMPL_LOOP>b"), ['ab'])
+        self.assertEquals(fold("<TMPL_IF x>a<TMPL_ELSE></TMPL_IF>"),
+                          [TMPLTemplate.OP_IF, 'x', None, None, 'a',
+                           TMPLTemplate.OP_END_IF])
+        self.assertEquals(fold("<TMPL_LOOP X><TMPL_ELSE>a</TMPL_LOOP>"),
+                          [TMPLTemplate.OP_LOOP, 'X', None,
+                           TMPLTemplate.OP_ELSE, None, 'a',
+                           TMPLTemplate.OP_END_LOOP])
+        self.assertEquals(fold("a<TMPL_CACHE k>b</TMPL_CACHE>c"
+                               "<TMPL_CACHE></TMPL_CACHE>d"), ['abcd'])
+        # Invalid blocks are not removed.
+        for data in ["<TMPL_IF></TMPL_IF>",
+                     "<TMPL_IF a><TMPL_ELSE><TMPL_ELSE></TMPL_IF>",
+                     "<TMPL_CACHE a><TMPL_ELSE></TMPL_CACHE>",
+                     "<TMPL_IF a></TMPL_LOOP>"]:
+            self.assertRaises(TemplateException.TemplateException,
+                              self.__testee.compile_string, data)
+
+    def test_index_parts(self):
+        """
+        Test index_parts
+        """
+        template = self.__testee.compile_string("a<TMPL_BOUNDARY>"
+                                                "<TMPL_IF b>c</TMPL_IF>"
+                                                "<TMPL_BOUNDARY>d")
+        self.assertEquals(template.parts(), [0, 2, 9])
+        self.assertEquals(template._parts, [0, 2, 9])
+        self.assertEquals(self.__testee.compile_string("a").parts(), [0])
+        template = self.__testee.compile_string("<TMPL_LOOP A>"
+                                                "<TMPL_BOUNDARY></TMPL_LOOP>")
+        self.assertEquals(template.parts(), [])
+
+    def test_schema(self):
+        """
+        Test schema
+        """
+        template = self.__testee.compile_string(
+            "<TMPL_VAR title><TMPL_IF Rows>"
+            "<TMPL_LOOP Rows><TMPL_VAR name><TMPL_VAR site GLOBAL=1>"
+            "<TMPL_IF __FIRST__>F</TMPL_IF><TMPL_LOOP Cells><TMPL_VAR id>"
+            "</TMPL_LOOP><TMPL_UNLESS empty></TMPL_UNLESS></TMPL_LOOP>"
+            "</TMPL_IF><TMPL_LOOP Rows><TMPL_VAR odd></TMPL_LOOP>"
+            "<TMPL_CACHE user:lang><TMPL_VAR y></TMPL_CACHE><TMPL_VAR __PASS__>")
+        cells = { "vars" : ['id'], "loops" : {}, "globals" : [],
+                  "magic" : [] }
+        rows = { "vars" : ['name', 'odd', 'site'], "loops" : { "Cells" : cells },
+                 "globals" : ['site'], "magic" : ['__FIRST__'] }
+        self.assertEquals(template.schema(), { "vars" : ['Rows', '__PASS__',
+                                                         'lang', 'title',
+                                                         'user', 'y'],
+                                               "loops" : { "Rows" : rows },
+                                               "globals" : [], "magic" : [],
+                                               "includes" : {} })
+        self.assertEquals(self.__testee.names(template.tokens()),
+                          ['Cells', 'Rows', '__FIRST__', '__PASS__', 'id',
+                           'lang', 'name', 'odd', 'site', 'title', 'user',
+                           'y'])
+
+        create_file(self.__tmpl_filename, "<TMPL_VAR a>", 1)
+        create_file(self.__tmpl_filename2, "<TMPL_LOOP B><TMPL_INCLUDE test.tmpl>"
+                    "</TMPL_LOOP>", 1)
+        testee = TMPLTemplateManager.TMPLTemplateCompiler()
+        schema = testee.compile(self.__tmpl_filename2).schema()
+        self.assertEquals(schema["loops"]["B"]["vars"], ['a'])
+        self.assertEquals(schema["includes"],
+                          { os.path.join(testee._include_path, "test.tmpl") :
+                            ['a'] })
+
+    def test_minify(self):
+        """
+        Test minify
+        """
+        testee = TMPLTemplateManager.TMPLTemplateCompiler(minify=1)
+        template = testee.compile_string("<ul>\n    <li> a  b\t</li>\n"
+                                         "<pre>  <TMPL_VAR x>  y</PRE>"
+                                         "  <textarea>\n\n</textarea> "
+                                         "<script type=\"a\">  <TMPL_IF x>"
+                                         "  </TMPL_IF></script>\t\r\n</ul>")
+        self.assertEquals(template.tokens(),
+                          ["<ul>\n<li> a b </li>\n<pre>  ",
+                           TMPLTemplate.OP_VAR, 'x', 0, None,
+                           "  y</PRE> <textarea>\n\n</textarea> "
+                           "<script type=\"a\">  ",
+                           TMPLTemplate.OP_IF, 'x', None, 11, "  ",
+                           TMPLTemplate.OP_END_IF, "</script>\n</ul>"])
+        self.assertEquals(template._compile_params[4], 1)
+
+        # Quoted attribute values are kept.
+        template = testee.compile_string("<input  value=\"a   b\"  title = "
+                                         "'<TMPL_VAR x>  c'  data-x=\"\">"
+                                         " a  =  b")
+        self.assertEquals(template.tokens(),
+                          ["<input value=\"a   b\" title = '",
+                           TMPLTemplate.OP_VAR, 'x', 0, None,
+                           "  c' data-x=\"\"> a = b"])
+
+    def test_translator(self):
+        """
+        Test translator
+        """
+        self.assertEquals(self.__testee.translator(), None)
+        testee = TMPLTemplateManager.TMPLTemplateCompiler(locale="xx")
+        self.assertEquals(testee._locale, None)
+        self.assertEquals(testee.compile_string("a[[b]]").tokens(),
+                          ["a[[b]]"])
+        testee = TMPLTemplateManager.TMPLTemplateCompiler(gettext=1)
+        self.assertEquals(testee.compile_string("a[[b]]").tokens(),
+                          ["a", TMPLTemplate.OP_GETTEXT, "b"])
+        # Without a catalog the strings are left untranslated.
+        testee = TMPLTemplateManager.TMPLTemplateCompiler(gettext=1,
+                                                          locale="xx")
+        template = testee.compile_string("a[[b]]<TMPL_VAR c>[[d]]e")
+        self.assertEquals(template.tokens(),
+                          ["ab", TMPLTemplate.OP_VAR, 'c', 0, None, "de"])
+        self.assertEquals(template.locale(), "xx")
+        self.assertEquals(template._compile_params[-1], "xx")
+        self.assert_(template.getid().endswith("@xx"))
+
     def test_tokenize(self):
         """
         Test tokenize
@@ -178,6 +369,8 @@ class testTMPLTemplateCompiler(unittest.TestCase):
 ("<!-- /TMPL_ NAME=val ESCAPE=escape GLOBAL=global####"), ['</TMPL_', 'val', 'escape', 'global'])
         self.assertEquals(self.__testee.tokenize("NAME=val ESCAPE=escape GLOBAL=global"),\
 ["NAME=val ESCAPE=escape GLOBAL=global"])
+        self.assertEquals(self.__testee.tokenize("<TMPL_CACHE a:b TTL=5>"),
+                          ['', '<TMPL_CACHE', 'a:b', '5', None, ''])
         
         testee = TMPLTemplateManager.TMPLTemplateCompiler(1,5,1,1)
         self.assertEquals(testee.tokenize("s\\\\s"), ['s\\s'])
@@ -189,7 +382,7 @@ class testTMPLTemplateCompiler(unittest.TestCase):
         template = self.__testee.compile_string("Compile_string### comments")
         self.assertEquals(template._version, TMPLTemplate.__version__)
         self.assertEquals(template._tokens, ['Compile_string'])
-        self.assertEquals(template._compile_params, (self.__testee._include,                  self.__testee._max_include, self.__testee._comments, self.__testee._gettext))
+        self.assertEquals(template._compile_params, (self.__testee._include,                  self.__testee._max_include, self.__testee._comments, self.__testee._gettext, self.__testee._minify, self.__testee._locale))
         self.assertEquals(template._mtime, None)  
         self.assertEquals(template._file , None)
         self.assertEquals(template._content, "Compile_string### comments")
@@ -210,7 +403,9 @@ class testTMPLTemplateCompiler(unittest.TestCase):
         tested = sets.Set(['compile', '__module__', 'gettext_tokens', 'find_param', 
                            'read', 'add_gettext_token', '__doc__', 'parse', 
                            'strip_brackets', 'remove_comments', 'find_name', 'include_templates', 
-                           'tokenize', 'compile_string', 'find_directive', '__init__', ])
+                           'tokenize', 'compile_string', 'find_directive', '__init__',
+                           'link_blocks', 'fold', 'minify', 'collapse',
+                           'index_parts', 'translator', 'schema', 'names', ])
 
         all_dir = tested | sets.Set(dir(mg))
 
@@ -227,7 +422,9 @@ class testTMPLTemplateCompiler(unittest.TestCase):
         tested = sets.Set(['compile', '__module__', 'gettext_tokens', 'find_param', 
                            'read', 'add_gettext_token', '__doc__', 'parse', 
                            'strip_brackets', 'remove_comments', 'find_name', 'include_templates', 
-                           'tokenize', 'compile_string', 'find_directive', '__init__', ])
+                           'tokenize', 'compile_string', 'find_directive', '__init__',
+                           'link_blocks', 'fold', 'minify', 'collapse',
+                           'index_parts', 'translator', 'schema', 'names', ])
 
         all_dir = tested | base_set
 
@@ -444,6 +641,117 @@ class testTMPLTemplateManager(unittest.TestCase):
         self.assert_(update12.file() is None)
         self.assert_(update12.content() == self.__test_content)
 
+    def test_minify(self):
+        """
+        Test recompilation of precompiled templates with minification
+        """
+        create_file(self.__tmpl_filename1, "a  \n  b", 1)
+        self.assertEquals(self.ttm_cache_1.prepare(self.__tmpl_filename1).tokens(),
+                          ["a  \n  b"])
+        self.ttm_cache_1.init(minify=1)
+        self.assertEquals(self.ttm_cache_1.prepare(self.__tmpl_filename1).tokens(),
+                          ["a\nb"])
+        self.ttm_no_cache.init(minify=1)
+        self.assertEquals(self.ttm_no_cache.prepare(self.__tmpl_filename1).tokens(),
+                          ["a\nb"])
+        self.ttm_no_cache.init()
+        self.assertEquals(self.ttm_no_cache.prepare(self.__tmpl_filename1).tokens(),
+                          ["a  \n  b"])
+
+    def test_locale(self):
+        """
+        Test templates prepared for a locale
+        """
+        locales = os.path.join(self.__path, "tmp", "locale")
+        os.makedirs(os.path.join(locales, "de", "LC_MESSAGES"))
+        domain = gettext.textdomain()
+        create_catalog(os.path.join(locales, "de", "LC_MESSAGES",
+                                    domain + ".mo"), { "Hello" : "Hallo" })
+        create_file(self.__tmpl_filename1, "[[Hello]] <TMPL_VAR x>", 1)
+        localedir = gettext.bindtextdomain(domain)
+        gettext.bindtextdomain(domain, locales)
+        try:
+            self.ttm_cache_1.init(gettext=1)
+            template = self.ttm_cache_1.prepare(self.__tmpl_filename1,
+                                                locale="de")
+            self.assertEquals(template.tokens(),
+                              ["Hallo ", TMPLTemplate.OP_VAR, 'x', 0, None])
+            self.assertEquals(template.locale(), "de")
+            self.assert_(self.ttm_cache_1.prepare(self.__tmpl_filename1,
+                                                  locale="de") is template)
+            self.assert_(os.path.exists(os.path.join(self.__path,
+                                                     "tmp/test1.tmpl@de.c")))
+            self.assertEquals(self.ttm_no_cache.load_precompiled(
+                self.__tmpl_filename1, "de").tokens(), template.tokens())
+
+            # An updated catalog is noticed.
+            catalog = os.path.join(locales, "de", "LC_MESSAGES",
+                                   domain + ".mo")
+            create_catalog(catalog, { "Hello" : "Servus" })
+            os.utime(catalog, (time.time() + 10, time.time() + 10))
+            self.assert_(not template.is_uptodate())
+            template = self.ttm_cache_1.prepare(self.__tmpl_filename1,
+                                                locale="de")
+            self.assertEquals(template.tokens()[0], "Servus ")
+            self.assertEquals(self.ttm_no_cache.load_precompiled(
+                self.__tmpl_filename1, "de").tokens()[0], "Servus ")
+
+            template = self.ttm_cache_1.prepare(self.__tmpl_filename1)
+            self.assertEquals(template.tokens()[:2],
+                              [TMPLTemplate.OP_GETTEXT, "Hello"])
+            self.assertEquals(template.locale(), None)
+            self.assertRaises(TemplateException.TemplateException,
+                              self.ttm_cache_1.prepare, self.__tmpl_filename1,
+                              None, "../de")
+
+            # The locale is ignored without gettext support.
+            template = self.ttm_no_cache.prepare(self.__tmpl_filename1,
+                                                 locale="de")
+            self.assertEquals(template.tokens(), ["[[Hello]] ",
+                                                  TMPLTemplate.OP_VAR, 'x',
+                                                  0, None])
+        finally:
+            gettext.bindtextdomain(domain, localedir)
+
+    def test_precompiled_schema(self):
+        """
+        Test the schema of precompiled templates
+        """
+        create_file(self.__tmpl_filename1, "<TMPL_LOOP Rows><TMPL_VAR a>"
+                    "</TMPL_LOOP>", 1)
+        schema = self.ttm_no_cache.prepare(self.__tmpl_filename1).schema()
+        template = self.ttm_no_cache.load_precompiled(self.__tmpl_filename1)
+        self.assertEquals(template._schema, schema)
+        self.assertEquals(template._schema["loops"]["Rows"]["vars"], ['a'])
+
+    def test_precompiled_file(self):
+        """
+        Test precompiled_file
+        """
+        self.assertEquals(self.ttm_no_cache.precompiled_file("a/b.tmpl"),
+                          "a/b.tmplc")
+        self.assertEquals(self.ttm_no_cache.precompiled_file("a/b.tmpl",
+                                                             "pt_BR"),
+                          "a/b.tmpl@pt_BR.c")
+        self.assertNotEquals(self.ttm_no_cache.precompiled_file("a/b.tmpl",
+                                                                "de"),
+                             self.ttm_no_cache.precompiled_file("a/b.de.tmpl"))
+
+    def test_compiled_other_template(self):
+        """
+        Test precompiled files which hold another template
+        """
+        create_file(self.__tmpl_filename2, "Test 1 [[x]]", 1)
+        self.ttm_no_cache.compiled(self.__tmpl_filename2)
+        # The precompiled form of test2.tmpl stored as the one of test1.tmpl.
+        os.rename(self.ttm_no_cache.precompiled_file(self.__tmpl_filename2),
+                  self.ttm_no_cache.precompiled_file(self.__tmpl_filename1))
+        template = self.ttm_no_cache.compiled(self.__tmpl_filename1)
+        self.assertEquals(template.file(), self.__tmpl_filename1)
+        self.assertEquals(template.tokens(), ["Test 1"])
+        template = self.ttm_no_cache.load_precompiled(self.__tmpl_filename1)
+        self.assertEquals(template.file(), self.__tmpl_filename1)
+
     def test_lock_file(self):
 	"""
         Test lock_file
@@ -512,7 +820,7 @@ class testTMPLTemplateManager(unittest.TestCase):
 
         tested = sets.Set(['init', 'compile', 'compiled', 'setlogger', 
                            'lock_file', 'compile_string', 'is_precompiled', 'load_precompiled', 
-                           'save_precompiled', ])
+                           'save_precompiled', 'variant', 'precompiled_file', ])
 
         all_dir = tested | sets.Set(dir(templatemanager))
 
@@ -525,7 +833,7 @@ class testTMPLTemplateManager(unittest.TestCase):
 
         tested = sets.Set(['init', 'compile', 'compiled', 'setlogger', 
                            'lock_file', 'compile_string', 'is_precompiled', 'load_precompiled', 
-                           'save_precompiled', ])
+                           'save_precompiled', 'variant', 'precompiled_file', ])
 
         all_dir = tested | base_set
 
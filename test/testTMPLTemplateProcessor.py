@@ -10,12 +10,26 @@ import unittest
 import sets
 import os
 import sys
+import time
+import pickle
+import socket
+import threading
+import StringIO
+import UserDict
+import collections
+import array
+import logging
+import sqlite3
+import wsgiref.util
+import wsgiref.validate
 
 # more imports
 import template.TMPLTemplateProcessor as TMPLTemplateProcessor
 import template.TemplateProcessor as TemplateProcessor
 import template.TMPLTemplate as TMPLTemplate
+import template.TMPLTemplateManager as TMPLTemplateManager
 import template.TemplateException as TemplateException
+import template.TMPLTemplateCache as TMPLTemplateCache
 
 # test fixture
 
@@ -33,6 +47,62 @@ def rm_f(top):
             os.rmdir(os.path.join(root, name))
     os.rmdir(top)
 
+class Item:
+    def __init__(self, name, price):
+        self.name = name
+        self.price = price
+        self._secret = "x"
+
+class Order(object):
+    def __init__(self, id, items):
+        self.id = id
+        self.items = items
+    def total(self):
+        return sum([ item.price for item in self.items ])
+    total = property(total)
+
+class Field:
+    def __init__(self, values):
+        self.values = values
+    def tolist(self):
+        return list(self.values)
+
+class DType:
+    names = ("id", "name")
+
+class RecordArray:
+    """ Stands for a NumPy structured array.
+    """
+    dtype = DType()
+    def __init__(self, ids, names):
+        self.fields = { "id" : Field(ids), "name" : Field(names) }
+    def __len__(self):
+        return len(self.fields["id"].values)
+    def __getitem__(self, name):
+        return self.fields[name]
+
+class CountingCursor:
+    """ Counts the fetched records of a cursor.
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.description = cursor.description
+        self.fetched = 0
+    def fetchmany(self, size):
+        records = self.cursor.fetchmany(size)
+        self.fetched += len(records)
+        return records
+
+class Logger:
+    """ Collects the messages of the given level.
+    """
+    def __init__(self, level):
+        self.level = level
+        self.messages = []
+    def write(self, msg, level):
+        if level == self.level:
+            self.messages.append(msg)
+
 class testTMPLTemplateProcessor(unittest.TestCase):
 
     def setUp(self):
@@ -88,7 +158,43 @@ class testTMPLTemplateProcessor(unittest.TestCase):
         self.assertEquals(tmpl.keys(), ["var1","var2"])
         self.assertEquals(tmpl._vars["var1"], 1)
         self.assertEquals(tmpl._vars["var2"], 2)
-        
+
+        # Conversions as by set().
+        data = {"var1":None, "Rows":[{}], "Cols":RecordArray([1], ["a"])}
+        tmpl.setdict(data)
+        self.assertEquals(tmpl._vars["var1"], False)
+        self.assertEquals(tmpl._vars["Rows"], [{}])
+        self.assertEquals(tmpl._vars["Cols"].__class__,
+                          TMPLTemplateProcessor.Columns)
+        self.assertEquals(data["var1"], None)
+
+        # The shape of a mapping is validated once.
+        self.assertEquals(len(tmpl._shapes), 2)
+        tmpl.setdict({"var1":3, "var2":4})
+        self.assertEquals(len(tmpl._shapes), 2)
+        self.assertEquals(tmpl._vars["var1"], 3)
+
+        # Invalid names.
+        self.assertRaises(TemplateException.TemplateException, tmpl.setdict,
+                          {"var1":5, "Var2":6})
+        self.assertEquals(tmpl._vars["var1"], 3)
+        tmpl.setdict({"var1":5, "Var2":6, "rows":[]}, strict=0)
+        self.assertEquals(tmpl._vars["var1"], 5)
+        self.assert_(not tmpl.has_key("Var2"))
+        self.assert_(not tmpl.has_key("rows"))
+        self.assertRaises(TemplateException.TemplateException, tmpl.setdict,
+                          {"var1":5, "Var2":6, "rows":[]})
+
+        # Other mappings.
+        tmpl.setdict(collections.OrderedDict([("var1", 7)]))
+        self.assertEquals(tmpl._vars["var1"], 7)
+        tmpl.setdict(UserDict.UserDict({"var2":8}))
+        self.assertEquals(tmpl._vars["var2"], 8)
+        # Other data is ignored.
+        tmpl.setdict([("var1", 1)])
+        tmpl.setdict(None)
+        self.assertEquals(tmpl._vars["var1"], 7)
+
     def test_escape(self):
 	"""
         Test escape
@@ -166,6 +272,13 @@ class testTMPLTemplateProcessor(unittest.TestCase):
         self.assertEquals(tmpl._vars['var'], 'str')
         tmpl.set('Var', [1,2,3])
         self.assertEquals(tmpl._vars['Var'], [1,2,3])
+        # Iterables which are not iterators are no loops.
+        tmpl.set('tags', set(["a"]))
+        self.assertEquals(tmpl._vars['tags'], True)
+        tmpl.set('box', UserDict.UserDict())
+        self.assertEquals(tmpl._vars['box'], False)
+        tmpl.set('Rows', iter([]))
+        self.assert_(tmpl.is_iterator_loop(tmpl._vars['Rows']))
 
 
     def test_get(self):
@@ -256,7 +369,7 @@ class testTMPLTemplateProcessor(unittest.TestCase):
         f_tmpl.init(TMPLTemplate.__version__, [], ["<TMPL_BOUNDARY","a","b","c","d"], {})
         tmplproc.process(f_tmpl, 2)
         self.assertEquals(tmplproc._current_part, 3)
-        self.assertEquals(tmplproc._current_pos, 4)
+        self.assertEquals(tmplproc._current_pos, 1)
         self.assertEquals(tmplproc.process(f_tmpl, 4), 'd')
 
         f_tmpl.init(TMPLTemplate.__version__, [], ['a','b','c','d',"</TMPL_UNLESS"], {})
@@ -330,6 +443,801 @@ class testTMPLTemplateProcessor(unittest.TestCase):
         # remove tmp dir
         rm_f(os.path.join(path, "tmp"))
         
+    def test_process_part(self):
+        """
+        Test process_part
+        """
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        f_tmpl = compiler.compile_string("head <TMPL_VAR title>"
+                                         "<TMPL_BOUNDARY>"
+                                         "<TMPL_LOOP Rows><TMPL_VAR name>"
+                                         "</TMPL_LOOP><TMPL_BOUNDARY>"
+                                         "<TMPL_IF title>foot</TMPL_IF>")
+        tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        tmplproc.set('title', 'T')
+        tmplproc.set('Rows', [ { 'name' : 'a' }, { 'name' : 'b' } ])
+        self.assertEquals(tmplproc.process_part(f_tmpl, 3), "foot")
+        self.assertEquals(tmplproc.process_part(f_tmpl, 1), "head T")
+        self.assertEquals(tmplproc.process_part(f_tmpl, 2), "ab")
+        self.assertEquals(tmplproc.process_part(f_tmpl, 3), "foot")
+        # The sequential processing is not affected.
+        self.assertEquals(tmplproc.process(f_tmpl, 1), "head T")
+        self.assertEquals(tmplproc.process_part(f_tmpl, 1), "head T")
+        self.assertEquals(tmplproc.process(f_tmpl, 2), "ab")
+        for part in [0, 4]:
+            self.assertRaises(TemplateException.TemplateException,
+                              tmplproc.process_part, f_tmpl, part)
+        f_tmpl = compiler.compile_string("<TMPL_IF title>a<TMPL_BOUNDARY>"
+                                         "</TMPL_IF>b")
+        self.assertRaises(TemplateException.TemplateException,
+                          tmplproc.process_part, f_tmpl, 1)
+
+    def test_context(self):
+        """
+        Test context
+        """
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        f_tmpl = compiler.compile_string("<TMPL_VAR site>:<TMPL_VAR name>"
+                                         "<TMPL_BOUNDARY><TMPL_VAR name>")
+        tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        tmplproc.init(html_escape=0)
+        tmplproc.set('site', '<www>')
+        context = tmplproc.context()
+        context.set('name', 'a')
+        self.assertEquals(context.process(f_tmpl, 1), "<www>:a")
+        self.assertEquals(tmplproc.render(f_tmpl, { 'name' : 'b' }),
+                          "<www>:bb")
+        self.assertEquals(context.process(f_tmpl, 2), "a")
+        # The shared processor is not changed.
+        self.assertEquals(tmplproc.keys(), ['site'])
+        self.assertEquals(tmplproc._current_part, 1)
+
+    def test_context_threads(self):
+        """
+        Concurrent renders of one processor and template
+        """
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        source = ("<TMPL_VAR site><TMPL_VAR id>"
+                  "<TMPL_LOOP Rows><TMPL_VAR __PASS__>=<TMPL_VAR value>"
+                  "<TMPL_IF __LAST__>.</TMPL_IF><TMPL_VAR id GLOBAL=1>"
+                  "</TMPL_LOOP><TMPL_BOUNDARY><TMPL_VAR id>")
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            for codegen in [0, 1]:
+                # Templates are linked and translated by the first render.
+                f_tmpl = compiler.compile_string(source)
+                f_tmpl._linked = 0
+                tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+                tmplproc.init(codegen=codegen)
+                tmplproc.set('site', 'www')
+                errors = []
+                def render(thread):
+                    try:
+                        for i in range(50):
+                            id = "%d-%d" % (thread, i)
+                            rows = [ { 'value' : j } for j in range(i % 4) ]
+                            expected = "www" + id + "".join(
+                                [ "%d=%d%s%s" % (j + 1, j,
+                                                 j == len(rows) - 1 and "."
+                                                 or "", id)
+                                  for j in range(len(rows)) ]) + id
+                            if i % 2:
+                                result = tmplproc.render(f_tmpl,
+                                                         { 'id' : id,
+                                                           'Rows' : rows })
+                            else:
+                                context = tmplproc.context()
+                                context.set('id', id)
+                                context.set('Rows', rows)
+                                result = context.process(f_tmpl, 1) + \
+                                         context.process(f_tmpl, 2)
+                            if result != expected:
+                                errors.append((result, expected))
+                    except Exception, error:
+                        errors.append(error)
+                threads = [ threading.Thread(target=render, args=(thread,))
+                            for thread in range(8) ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.assertEquals(errors, [])
+                self.assertEquals(tmplproc.keys(), ['site'])
+        finally:
+            sys.setcheckinterval(interval)
+
+    def test_process_iter(self):
+        """
+        Test process_iter
+        """
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        f_tmpl = compiler.compile_string("<TMPL_LOOP Rows><TMPL_VAR name>,"
+                                         "</TMPL_LOOP><TMPL_BOUNDARY>tail")
+        tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        tmplproc.set('Rows', [ {'name' : 'row%d' % i} for i in range(100) ])
+        expected = tmplproc.process(f_tmpl)
+
+        tmplproc.reset(keep_data=1)
+        chunks = list(tmplproc.process_iter(f_tmpl, chunk_size=64))
+        self.assert_(len(chunks) > 1)
+        for chunk in chunks[:-1]:
+            self.assert_(len(chunk) >= 64)
+        self.assertEquals("".join(chunks), expected)
+
+        tmplproc.reset(keep_data=1)
+        chunks = list(tmplproc.process_iter(f_tmpl, chunk_size=0))
+        self.assertEquals(chunks[:3], ['row0', ',', 'row1'])
+
+        # Multipart templates.
+        tmplproc.reset(keep_data=1)
+        self.assertEquals("".join(tmplproc.process_iter(f_tmpl, 1)),
+                          expected[:-len('tail')])
+        self.assertEquals("".join(tmplproc.process_iter(f_tmpl, 2)), 'tail')
+        self.assertRaises(TemplateException.TemplateException,
+                          tmplproc.process_iter, f_tmpl, 1)
+
+        tmplproc.reset(keep_data=1)
+        f_tmpl = compiler.compile_string("<TMPL_LOOP Rows>"
+                                         "<TMPL_VAR __EVERY__x></TMPL_LOOP>")
+        self.assertRaises(TemplateException.TemplateException,
+                          list, tmplproc.process_iter(f_tmpl))
+
+    def test_process_blocks(self):
+        """
+        Test that disabled blocks are skipped
+        """
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        tmplproc.set('Rows', [ {}, {} ])
+        # The invalid magic variable is never resolved.
+        f_tmpl = compiler.compile_string("<TMPL_LOOP Rows><TMPL_IF novar>"
+                                         "<TMPL_VAR __EVERY__x><TMPL_ELSE>"
+                                         "<TMPL_VAR __PASS__></TMPL_IF>"
+                                         "</TMPL_LOOP>")
+        self.assertEquals(tmplproc.process(f_tmpl), "12")
+        f_tmpl = compiler.compile_string("<TMPL_LOOP Rows>a<TMPL_ELSE>b"
+                                         "</TMPL_LOOP><TMPL_LOOP None>c"
+                                         "<TMPL_ELSE>d</TMPL_LOOP>")
+        self.assertEquals(tmplproc.process(f_tmpl), "aad")
+        f_tmpl = compiler.compile_string("<TMPL_UNLESS Rows>a<TMPL_ELSE>b"
+                                         "</TMPL_UNLESS>")
+        self.assertEquals(tmplproc.process(f_tmpl), "b")
+
+    def test_process_to(self):
+        """
+        Test process_to
+        """
+        class Sink:
+            def __init__(self):
+                self.writes = []
+            def write(self, data):
+                self.writes.append(data)
+
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        static = "x" * 100
+        f_tmpl = compiler.compile_string(static + "<TMPL_LOOP Rows>"
+                                         "<TMPL_VAR __PASS__>,</TMPL_LOOP>"
+                                         "<TMPL_BOUNDARY>end")
+        for codegen in [0, 1]:
+            tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+            tmplproc.init(codegen=codegen, keep_data=1)
+            tmplproc.set('Rows', [ {} ] * 30)
+            expected = tmplproc.process(f_tmpl)
+            tmplproc.reset(keep_data=1)
+            sink = Sink()
+            self.assertEquals(tmplproc.process_to(f_tmpl, sink, None, 10),
+                              len(expected))
+            self.assertEquals("".join(sink.writes), expected)
+            for data in sink.writes[:-1]:
+                self.assert_(len(data) >= 10)
+            if not codegen:
+                # The static text is written without a copy.
+                self.assert_(sink.writes[0] is f_tmpl.tokens()[0])
+
+        tmplproc.reset(keep_data=1)
+        sink = StringIO.StringIO()
+        tmplproc.process_to(f_tmpl, sink, 1)
+        self.assertEquals(sink.getvalue(), expected[:-3])
+        tmplproc.process_to(f_tmpl, sink, 2)
+        self.assertEquals(sink.getvalue(), expected)
+
+        left, right = socket.socketpair()
+        tmplproc.reset(keep_data=1)
+        tmplproc.process_to(f_tmpl, left)
+        left.close()
+        self.assertEquals(right.makefile().read(), expected)
+        right.close()
+
+        self.assertRaises(TemplateException.TemplateException,
+                          tmplproc.process_to, f_tmpl, None)
+
+    def test_response(self):
+        """
+        Test response
+        """
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        f_tmpl = compiler.compile_string("<head><TMPL_VAR title></head>"
+                                         "<TMPL_BOUNDARY><body>"
+                                         "<TMPL_BOUNDARY></body>")
+        tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+
+        def application(environ, start_response):
+            tmplproc.set('title', 'T')
+            start_response("200 OK", [ ("Content-Type", "text/html") ])
+            return tmplproc.response(f_tmpl)
+
+        environ = {}
+        wsgiref.util.setup_testing_defaults(environ)
+        app = wsgiref.validate.validator(application)
+        result = app(environ, lambda status, headers: None)
+        self.assertEquals(list(result), [ "<head>T</head>", "<body>",
+                                          "</body>" ])
+        result.close()
+        self.assertEquals(tmplproc._current_part, 1)
+        self.assertEquals(tmplproc._current_pos, 0)
+        self.assertEquals(tmplproc.keys(), [])
+
+        # The client disconnects after the first part.
+        result = app(environ, lambda status, headers: None)
+        self.assertEquals(iter(result).next(), "<head>T</head>")
+        result.close()
+        self.assertEquals(tmplproc._current_part, 1)
+        self.assertEquals(tmplproc._current_pos, 0)
+
+        tmplproc.set('title', 'U')
+        result = tmplproc.response(compiler.compile_string("<TMPL_VAR title>"),
+                                   keep_data=1)
+        self.assertEquals(list(result), [ "U" ])
+        result.close()
+        self.assertEquals(tmplproc.keys(), [ 'title' ])
+
+    def test_deferred(self):
+        """
+        Test values computed on demand
+        """
+        calls = []
+        def fetch(name, value):
+            calls.append(name)
+            return value
+
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        f_tmpl = compiler.compile_string("<TMPL_IF show><TMPL_VAR hidden>"
+                                         "</TMPL_IF><TMPL_VAR name>"
+                                         "<TMPL_LOOP Rows><TMPL_VAR id>"
+                                         "<TMPL_VAR name GLOBAL=1>"
+                                         "</TMPL_LOOP><TMPL_VAR name>")
+        Deferred = TMPLTemplateProcessor.Deferred
+        for codegen in [0, 1]:
+            del calls[:]
+            tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+            tmplproc.init(codegen=codegen)
+            tmplproc.set('show', 0)
+            tmplproc.set('hidden', Deferred(fetch, 'hidden', 'h'))
+            tmplproc.set('name', Deferred(fetch, 'name', 'n'))
+            tmplproc.set('Rows', Deferred(fetch, 'Rows',
+                                          [ { 'id' : Deferred(fetch, 'id', 1) },
+                                            { 'id' : 2 } ]))
+            self.assertEquals(tmplproc.process(f_tmpl), "n1n2nn")
+            self.assertEquals(calls, [ 'name', 'Rows', 'id' ])
+
+        self.assertRaises(TemplateException.TemplateException, tmplproc.set,
+                          'ROWS', Deferred(list))
+
+        # Deferred values are computed while the result is streamed.
+        del calls[:]
+        tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        tmplproc.set('name', Deferred(fetch, 'name', 'n'))
+        chunks = tmplproc.process_iter(compiler.compile_string(
+            "head<TMPL_VAR name>"), chunk_size=0)
+        self.assertEquals(chunks.next(), "head")
+        self.assertEquals(calls, [])
+        self.assertEquals(chunks.next(), "n")
+        self.assertEquals(calls, [ 'name' ])
+
+        # A value shared by concurrent contexts is computed once.
+        del calls[:]
+        def slow_fetch(name, value):
+            time.sleep(0.01)
+            return fetch(name, value)
+        tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        tmplproc.set('name', Deferred(slow_fetch, 'name', 'n'))
+        f_tmpl = compiler.compile_string("<TMPL_VAR name>")
+        results = []
+        def render():
+            results.append(tmplproc.render(f_tmpl))
+        threads = [ threading.Thread(target=render) for thread in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(results, [ "n" ] * 8)
+        self.assertEquals(calls, [ 'name' ])
+
+        # Deferred values can be pickled.
+        value = pickle.loads(pickle.dumps(Deferred(len, "abc")))
+        self.assertEquals(value.resolve(), 3)
+
+    def test_iterator_loop(self):
+        """
+        Test loops over iterators
+        """
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        f_tmpl = compiler.compile_string("<TMPL_LOOP Rows><TMPL_VAR __PASS__>"
+                                         "<TMPL_IF __FIRST__>F</TMPL_IF>"
+                                         "<TMPL_IF __LAST__>L</TMPL_IF>"
+                                         "<TMPL_IF __INNER__>I</TMPL_IF>"
+                                         "<TMPL_IF __ODD__>O</TMPL_IF>"
+                                         "<TMPL_IF __EVERY__2>E</TMPL_IF>"
+                                         "<TMPL_LOOP Cells><TMPL_VAR id>"
+                                         "<TMPL_IF __LAST__>/<TMPL_VAR __PASSTOTAL__>"
+                                         "</TMPL_IF></TMPL_LOOP>,<TMPL_ELSE>none"
+                                         "</TMPL_LOOP>")
+        def rows(count):
+            for i in range(count):
+                yield { 'Cells' : iter([ { 'id' : j } for j in range(i) ]) }
+        for codegen in [0, 1]:
+            tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+            tmplproc.init(codegen=codegen)
+            for count in [0, 1, 2, 5]:
+                tmplproc.set('Rows', [ { 'Cells' : [ { 'id' : j }
+                                                     for j in range(i) ] }
+                                       for i in range(count) ])
+                expected = tmplproc.process(f_tmpl)
+                tmplproc.reset()
+                tmplproc.set('Rows', rows(count))
+                self.assertEquals(tmplproc.process(f_tmpl), expected)
+                tmplproc.reset()
+
+            # __PASSTOTAL__ is known in the last pass only.
+            tmplproc.set('Rows', iter([ {}, {} ]))
+            self.assertRaises(TemplateException.TemplateException,
+                              tmplproc.process,
+                              compiler.compile_string("<TMPL_LOOP Rows>"
+                                                      "<TMPL_VAR __PASSTOTAL__>"
+                                                      "</TMPL_LOOP>"))
+
+        # The iterator is consumed while the result is streamed.
+        consumed = []
+        def numbers():
+            for i in xrange(100000):
+                consumed.append(i)
+                yield { 'n' : i }
+        tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        tmplproc.set('Rows', numbers())
+        chunks = tmplproc.process_iter(compiler.compile_string(
+            "<TMPL_LOOP Rows><TMPL_VAR n>,</TMPL_LOOP>"), chunk_size=0)
+        self.assertEquals([ chunks.next() for i in range(4) ],
+                          [ "0", ",", "1", "," ])
+        self.assertEquals(len(consumed), 3)
+        self.assertRaises(TemplateException.TemplateException, tmplproc.set,
+                          'rows', numbers())
+
+        # Top-level loops over iterators are processed serially.
+        f_tmpl = compiler.compile_string("<TMPL_LOOP Rows>[<TMPL_VAR n>]"
+                                         "</TMPL_LOOP>")
+        for codegen in [0, 1]:
+            tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+            tmplproc.init(codegen=codegen, loop_workers=2, loop_min_rows=1)
+            tmplproc.set('Rows', iter([ { 'n' : i } for i in range(3) ]))
+            self.assertEquals(tmplproc.process(f_tmpl), "[0][1][2]")
+        tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        tmplproc.set('Rows', TMPLTemplateProcessor.Deferred(
+            iter, [ { 'n' : i } for i in range(3) ]))
+        self.assertEquals(tmplproc.session(f_tmpl).process(), "[0][1][2]")
+
+    def test_object_loop(self):
+        """
+        Test loops over objects
+        """
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        f_tmpl = compiler.compile_string("<TMPL_LOOP Orders><TMPL_VAR id>="
+                                         "<TMPL_VAR total>:<TMPL_LOOP items>"
+                                         "<TMPL_VAR name><TMPL_VAR _secret>"
+                                         "<TMPL_VAR missing><TMPL_VAR title "
+                                         "GLOBAL=1>,</TMPL_LOOP>"
+                                         "<TMPL_IF items>!</TMPL_IF>;"
+                                         "</TMPL_LOOP>")
+        orders = [ Order(1, [ Item("a", 2), Item("b", 3) ]), Order(2, []),
+                   UserDict.UserDict({ "id" : 3, "items" : [ Item("c", 1) ] }) ]
+        for codegen in [0, 1]:
+            tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+            tmplproc.init(codegen=codegen)
+            tmplproc.set('Orders', orders)
+            tmplproc.set('title', 'T')
+            self.assertEquals(tmplproc.process(f_tmpl),
+                              "1=5:aT,bT,!;2=0:;3=:cT,!;")
+
+        # The accessors are found once per class and name.
+        accessor = TMPLTemplateProcessor.ACCESSORS[(Item, 'name')]
+        self.assertEquals(TMPLTemplateProcessor.lookup(Item("d", 0), 'name'),
+                          "d")
+        self.assert_(TMPLTemplateProcessor.ACCESSORS[(Item, 'name')] is accessor)
+        self.assert_(TMPLTemplateProcessor.lookup(Item("d", 0), '_secret') is
+                     TMPLTemplateProcessor.MISSING)
+        self.assert_(TMPLTemplateProcessor.lookup(UserDict.UserDict(), 'id') is
+                     TMPLTemplateProcessor.MISSING)
+
+        # Rows which are sequences with keys.
+        connection = sqlite3.connect(":memory:")
+        connection.row_factory = sqlite3.Row
+        rows = connection.execute("select 1 as id, 'a' as name").fetchall()
+        f_tmpl = compiler.compile_string("<TMPL_LOOP Rows>[<TMPL_VAR id>:"
+                                         "<TMPL_VAR name><TMPL_VAR x>]"
+                                         "</TMPL_LOOP>")
+        for codegen in [0, 1]:
+            tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+            tmplproc.init(codegen=codegen)
+            tmplproc.set('Rows', rows)
+            self.assertEquals(tmplproc.process(f_tmpl), "[1:a]")
+        connection.close()
+
+        # Rows with a default value don't get the names looked up and the
+        # names not found are looked up globally.
+        rows = [ collections.defaultdict(list, { 'name' : 'x' }) ]
+        f_tmpl = compiler.compile_string("<TMPL_LOOP Rows>[<TMPL_VAR name>|"
+                                         "<TMPL_VAR missing>|<TMPL_VAR title "
+                                         "GLOBAL=1>]</TMPL_LOOP>")
+        for codegen in [0, 1]:
+            tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+            tmplproc.init(codegen=codegen)
+            tmplproc.set('Rows', rows)
+            tmplproc.set('title', 'T')
+            self.assertEquals(tmplproc.process(f_tmpl), "[x||T]")
+        self.assertEquals(rows, [ { 'name' : 'x' } ])
+
+        # The number of remembered accessors is bounded.
+        for i in range(TMPLTemplateProcessor.ACCESSORS_SIZE + 1):
+            TMPLTemplateProcessor.lookup(Item("d", 0), "name%d" % i)
+        self.assert_(len(TMPLTemplateProcessor.ACCESSORS) <=
+                     TMPLTemplateProcessor.ACCESSORS_SIZE)
+
+    def test_columns(self):
+        """
+        Test loops given by columns
+        """
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        f_tmpl = compiler.compile_string("<TMPL_IF Rows><TMPL_VAR Rows>:"
+                                         "</TMPL_IF><TMPL_LOOP Rows>"
+                                         "<TMPL_VAR id>=<TMPL_VAR name>"
+                                         "<TMPL_IF __LAST__>.<TMPL_ELSE>,"
+                                         "</TMPL_IF></TMPL_LOOP>")
+        columns = TMPLTemplateProcessor.Columns({
+            "id" : array.array("i", [1, 2, 3]),
+            "name" : ["a", "<b>", "c"] })
+        self.assertEquals(len(columns), 3)
+        self.assertEquals(columns[-1]["name"], "c")
+        self.assertEquals(columns[0]["id"].__class__, int)
+        self.assert_(not hasattr(columns[0], "__dict__"))
+        self.assertRaises(IndexError, columns.__getitem__, 3)
+        self.assertRaises(TemplateException.TemplateException,
+                          TMPLTemplateProcessor.Columns,
+                          { "id" : [1], "name" : [] })
+        self.assertEquals(len(TMPLTemplateProcessor.Columns({})), 0)
+
+        for codegen in [0, 1]:
+            tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+            tmplproc.init(codegen=codegen)
+            tmplproc.set('Rows', columns)
+            self.assertEquals(tmplproc.process(f_tmpl),
+                              "3:1=a,2=&lt;b&gt;,3=c.")
+            tmplproc.set('Rows', RecordArray([4, 5], ["d", "e"]))
+            self.assertEquals(tmplproc['Rows'].__class__,
+                              TMPLTemplateProcessor.Columns)
+            self.assertEquals(tmplproc.process(f_tmpl), "2:4=d,5=e.")
+            # Nested loops and empty columns.
+            tmplproc.set('Rows', [ { 'Rows' : RecordArray([6], ["f"]) } ])
+            self.assertEquals(tmplproc.process(compiler.compile_string(
+                "<TMPL_LOOP Rows><TMPL_LOOP Rows><TMPL_VAR name>"
+                "</TMPL_LOOP></TMPL_LOOP>")), "f")
+            tmplproc.set('Rows', TMPLTemplateProcessor.Columns({ "id" : [] }))
+            self.assertEquals(tmplproc.process(f_tmpl), "")
+
+        # Sessions reuse the passes of columns.
+        tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        tmplproc.set('Rows', columns)
+        session = tmplproc.session(f_tmpl)
+        session.process()
+        self.assertEquals(session.process(), "3:1=a,2=&lt;b&gt;,3=c.")
+        self.assertEquals(session.hits, 3)
+
+    def test_cursor_rows(self):
+        """
+        Test loops given by cursors
+        """
+        connection = sqlite3.connect(":memory:")
+        connection.execute("create table item (id integer, name text)")
+        connection.executemany("insert into item values (?, ?)",
+                               [ (i, "<%d>" % i) for i in range(1000) ])
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        f_tmpl = compiler.compile_string("<TMPL_LOOP Items><TMPL_VAR id>"
+                                         "<TMPL_VAR name><TMPL_VAR x>"
+                                         "<TMPL_IF __LAST__>.</TMPL_IF>"
+                                         "</TMPL_LOOP>")
+        expected = "".join([ "%d&lt;%d&gt;" % (i, i) for i in range(1000) ])
+        for codegen in [0, 1]:
+            tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+            tmplproc.init(codegen=codegen)
+            cursor = connection.execute("select id, name from item "
+                                        "order by id")
+            tmplproc.set('Items', TMPLTemplateProcessor.CursorRows(cursor, 7))
+            self.assertEquals(tmplproc.process(f_tmpl), expected + ".")
+        cursor = connection.execute("select id from item")
+        scope = iter(TMPLTemplateProcessor.CursorRows(cursor)).next()
+        self.assert_(not hasattr(scope, "__dict__"))
+
+        # The records are fetched while the output is streamed.
+        cursor = CountingCursor(connection.execute("select id, name "
+                                                   "from item order by id"))
+        tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        tmplproc.set('Items', TMPLTemplateProcessor.CursorRows(cursor, 10))
+        chunks = tmplproc.process_iter(f_tmpl, chunk_size=0)
+        self.assertEquals([ chunks.next() for i in range(4) ],
+                          [ "0", "&lt;0&gt;", "1", "&lt;1&gt;" ])
+        self.assertEquals(cursor.fetched, 10)
+
+        tmplproc.reset()
+        tmplproc.set('Items', TMPLTemplateProcessor.CursorRows(
+            connection.cursor()))
+        self.assertRaises(TemplateException.TemplateException,
+                          tmplproc.process, f_tmpl)
+        connection.close()
+
+    def test_unused(self):
+        """
+        Test handling of unused data
+        """
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        f_tmpl = compiler.compile_string("<TMPL_VAR title><TMPL_LOOP Rows>"
+                                         "<TMPL_VAR name><TMPL_VAR site "
+                                         "GLOBAL=1><TMPL_VAR user></TMPL_LOOP>")
+        data = { 'title' : 'T', 'site' : 'S', 'user' : 'U', 'other' : 'O',
+                 'Rows' : [ { 'name' : 'a' } ], 'Items' : [] }
+        self.assertRaises(TemplateException.TemplateException,
+                          self.__testee.init, unused="drop")
+
+        logger = Logger(logging.WARNING)
+        tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        tmplproc.init(logger=logger, unused="warn")
+        tmplproc.setdict(data)
+        self.assertEquals(sorted(tmplproc.unused_vars(f_tmpl, data)),
+                          ['Items', 'other', 'user'])
+        self.assertEquals(tmplproc.process(f_tmpl), "TaS")
+        self.assertEquals(logger.messages, [ "UNUSED DATA: %s: Items, other, "
+                                             "user" % f_tmpl.getid() ])
+        tmplproc.init(logger=logger, unused="warn", global_vars=1)
+        self.assertEquals(tmplproc.render(f_tmpl, data), "TaSU")
+        self.assertEquals(logger.messages[1:], [ "UNUSED DATA: %s: Items, "
+                                                 "other" % f_tmpl.getid() ])
+
+        tmplproc.init(unused="ignore")
+        title = { 'title' : 'T' }
+        self.assert_(tmplproc.used(f_tmpl, title) is title)
+        self.assertEquals(tmplproc.used(f_tmpl, data),
+                          { 'title' : 'T', 'site' : 'S',
+                            'Rows' : [ { 'name' : 'a' } ] })
+        self.assertEquals(len(data), 6)
+        # Invalid names of unused data are not noticed.
+        self.assertEquals(tmplproc.render(f_tmpl, { 'title' : 'T', 'X' : 1 }),
+                          "T")
+        tmplproc.set('Other', [ {} ])
+        self.assertEquals(list(tmplproc.process_many(f_tmpl,
+                                                     [ { 'title' : 1,
+                                                         'Name' : 2 } ],
+                                                     workers=2)), ["1"])
+        tmplproc.close()
+        tmplproc.init()
+        self.assert_(tmplproc.used(f_tmpl, data) is data)
+
+    def test_process_many(self):
+        """
+        Test process_many
+        """
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        f_tmpl = compiler.compile_string("<TMPL_VAR site>:<TMPL_VAR name>"
+                                         "<TMPL_LOOP Items>,<TMPL_VAR id>"
+                                         "</TMPL_LOOP>")
+        datasets = [ { 'name' : 'user%d' % i,
+                       'Items' : [ { 'id' : j } for j in range(i % 3) ] }
+                     for i in range(50) ]
+        expected = [ "www:user%d" % i + "".join([ ",%d" % j
+                                                  for j in range(i % 3) ])
+                     for i in range(50) ]
+        tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        tmplproc.set('site', 'www')
+        self.assertEquals(list(tmplproc.process_many(f_tmpl, datasets)),
+                          expected)
+        self.assertEquals(list(tmplproc.process_many(f_tmpl, iter(datasets),
+                                                     workers=3, batch_size=4)),
+                          expected)
+        # The common data of the processor is not changed.
+        self.assertEquals(tmplproc.keys(), ['site'])
+        self.assertEquals(list(tmplproc.process_many(f_tmpl, [ { 'site' : 'ftp' } ],
+                                                     workers=2)), ["ftp:"])
+        self.assertEquals(list(tmplproc.process_many(f_tmpl, [], workers=2)), [])
+        # The worker processes are kept for the next calls and are shared
+        # by the contexts.
+        pool = tmplproc._pool.get(2)
+        self.assertEquals(list(tmplproc.context().process_many(
+            f_tmpl, [ { 'name' : 'x' } ], workers=2)), ["www:x"])
+        self.assert_(tmplproc._pool.get(2) is pool)
+        self.assertEquals(list(tmplproc.process_many(f_tmpl,
+            [ collections.OrderedDict([ ('name', 'bob') ]) ])), ["www:bob"])
+        self.assertRaises(TemplateException.TemplateException, list,
+                          tmplproc.process_many(f_tmpl, [ { 'Name' : 'x' } ],
+                                                workers=2))
+        self.assertRaises(TemplateException.TemplateException, list,
+                          tmplproc.process_many(f_tmpl, datasets, batch_size=0))
+        tmplproc.close()
+        self.assertEquals(tmplproc._pool._pools, {})
+        self.assertEquals(list(tmplproc.process_many(f_tmpl, [ {} ],
+                                                     workers=2)), ["www:"])
+        tmplproc.close()
+
+    def test_process_parallel(self):
+        """
+        Test rendering of large loops by worker processes
+        """
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        f_tmpl = compiler.compile_string("<TMPL_VAR title><TMPL_LOOP Rows>"
+                                         "<TMPL_VAR __PASS__>/<TMPL_VAR __PASSTOTAL__>"
+                                         "<TMPL_IF __FIRST__>F</TMPL_IF>"
+                                         "<TMPL_IF __LAST__>L</TMPL_IF>"
+                                         "<TMPL_IF __ODD__>O</TMPL_IF>"
+                                         "<TMPL_IF __INNER__>I</TMPL_IF>"
+                                         "<TMPL_IF __EVERY__3>E</TMPL_IF>"
+                                         "<TMPL_VAR name><TMPL_VAR title GLOBAL=1>"
+                                         "<TMPL_LOOP Cells><TMPL_VAR __PASS__>"
+                                         "</TMPL_LOOP>;<TMPL_ELSE>empty"
+                                         "</TMPL_LOOP><TMPL_BOUNDARY>"
+                                         "<TMPL_LOOP Small>s</TMPL_LOOP>"
+                                         "<TMPL_LOOP Rows>.</TMPL_LOOP>")
+        rows = [ { 'name' : 'n%d' % i, 'Cells' : [ {} ] * (i % 3) }
+                 for i in range(100) ]
+        results = []
+        for workers in [1, 3]:
+            tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+            tmplproc.init(global_vars=1, loop_workers=workers, loop_min_rows=20)
+            tmplproc.set('title', 'T')
+            tmplproc.set('Rows', rows)
+            tmplproc.set('Small', [ {} ])
+            self.assertEquals(len(tmplproc.parallel_loops(f_tmpl.tokens())),
+                              2)
+            results.append(tmplproc.process(f_tmpl))
+            self.assertEquals(tmplproc._current_part, 2)
+            tmplproc.reset(keep_data=1)
+            results.append(tmplproc.process(f_tmpl))
+            tmplproc.close()
+        self.assertEquals(results[0], results[1])
+        self.assertEquals(results[0], results[2])
+        self.assertEquals(results[0], results[3])
+        self.assert_(results[0].startswith("T1/100FOn0T;2/100In1T1;"))
+
+        tmplproc.set('Rows', [])
+        self.assertEquals(tmplproc.parallel_loops(f_tmpl.tokens()), [])
+        self.assertEquals(tmplproc.process(f_tmpl), "Temptys")
+
+        # Loops with a boundary are processed serially.
+        f_tmpl = compiler.compile_string("<TMPL_LOOP Rows>a<TMPL_BOUNDARY>"
+                                         "</TMPL_LOOP>")
+        tmplproc.set('Rows', rows)
+        self.assertEquals(tmplproc.parallel_loops(f_tmpl.tokens()), [])
+
+        # The workers get only their passes of columns.
+        f_tmpl = compiler.compile_string("<TMPL_LOOP Rows><TMPL_VAR id>"
+                                         "<TMPL_IF __LAST__>.</TMPL_IF>"
+                                         "</TMPL_LOOP>")
+        tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        tmplproc.init(loop_workers=3, loop_min_rows=20)
+        tmplproc.set('Rows', TMPLTemplateProcessor.Columns(
+            { 'id' : range(50) }))
+        self.assertEquals(tmplproc.process(f_tmpl),
+                          "".join(map(str, range(50))) + ".")
+        tmplproc.close()
+
+    def test_session(self):
+        """
+        Test session
+        """
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        f_tmpl = compiler.compile_string("<TMPL_VAR title>"
+                                         "<TMPL_LOOP Rows>[<TMPL_VAR name>"
+                                         "<TMPL_LOOP Cells><TMPL_VAR __PASS__>"
+                                         "</TMPL_LOOP>]<TMPL_ELSE>empty"
+                                         "</TMPL_LOOP>"
+                                         "<TMPL_LOOP Items><TMPL_VAR id>"
+                                         "<TMPL_IF __LAST__>.</TMPL_IF>"
+                                         "</TMPL_LOOP>"
+                                         "<TMPL_LOOP Rows><TMPL_VAR name>"
+                                         "<TMPL_VAR title GLOBAL=1>"
+                                         "</TMPL_LOOP>")
+        tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        session = tmplproc.session(f_tmpl)
+        rows = [ { 'name' : 'r%d' % i, 'Cells' : [ {} ] * (i % 3) }
+                 for i in range(5) ]
+        items = [ { 'id' : i } for i in range(3) ]
+        checked = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        def check(title, rows, items):
+            for processor in [tmplproc, checked]:
+                processor.set('title', title)
+                processor.set('Rows', rows)
+                processor.set('Items', items)
+            self.assertEquals(session.process(), checked.process(f_tmpl))
+
+        check('T', rows, items)
+        self.assertEquals((session.hits, session.misses), (0, 13))
+        # One changed row, one removed item and the same title.
+        rows[2] = { 'name' : 'changed', 'Cells' : [] }
+        check('T', rows, items[:2])
+        self.assertEquals((session.hits, session.misses), (8, 17))
+        # The magic variables of the loop depend on the number of passes
+        # and the global variable on the top-level scope.
+        check('U', rows, [ { 'id' : 9 } ] + items)
+        self.assertEquals((session.hits, session.misses), (13, 26))
+        check('U', [], [])
+        self.assertEquals(tmplproc.process(f_tmpl), "Uempty")
+
+        # Passes with equal fingerprints are rendered once.
+        session = tmplproc.session(f_tmpl, repr)
+        check('T', rows + [ rows[0] ], items)
+        self.assertEquals((session.hits, session.misses), (2, 13))
+        session.clear()
+        session.process()
+        self.assertEquals((session.hits, session.misses), (4, 26))
+
+    def test_process_cache(self):
+        """
+        Test processing of TMPL_CACHE blocks
+        """
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        f_tmpl = compiler.compile_string("<TMPL_LOOP Rows>"
+                                         "<TMPL_CACHE id>[<TMPL_VAR name>"
+                                         "<TMPL_LOOP Cells><TMPL_VAR __PASS__>"
+                                         "</TMPL_LOOP>]</TMPL_CACHE>"
+                                         "<TMPL_VAR __PASS__></TMPL_LOOP>"
+                                         "<TMPL_CACHE>|<TMPL_VAR title>"
+                                         "</TMPL_CACHE>")
+        rows = [ { 'id' : 1, 'name' : 'a', 'Cells' : [ {}, {} ] },
+                 { 'id' : 2, 'name' : 'b', 'Cells' : [] },
+                 { 'id' : 1, 'name' : 'c', 'Cells' : [] } ]
+        for codegen in [0, 1]:
+            cache = TMPLTemplateCache.TMPLTemplateCache()
+            tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+            tmplproc.init(codegen=codegen)
+            tmplproc.setdict({ 'title' : 'T', 'Rows' : rows })
+            self.assertEquals(tmplproc.process(f_tmpl),
+                              "[a12]1[b]2[c]3|T")
+
+            tmplproc.init(codegen=codegen, cache=cache)
+            tmplproc.setdict({ 'title' : 'T', 'Rows' : rows })
+            self.assertEquals(tmplproc.process(f_tmpl),
+                              "[a12]1[b]2[a12]3|T")
+            self.assertEquals((cache.hits, cache.misses), (1, 3))
+            tmplproc.set('title', 'U')
+            self.assertEquals(tmplproc.process(f_tmpl),
+                              "[a12]1[b]2[a12]3|T")
+            self.assertEquals((cache.hits, cache.misses), (5, 3))
+            # The parts are processed by the interpreter.
+            self.assertEquals("".join(tmplproc.process_iter(f_tmpl)),
+                              "[a12]1[b]2[a12]3|T")
+
+        # Processors with other settings don't share fragments.
+        f_tmpl = compiler.compile_string("[<TMPL_CACHE><TMPL_VAR name>"
+                                         "</TMPL_CACHE>]")
+        cache = TMPLTemplateCache.TMPLTemplateCache()
+        for codegen in [0, 1]:
+            for html_escape, expected in [(1, "[&lt;b&gt;]"), (0, "[<b>]")]:
+                tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+                tmplproc.init(codegen=codegen, html_escape=html_escape,
+                              cache=cache)
+                tmplproc.set('name', '<b>')
+                self.assertEquals(tmplproc.process(f_tmpl), expected)
+            tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+            tmplproc.init(codegen=codegen, cache=cache,
+                          escapes={ 'HTML' : lambda value: "*" })
+            tmplproc.set('name', '<b>')
+            self.assertEquals(tmplproc.process(f_tmpl), "[*]")
+
     def test_find_value(self):
 	"""
         Test find_value
@@ -343,12 +1251,65 @@ class testTMPLTemplateProcessor(unittest.TestCase):
         self.assertEquals(tmpl.find_value('Nolist',[], 0, 0), 0)
         self.assertEquals(tmpl.find_value('var',[], 0, 0), '')
 
+    def test_find_global(self):
+        """
+        Test global lookup through the scope chain
+        """
+        tmpl = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        tmpl.set('var', 'top')
+        tmpl.set('List', [1,2,3])
+        scopes = [ { 'var' : 'outer', 'List' : [] }, { 'other' : 1 } ]
+        chains = [ {}, {} ]
+        self.assertEquals(tmpl.find_global('var', scopes, 1, chains), 'outer')
+        self.assertEquals(tmpl.find_global('var', scopes, 0, chains), 'top')
+        self.assertEquals(tmpl.find_global('List', scopes, 1, chains), None)
+        # The results are remembered until the loop is left.
+        self.assertEquals(chains[1], { 'var' : 'outer', 'List' : None })
+        scopes[0]['var'] = 'changed'
+        self.assertEquals(tmpl.find_value('var', scopes, [0,0], [1,1], 1,
+                                          chains), 'outer')
+        self.assertEquals(tmpl.find_value('var', scopes, [0,0], [1,1], 1),
+                          'changed')
+        self.assertEquals(tmpl.find_value('var', scopes, [0,0], [1,1], 0,
+                                          chains), '')
+        self.assertEquals(tmpl.find_loop('List', [], [], []), [1,2,3])
+        self.assertEquals(tmpl.find_loop('Nolist', [], [], []), [])
+
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        f_tmpl = compiler.compile_string("<TMPL_LOOP A><TMPL_LOOP B>"
+                                         "<TMPL_LOOP C><TMPL_VAR v GLOBAL=1>"
+                                         "<TMPL_VAR w GLOBAL=1><TMPL_VAR x>,"
+                                         "<TMPL_ELSE><TMPL_VAR v GLOBAL=1>"
+                                         "</TMPL_LOOP></TMPL_LOOP>"
+                                         "</TMPL_LOOP>")
+        for codegen in [0, 1]:
+            tmplproc = TMPLTemplateProcessor.TMPLTemplateProcessor()
+            tmplproc.init(codegen=codegen)
+            tmplproc.set('v', 'V')
+            tmplproc.set('A', [ { 'w' : 'a1', 'B' : [ { 'C' : [ { 'x' : 1 },
+                                                                 { 'x' : 2 } ] },
+                                                       { 'w' : 'b', 'C' : [] },
+                                                       { 'C' : [ {} ] } ] },
+                                { 'v' : 'a2', 'B' : [ { 'C' : [ {} ] } ] } ])
+            # Variables in the ELSE block of an empty loop are not found.
+            self.assertEquals(tmplproc.process(f_tmpl), "Va11,Va12,Va1,a2,")
+
     def test_instance_boundary(self):
         templateprocessor = TMPLTemplateProcessor.TMPLTemplateProcessor()
 
         tested = sets.Set(['init', 'escape', 'magic_var', 'get', 
                            '__setitem__', '__getitem__', '__delitem__', 'has_key', 
-                           'keys', 'setlogger', 'find_value', 'is_ordinary_var', ])
+                           'keys', 'setlogger', 'find_value', 'is_ordinary_var',
+                           'process_iter', 'process_many',
+                           'process_to', 'response', 'session',
+                           'process_part', 'context', 'render', 'close',
+                           'debug', 'check', 'check_data', 'plan', 'used',
+                           'unused_vars', 'settings', 'batches', 'chunks',
+                           'process_tokens', 'process_parallel',
+                           'parallel_loops', 'top_loops', 'has_boundary',
+                           'referenced_names', 'is_iterator_loop',
+                           'find_loop', 'find_global', 'escape_value',
+                           'jump', 'loop_end', 'cache_scope', ])
 
         all_dir = tested | sets.Set(dir(templateprocessor))
 
@@ -362,7 +1323,17 @@ class testTMPLTemplateProcessor(unittest.TestCase):
 
         tested = sets.Set(['init', 'escape', 'magic_var', 'get', 
                            '__setitem__', '__getitem__', '__delitem__', 'has_key', 
-                           'keys', 'setlogger', 'find_value', 'is_ordinary_var', ])
+                           'keys', 'setlogger', 'find_value', 'is_ordinary_var',
+                           'process_iter', 'process_many',
+                           'process_to', 'response', 'session',
+                           'process_part', 'context', 'render', 'close',
+                           'debug', 'check', 'check_data', 'plan', 'used',
+                           'unused_vars', 'settings', 'batches', 'chunks',
+                           'process_tokens', 'process_parallel',
+                           'parallel_loops', 'top_loops', 'has_boundary',
+                           'referenced_names', 'is_iterator_loop',
+                           'find_loop', 'find_global', 'escape_value',
+                           'jump', 'loop_end', 'cache_scope', ])
 
         all_dir = tested | base_set
 
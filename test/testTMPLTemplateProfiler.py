@@ -0,0 +1,108 @@
+"""
+PyUnit TestCase for TMPLTemplateProfiler.
+
+$Id: testTMPLTemplateProfiler.py 3193 2010-11-10 14:22:01Z duan $
+"""
+
+__version__= "$Revision: 3193 $"[11:-2]
+
+import unittest
+
+# more imports
+import template.TMPLTemplateManager as TMPLTemplateManager
+import template.TMPLTemplateProcessor as TMPLTemplateProcessor
+import template.TMPLTemplateProfiler as TMPLTemplateProfiler
+
+# test fixture
+
+TEMPLATE = """<h1><TMPL_VAR title></h1>
+<TMPL_LOOP Rows><TMPL_IF odd><TMPL_VAR name><TMPL_ELSE>-</TMPL_IF>
+</TMPL_LOOP>"""
+
+DATA = {
+    "title" : "T",
+    "Rows" : [ { "name" : "ab", "odd" : 1 }, { "name" : "cd" },
+               { "name" : "ef", "odd" : 1 } ],
+    }
+
+class Timer:
+    """ A clock which advances by one second on every reading.
+    """
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        self.now += 1.0
+        return self.now
+
+class testTMPLTemplateProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.__testee = TMPLTemplateProfiler.TMPLTemplateProfiler(Timer())
+        compiler = TMPLTemplateManager.TMPLTemplateCompiler()
+        self.template = compiler.compile_string(TEMPLATE)
+
+    def tearDown(self):
+        self.__testee = None
+
+    def process(self, profiler):
+        processor = TMPLTemplateProcessor.TMPLTemplateProcessor()
+        processor.init(profiler=profiler)
+        processor.setdict(DATA)
+        return processor.process(self.template)
+
+    def test_stats(self):
+        """
+        Test stats
+        """
+        self.assertEquals(self.__testee.stats(), [])
+        expected = self.process(None)
+        self.assertEquals(self.process(self.__testee), expected)
+        self.assertEquals(self.process(self.__testee), expected)
+        template = self.template.getid()
+        counts = [ (stat[1], stat[2], stat[4])
+                   for stat in self.__testee.stats() ]
+        self.assertEquals(counts, [
+            ((), 2, 2 * len(expected)),
+            (("TMPL_LOOP Rows",), 2, 2 * 5),
+            (("TMPL_LOOP Rows", "TMPL_IF odd"), 6, 2 * 5),
+            (("TMPL_LOOP Rows", "TMPL_IF odd", "TMPL_VAR name"), 4, 2 * 4),
+            (("TMPL_VAR title",), 2, 2) ])
+        for stat in self.__testee.stats():
+            self.assertEquals(stat[0], template)
+            self.assert_(stat[3] > 0)
+
+    def test_table(self):
+        """
+        Test table
+        """
+        self.process(self.__testee)
+        lines = self.__testee.table(sort="count").splitlines()
+        self.assertEquals(len(lines), 6)
+        self.assert_(lines[0].split() == [ "count", "time", "[ms]", "bytes",
+                                          "statement" ])
+        self.assert_(lines[1].endswith("TMPL_LOOP Rows / TMPL_IF odd"))
+        self.assertEquals(len(self.__testee.table(limit=2).splitlines()), 3)
+
+    def test_collapsed(self):
+        """
+        Test collapsed
+        """
+        self.process(self.__testee)
+        template = self.template.getid()
+        total = 0
+        for line in self.__testee.collapsed().splitlines():
+            frames, micros = line.rsplit(" ", 1)
+            self.assertEquals(frames.split(";")[0], template)
+            total += int(micros)
+        # The own times add up to the time of the whole template.
+        self.assertEquals(total, int(self.__testee.stats()[0][3] * 1000000))
+
+    def test_reset(self):
+        """
+        Test reset
+        """
+        self.process(self.__testee)
+        self.__testee.reset()
+        self.assertEquals(self.__testee.stats(), [])
+        self.process(self.__testee)
+        self.assertEquals(self.__testee.stats()[0][2], 1)